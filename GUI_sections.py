@@ -12,10 +12,8 @@ from column_constants import ColumnNames
 import threading
 import time
 import numpy as np
-import sounddevice as sd
 import os
 from datetime import datetime
-from data_analysis import DataAnalysis
 
 
 class TkinterApp:
@@ -168,6 +166,7 @@ class TkinterApp:
         tone_shape = voltage * ramp * np.sin(2 * np.pi * freq * 1000 * t / Fs)
 
         # Play sound
+        import sounddevice as sd
         sd.play(tone_shape, Fs)
         sd.wait()  # Wait until sound finishes playing
 
@@ -344,13 +343,18 @@ class TkinterApp:
                 "open_valve_duration": self.parameters_btns.time_open_valve_entry.get(),
                 "open_odor_duration": self.parameters_btns.time_open_odor_entry.get(),
                 "load_odor_duration": self.parameters_btns.load_odor_duration_entry.get(),
+                "inter_odor_delay": self.parameters_btns.inter_odor_delay_entry.get(),
                 "timeout_punishment": self.parameters_btns.timeout_punishment_entry.get(),
                 "ITI": self.parameters_btns.ITI_display_option.get(),
                 "ITI_time": self.parameters_btns.ITI_bin_size_entry.get() if self.parameters_btns.ITI_display_option.get() == '2' else None,
                 "stimulus_length": self.experiment.stim_length,
             }
             # Set parameters in the Experiment class
-            self.experiment.set_levels_df(self.levels_df)
+            try:
+                self.experiment.set_levels_df(self.levels_df)
+            except ValueError as e:
+                messagebox.showerror("Error", f"Invalid levels table:\n{e}")
+                return
             self.mice_table.set_mice_as_dict()
             self.experiment.set_mice_dict(self.mice_table.mice_dict)
             self.experiment.run_live_window()
@@ -365,7 +369,7 @@ class TkinterApp:
             def apply_params_and_save():
                 self.experiment.set_parameters(parameters)
                 # שמירת המצב המינימלי של הניסוי
-                self.experiment.save_minimal_state()
+                self.experiment.save_checkpoint()
                 self.save_parameters_txt()
                 self.save_mice_list_txt()
             self.experiment.root.after(200, apply_params_and_save)
@@ -417,6 +421,8 @@ class TkinterApp:
             self.tree.column(column, width=width)
 
     def open_data_analysis_window(self):
+        # matplotlib and scipy are loaded only when the window is opened
+        from data_analysis import DataAnalysis
         analysis_root = tk.Toplevel()
         DataAnalysis(analysis_root)
 
@@ -514,6 +520,11 @@ class TkinterApp:
                     self.parameters_btns.time_open_valve_entry.delete(0, tk.END)
                     self.parameters_btns.time_open_valve_entry.insert(0, str(exp_params['open_valve_duration']))
                 
+                # inter_odor_delay
+                if 'inter_odor_delay' in exp_params and exp_params['inter_odor_delay'] is not None:
+                    self.parameters_btns.inter_odor_delay_entry.delete(0, tk.END)
+                    self.parameters_btns.inter_odor_delay_entry.insert(0, str(exp_params['inter_odor_delay']))
+                
                 # ITI and optional ITI_time
                 if 'ITI' in exp_params and exp_params['ITI'] is not None:
                     self.parameters_btns.ITI_display_option.set(str(exp_params['ITI']))
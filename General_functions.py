@@ -1,5 +1,4 @@
 import numpy as np
-import sounddevice as sd
 import tkinter as tk
 import smtplib
 from email.mime.text import MIMEText
@@ -101,6 +100,7 @@ def generate_white_noise(duration, Fs, voltage):
     # Clamp the noise values to ensure they stay within the valid range
     noise = np.clip(noise, -1, 1)
     
+    import sounddevice as sd
     sd.play(noise, Fs)
     sd.wait()  # Wait until sound finishes playing
     
@@ -131,6 +131,7 @@ def generate_white_noise_npz(duration, Fs, voltage, save_path='/home/educage/git
     noise = np.clip(noise, -1, 1)
     
     # Play the sound
+    import sounddevice as sd
     sd.play(noise, samplerate=Fs)
     sd.wait()
 
@@ -177,6 +178,7 @@ def scary_with_ultrasonic(duration=3.0, sample_rate=192000, click_rate=10, save_
     signal = signal / np.max(np.abs(signal))
 
     # השמעה
+    import sounddevice as sd
     sd.play(signal, samplerate=sample_rate)
     sd.wait()
 
@@ -221,6 +223,7 @@ def scary_with_clicks(duration=3.0, sample_rate=44100, click_rate=10, save_path
     signal = signal / np.max(np.abs(signal))
 
     # השמעה
+    import sounddevice as sd
     sd.play(signal, samplerate=sample_rate)
     sd.wait()
 
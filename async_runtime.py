@@ -0,0 +1,201 @@
+"""
+asyncio runtime mode of the FSM.
+
+The states (IdleState, InPortState, TrialState) are the same objects the
+threaded mode runs: their run() yields the waits of finite_state_machine
+(Sleep, NextTag, BeamEdge, RunValves, NewLicks, PlaybackStart) and this runtime
+awaits them on one asyncio loop, in the FSM executor thread:
+- tag events of the RFID reader (rfid_reader.RfidReader) are bridged from its thread
+  with call_soon_threadsafe() and read from a queue while in Idle. The RFID fd is
+  not registered with the loop: since the reader service owns the port (and the
+  mice table dialog reads it too), the loop gets its tags like every subscriber
+- lick and IR edges are bridged from the alert thread with call_soon_threadsafe()
+  and awaited as events / futures
+- the start of a punishment sound is bridged from the audio thread the same way
+- valve switches are scheduled with loop.call_at() against the loop's monotonic clock,
+  SPIN_S early, and the callback spins to the deadline (like valve_timeline.ValveSequencer)
+No thread is started for the waiting.
+Selected with FiniteStateMachine(..., mode="asyncio").
+"""
+import asyncio
+import logging
+import time
+
+from finite_state_machine import Sleep, NextTag, BeamEdge, RunValves, NewLicks, PlaybackStart
+from valve_timeline import SwitchRecord, precise_switching
+
+logger = logging.getLogger("rig.fsm")
+
+SPIN_S = 0.001  # the last part of the wait for a valve switch that is busy-waited
+
+
+class AsyncRigRuntime:
+
+    def __init__(self, fsm):
+        self.fsm = fsm
+        self.loop = None
+        self._tags = None
+        self._lick_edge = None
+        self._woken = None  # set by wake(): the sleeps end at once
+        self._beam_waiters = {0: [], 1: []}  # level -> futures waiting for it
+        self.handlers = {Sleep: self.sleep, NextTag: self.next_tag, BeamEdge: self.beam_edge,
+                         RunValves: self.run_valves, NewLicks: self.new_licks, PlaybackStart: self.playback_start}
+
+    def run(self):
+        """Target of the FSM executor thread"""
+        asyncio.run(self._main())
+
+    async def _main(self):
+        self.loop = asyncio.get_running_loop()
+        self._tags = asyncio.Queue()
+        self._lick_edge = asyncio.Event()
+        self._woken = asyncio.Event()
+        self.fsm.lick_capture.listeners.append(self._bridge(self._on_lick_edge))
+        self.fsm.beam.listeners.append(self._bridge(self._on_beam_edge))
+        # the tags come from a listener here, not from the threaded Idle state's queue; the tags
+        # read since the FSM started (before the loop was running) are taken over from that queue
+        self.fsm.rfid.listeners.append(self._on_tag_event)
+        idle_tags = self.fsm.states["Idle"].tags
+        self.fsm.rfid.unsubscribe(idle_tags)
+        while not idle_tags.empty():
+            self._tags.put_nowait(idle_tags.get_nowait())
+        while not self.fsm.stopped:
+            state = self.fsm.state
+            state.enter()
+            event = await self._run_state(state.run())
+            if event is not None:
+                self.fsm.on_event(event)
+
+    async def _run_state(self, steps):
+        """Runs the run() generator of a state to its end. Returns its event"""
+        result = None
+        while True:
+            try:
+                wait = steps.send(result)
+            except StopIteration as stop:
+                return stop.value
+            result = await self.handlers[type(wait)](*wait)
+
+    def wake(self):
+        """Wakes the Idle wait and the sleeps so that the loop sees fsm.stopped (from any thread)"""
+        if self.loop is not None:
+            try:
+                self.loop.call_soon_threadsafe(self._woken.set)
+                self.loop.call_soon_threadsafe(self._tags.put_nowait, None)
+            except RuntimeError:  # the loop is closed
+                pass
+
+    def _bridge(self, callback):
+        """Wraps a loop callback so it can be called from the GPIO alert thread"""
+        def _threadsafe(level, timestamp_ns):
+            self.loop.call_soon_threadsafe(callback, level, timestamp_ns)
+        return _threadsafe
+
+    # ---- inputs ----
+    def _on_tag_event(self, event):
+        """Called from the RFID reader thread"""
+        self.loop.call_soon_threadsafe(self._tags.put_nowait, event)
+
+    def _on_lick_edge(self, level, timestamp_ns):
+        self._lick_edge.set()
+
+    def _on_beam_edge(self, level, timestamp_ns):
+        waiters, self._beam_waiters[level] = self._beam_waiters[level], []
+        for future in waiters:
+            if not future.done():
+                future.set_result(timestamp_ns)
+
+    async def wait_for_beam(self, level, timeout=None):
+        """Waits for the beam to be broken (1) or restored (0). Returns the edge time, or None on timeout"""
+        beam = self.fsm.beam
+        if beam.in_port == (level == 1):
+            return beam.entry_ns if level == 1 else beam.exit_ns
+        future = self.loop.create_future()
+        self._beam_waiters[level].append(future)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            if future in self._beam_waiters[level]:
+                self._beam_waiters[level].remove(future)
+            return None
+
+    # ---- the waits of the states ----
+    async def sleep(self, seconds):
+        try:
+            await asyncio.wait_for(self._woken.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def next_tag(self, timeout):
+        try:
+            return await asyncio.wait_for(self._tags.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def beam_edge(self, level, timeout, since_ns):
+        if level == 0 and since_ns is not None:
+            # like BeamMonitor.wait_for_exit: the mouse's exit counts even if the beam is broken again since
+            exit_ns = self.fsm.beam.exit_after(since_ns)
+            if exit_ns is not None:
+                return exit_ns
+        return await self.wait_for_beam(level, timeout)
+
+    async def run_valves(self, switches, on_switch):
+        """Schedules the switches on the loop; switches with the same offset run in one callback, in order"""
+        t0 = self.loop.time()
+        t0_ns = time.monotonic_ns()
+        groups = {}
+        for switch in switches:
+            groups.setdefault(switch.offset_ns, []).append(switch)
+        records = []
+        done = self.loop.create_future()
+        last = max(groups)
+        with precise_switching():
+            for offset_ns, group in groups.items():
+                self.loop.call_at(t0 + offset_ns / 1e9 - SPIN_S, self._switch, group, t0_ns + offset_ns, records,
+                                  on_switch, done if offset_ns == last else None)
+            await done
+        return records
+
+    def _switch(self, switches, planned_ns, records, on_switch, done):
+        while time.monotonic_ns() < planned_ns:
+            pass
+        for switch in switches:
+            if switch.level:
+                self.fsm.hw.valve_on(switch.channel)
+            else:
+                self.fsm.hw.valve_off(switch.channel)
+            records.append(SwitchRecord(planned_ns, time.monotonic_ns(), switch.channel, switch.level))
+            if on_switch is not None:
+                on_switch(switch.channel, switch.level)
+        if done is not None and not done.done():
+            done.set_result(None)
+
+    async def new_licks(self, deadline_ns):
+        self._lick_edge.clear()
+        licks = self.fsm.lick_capture.pop_all()
+        remaining = (deadline_ns - time.monotonic_ns()) / 1e9
+        if not licks and remaining > 0:
+            try:
+                await asyncio.wait_for(self._lick_edge.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+            licks = self.fsm.lick_capture.pop_all()
+        return licks
+
+    async def playback_start(self, playback, timeout):
+        started = self.loop.create_future()
+
+        def _on_start():  # from the audio thread
+            try:
+                self.loop.call_soon_threadsafe(lambda: started.done() or started.set_result(True))
+            except RuntimeError:  # the loop is closed
+                pass
+
+        playback.listeners.append(_on_start)
+        if playback.started.is_set():
+            return True
+        try:
+            return await asyncio.wait_for(started, timeout)
+        except asyncio.TimeoutError:
+            return False
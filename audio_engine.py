@@ -0,0 +1,166 @@
+"""
+Audio output of the rig.
+
+AudioEngine opens one output stream when the FSM starts and keeps it open for
+the whole session. The sounds are loaded once and resampled to the stream's
+rate, so play() only hands a buffer to the stream callback and returns.
+The stream runs at the highest rate of the sounds if the device can play it.
+A sound is only ever upsampled (band-limited): a sound above the device's rate
+would lose its high frequencies (the ultrasonic part of a punishment noise),
+so it is refused and logged as an error instead of silently changed.
+The callback starts the sound at the next block and stamps its onset (the time
+the first sample reaches the DAC, on the time.monotonic_ns() clock).
+"""
+import logging
+import os
+import threading
+import time
+from math import gcd
+
+import numpy as np
+
+import stimulus_bank
+
+logger = logging.getLogger("rig.audio")
+
+# name -> file in stimuli/ (.npz with the samples in 'noise' or 'data' and the rate in 'Fs')
+PUNISHMENT_SOUNDS = {
+    "white_noise": "white_noise.npz",
+    "scary_noise": "scary_noise.npz",
+    "scary_noise_with_ultrasonic": "scary_noise_with_ultrasonic.npz",
+}
+
+
+def load_sound(path):
+    """Returns (mono float32 samples, samplerate) of a stimuli .npz file"""
+    with np.load(path) as z:
+        data = z['noise'] if 'noise' in z.files else z['data']
+        samplerate = int(z['Fs'])
+    data = np.asarray(data, dtype=np.float32)
+    if data.ndim > 1:
+        data = data.mean(axis=1)
+    return data, samplerate
+
+
+def resample(data, samplerate, target_samplerate):
+    """Band-limited (polyphase FIR) resampling to target_samplerate"""
+    if samplerate == target_samplerate:
+        return np.array(data, dtype=np.float32)
+    from scipy.signal import resample_poly  # only needed when a sound is not at the stream's rate
+    divisor = gcd(int(samplerate), int(target_samplerate))
+    return resample_poly(data, int(target_samplerate) // divisor, int(samplerate) // divisor).astype(np.float32)
+
+
+class Playback:
+    """One play() request. onset_ns is set by the stream callback when the sound starts"""
+
+    def __init__(self, name, buffer, samplerate):
+        self.name = name
+        self.buffer = buffer
+        self.duration_s = len(buffer) / samplerate
+        self.requested_ns = time.monotonic_ns()
+        self.onset_ns = None
+        self.started = threading.Event()
+        self.finished = threading.Event()
+        self.listeners = []  # callback() when the sound starts, called from the audio thread (must not block)
+
+    @property
+    def latency_ms(self):
+        """From play() to the first sample at the DAC"""
+        if self.onset_ns is None:
+            return None
+        return (self.onset_ns - self.requested_ns) / 1e6
+
+    @property
+    def end_ns(self):
+        """When the sound ends (estimated from the request if it did not start yet)"""
+        start = self.onset_ns if self.onset_ns is not None else self.requested_ns
+        return start + int(self.duration_s * 1e9)
+
+
+class AudioEngine:
+
+    def __init__(self, backend, sounds=PUNISHMENT_SOUNDS, folder='stimuli', blocksize=256):
+        """
+        backend: hardware.HardwareBackend, opens the output stream
+        sounds: name -> file in folder, preloaded at the stream's rate
+        """
+        bank = stimulus_bank.open_bank(folder)
+        raw = {}
+        for name, file_name in sounds.items():
+            try:
+                if bank is not None and file_name in bank:
+                    raw[name] = bank.get(file_name)
+                else:
+                    raw[name] = load_sound(os.path.join(folder, file_name))
+            except FileNotFoundError:
+                logger.error("%s not found, the '%s' sound will not work", file_name, name)
+        # the highest rate of the sounds, so ultrasonic content survives if the device can play it
+        preferred = max((samplerate for _, samplerate in raw.values()), default=None)
+        self.samplerate = backend.audio_samplerate(preferred)
+        self.sounds = {}
+        for name, (data, samplerate) in raw.items():
+            if samplerate > self.samplerate:
+                logger.error("The audio device plays %d Hz, the '%s' sound needs %d Hz: it is unavailable",
+                             self.samplerate, name, samplerate)
+                continue
+            self.sounds[name] = resample(data, samplerate, self.samplerate)
+        self._missing = set()  # sounds play() was asked for and did not have (logged once)
+
+        # Handed from play()/stop() to the callback by single assignments, so the audio thread never waits for a lock
+        self._request = None
+        self._stop_request = False
+        self._playing = None
+        self._position = 0
+        self.last_playback = None
+        self.stream = backend.open_audio_stream(self._callback, self.samplerate, blocksize)
+
+    def play(self, name):
+        """Starts a sound at the next audio block and returns its Playback without waiting"""
+        buffer = self.sounds.get(name)
+        if buffer is None:
+            if name not in self._missing:
+                self._missing.add(name)
+                logger.error("No sound named '%s', playing nothing", name)
+            buffer = np.zeros(0, dtype=np.float32)
+        playback = Playback(name, buffer, self.samplerate)
+        self._request = playback
+        self.last_playback = playback
+        return playback
+
+    def stop(self):
+        """Silences the current sound at the next audio block"""
+        self._stop_request = True
+
+    def _callback(self, outdata, frames, dac_delay_s):
+        if self._stop_request:
+            self._stop_request = False
+            self._finish()
+        request = self._request
+        if request is not None:
+            self._request = None
+            self._finish()
+            self._playing = request
+            self._position = 0
+            request.onset_ns = time.monotonic_ns() + int(dac_delay_s * 1e9)
+            request.started.set()
+            for listener in request.listeners:
+                listener()
+        playing = self._playing
+        if playing is None:
+            outdata.fill(0)
+            return
+        n = min(frames, len(playing.buffer) - self._position)
+        outdata[:n, 0] = playing.buffer[self._position:self._position + n]
+        outdata[n:] = 0
+        self._position += n
+        if self._position >= len(playing.buffer):
+            self._finish()
+
+    def _finish(self):
+        if self._playing is not None:
+            self._playing.finished.set()
+            self._playing = None
+
+    def close(self):
+        self.stream.close()
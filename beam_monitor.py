@@ -0,0 +1,59 @@
+import threading
+from collections import deque
+
+import input_sampler
+
+
+class BeamMonitor:
+    """
+    Tracks the IR beam of the port from its edge events.
+    Beam break (level 1) = the mouse entered, beam restore (level 0) = the mouse left.
+    Both edges are timestamped on the time.monotonic_ns() clock (they come from
+    the session's InputSampler) and waiting threads are woken up by a condition
+    instead of polling the pin.
+    """
+
+    def __init__(self, backend, sampler):
+        self._cond = threading.Condition()
+        self.in_port = backend.read_ir() == 1
+        self.entry_ns = None  # time of the last beam break
+        self.exit_ns = None   # time of the last beam restore
+        self.exits = deque(maxlen=16)  # times of the recent beam restores, oldest first
+        self.listeners = []   # extra callback(level, timestamp_ns), called from the alert thread
+        sampler.listeners[input_sampler.IR].append(self._on_edge)
+
+    def _on_edge(self, level, timestamp_ns):
+        with self._cond:
+            self.in_port = level == 1
+            if self.in_port:
+                self.entry_ns = timestamp_ns
+            else:
+                self.exit_ns = timestamp_ns
+                self.exits.append(timestamp_ns)
+            self._cond.notify_all()
+        for listener in self.listeners:
+            listener(level, timestamp_ns)
+
+    def wait_for_entry(self, timeout=None):
+        """Blocks until the beam is broken. Returns the entry time, or None on timeout"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.in_port, timeout):
+                return None
+            return self.entry_ns
+
+    def exit_after(self, since_ns):
+        """The first beam restore after since_ns, or None"""
+        return next((exit_ns for exit_ns in self.exits if exit_ns > since_ns), None)
+
+    def wait_for_exit(self, timeout=None, since_ns=None):
+        """
+        Blocks until the beam is restored. Returns the exit time, or None on timeout.
+        since_ns: the entry of the mouse; its exit counts even if the next mouse
+        has broken the beam again since (a trial can outlast the visit).
+        """
+        with self._cond:
+            if since_ns is not None and self.exit_after(since_ns) is not None:
+                return self.exit_after(since_ns)
+            if not self._cond.wait_for(lambda: not self.in_port, timeout):
+                return None
+            return self.exit_ns
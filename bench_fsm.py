@@ -0,0 +1,190 @@
+"""
+Benchmark of the FSM against the simulated rig (hardware.SimulatedBackend).
+Runs the real IdleState / InPortState / TrialState code with a scripted mouse
+and reports trial throughput, trial start latency and odor-onset timing error
+(actual minus planned exit-valve switch times).
+The onset error is sub-ms on average; its p99 also depends on how often the
+machine preempts the process, so the wake error of a lone thread that sleeps
+and spins to a deadline like the sequencer (no FSM running) is reported next
+to it. On a loaded single-core machine that baseline alone has a p99 of
+several ms, and only the mean onset error is sub-ms there.
+With --soak the thread count and RSS are sampled during the run, to check
+that a long session does not grow (e.g. python bench_fsm.py 10000 --soak).
+With --asyncio the FSM runs in its asyncio mode instead of the threaded one.
+The run fails (exit code 1) if a trial starts more than START_LATENCY_BUDGET_MS
+after its beam break: the scripted mice arrive right after the previous
+mouse left, so a pause or a dropped tag after a trial shows up here.
+With --imports the import-time budget of the entry points is checked too
+(import_budget.py); the exit code is 1 if it fails.
+
+usage: python bench_fsm.py [num_trials] [--soak] [--asyncio] [--imports]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import psutil
+
+import hardware
+from column_constants import ColumnNames
+from finite_state_machine import FiniteStateMachine
+from level import compile_levels
+from mouse import Mouse
+
+MOUSE_ID = "SIM0000001"
+START_LATENCY_BUDGET_MS = 100
+
+
+def make_experiment(txt_file_path):
+    """A minimal stand-in for experiment.Experiment with no GUI"""
+    levels_df = pd.DataFrame(
+        [["L1", 1, "go\\no-go", 50, 50, 1],
+         ["L1", 2, "go\\no-go", 50, 50, 2]],
+        columns=[ColumnNames.LEVEL_NAME, ColumnNames.ODOR_NUMBER, ColumnNames.VALUE,
+                 ColumnNames.P_FIRST, ColumnNames.P_SECOND, ColumnNames.INDEX])
+    exp_params = {
+        "lick_time": "1",
+        "lick_time_bin_size": None,
+        "start_trial_option": "1",
+        "start_trial_time": None,
+        "IR_no_RFID_option": "1",
+        "lick_threshold": "3",
+        "time_to_lick_after_stim": "1",
+        "open_valve_duration": "0.02",
+        "open_odor_duration": "0.1",
+        "load_odor_duration": "0.05",
+        "inter_odor_delay": "0.3",
+        "timeout_punishment": "0",
+        "ITI": "1",
+        "ITI_time": None,
+        "stimulus_length": 2,
+    }
+    return SimpleNamespace(
+        exp_params=exp_params,
+        levels_df=levels_df,
+        mice_dict={MOUSE_ID: Mouse(MOUSE_ID, "L1")},
+        GPIO_dict={1: 5, 2: 6},
+        levels=compile_levels(levels_df, {1: 5, 2: 6}),
+        trial_plans=None,
+        progress=None,
+        live_w=SimpleNamespace(activate_window=False, pause=False),
+        txt_file_path=txt_file_path,
+        upload_data=lambda: None,
+    )
+
+
+def make_visits(num_trials, seed=0):
+    rng = np.random.default_rng(seed)
+    for _ in range(num_trials):
+        # half of the visits lick enough to reach the threshold
+        if rng.random() < 0.5:
+            licks = np.sort(rng.uniform(1.3, 2.2, size=5)).tolist()
+        else:
+            licks = []
+        yield hardware.SimulatedVisit(MOUSE_ID, arrive_after=0.05, enter_after=0.02, dwell=2.5, licks=licks)
+
+
+def valve_jitter(valve_log, exit_pin, nominal_s):
+    """Returns the deviation (ms) between consecutive exit-valve openings of the same trial and the nominal gap"""
+    onsets = [t for t, gpio, level in valve_log if gpio == exit_pin and level == 1]
+    gaps = np.diff(np.array(onsets[: len(onsets) // 2 * 2]).reshape(-1, 2), axis=1).ravel() / 1e6
+    return gaps - nominal_s * 1000
+
+
+def start_latency(ir_log, valve_log):
+    """Returns the latency (ms) from every beam break to the first valve opening after it"""
+    valve_on = np.array([t for t, gpio, level in valve_log if level == 1])
+    latencies = []
+    for t, level in ir_log:
+        if level != 1:
+            continue
+        later = valve_on[valve_on >= t]
+        if later.size:
+            latencies.append((later[0] - t) / 1e6)
+    return np.array(latencies)
+
+
+def wake_error(num_deadlines=500, spin_ns=1_000_000):
+    """Returns the error (ms) of a lone thread sleeping and spinning to deadlines 2 ms apart"""
+    errors = []
+    for _ in range(num_deadlines):
+        deadline = time.monotonic_ns() + 2_000_000
+        time.sleep((2_000_000 - spin_ns) / 1e9)
+        while time.monotonic_ns() < deadline:
+            pass
+        errors.append((time.monotonic_ns() - deadline) / 1e6)
+    return np.array(errors)
+
+
+def main():
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    num_trials = int(args[0]) if args else 20
+    soak = '--soak' in sys.argv
+    mode = "asyncio" if '--asyncio' in sys.argv else "threaded"
+    process = psutil.Process(os.getpid())
+    cpu_start = process.cpu_times()
+    samples = []  # (trials done, threads, RSS MB)
+    with tempfile.TemporaryDirectory() as folder:
+        exp = make_experiment(os.path.join(folder, "bench.txt"))
+        backend = hardware.SimulatedBackend(make_visits(num_trials), realtime_audio=False)
+        start = time.perf_counter()
+        fsm = FiniteStateMachine(exp, backend=backend, mode=mode)
+        # wait for the last trial to be written and the FSM to be back in Idle
+        while not (backend.visits_done.is_set() and fsm.trial_count >= num_trials and fsm.get_state() == "Idle"):
+            time.sleep(1 if soak else 0.05)
+            if not fsm.executor.is_alive():
+                print("FSM executor died")
+                break
+            if soak:
+                samples.append((fsm.trial_count, threading.active_count(), process.memory_info().rss / 2**20))
+        elapsed = time.perf_counter() - start
+        fsm.stop()  # closes the backend too
+        rows = len(pd.read_csv(exp.txt_file_path))  # stop() syncs the trial writer
+        cpu = process.cpu_times()
+        cpu_s = (cpu.user + cpu.system) - (cpu_start.user + cpu_start.system)
+
+    params = exp.exp_params
+    nominal = float(params["open_odor_duration"]) + max(float(params["load_odor_duration"]), float(params["inter_odor_delay"]))
+    onset_error = np.array([(r.actual_ns - r.planned_ns) / 1e6 for r in fsm.switch_log
+                            if r.channel == hardware.exit_odor_valve_pin and r.level == 1])
+    jitter = valve_jitter(backend.valve_log, hardware.exit_odor_valve_pin, nominal)
+    latency = start_latency(backend.ir_log, backend.valve_log)
+    print(f"\n==== FSM benchmark (simulated rig, {mode}) ====")
+    print(f"trials:           {rows}")
+    print(f"elapsed:          {elapsed:.2f} s")
+    print(f"throughput:       {rows / elapsed * 60:.1f} trials/min")
+    print(f"CPU:              {cpu_s / elapsed * 100:.1f} % of one core (simulator included)")
+    if latency.size:
+        print(f"start latency:    mean {latency.mean():.3f} ms, max {latency.max():.3f} ms")
+    if jitter.size:
+        print(f"odor gap error:   mean {jitter.mean():.3f} ms, std {jitter.std():.3f} ms, max {jitter.max():.3f} ms")
+    if onset_error.size:
+        print(f"odor onset error: mean {onset_error.mean():.3f} ms, std {onset_error.std():.3f} ms, "
+              f"p99 {np.percentile(onset_error, 99):.3f} ms, max {onset_error.max():.3f} ms")
+        baseline = wake_error()
+        print(f"machine wake err: mean {baseline.mean():.3f} ms, p99 {np.percentile(baseline, 99):.3f} ms, "
+              f"max {baseline.max():.3f} ms (lone thread, no FSM)")
+    if samples:
+        samples = np.array(samples)
+        print(f"threads:          min {samples[:, 1].min():.0f}, max {samples[:, 1].max():.0f}")
+        print(f"RSS:              start {samples[0, 2]:.1f} MB, end {samples[-1, 2]:.1f} MB, max {samples[:, 2].max():.1f} MB")
+        print("trials   threads   RSS(MB)")
+        for row in samples[:: max(1, len(samples) // 10)]:
+            print(f"{row[0]:6.0f}   {row[1]:7.0f}   {row[2]:7.1f}")
+    code = 0
+    if latency.size < rows or latency.max() > START_LATENCY_BUDGET_MS:
+        print(f"FAIL: a trial started more than {START_LATENCY_BUDGET_MS} ms after its beam break")
+        code = 1
+    if '--imports' in sys.argv:
+        import import_budget
+        code = import_budget.main([]) or code
+    return code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
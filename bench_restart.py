@@ -0,0 +1,107 @@
+"""
+Benchmark of a supervised restart on the simulated rig.
+Runs headless.py under the supervisor (supervisor.Supervisor) with the
+"simulated_rig" param, so the FSM waits in Idle on hardware.SimulatedBackend.
+As soon as a child reports a running FSM, the supervisor is told that it
+overflowed (as if its RSS had crossed the threshold) and restarts it. The
+downtime of every restart is measured from that overflow to the first heartbeat
+of the resumed child with its FSM in Idle, ready for the next trial; the rig
+downtime (old child stopped -> new one running) is reported too.
+Exits with 1 when a restart takes longer than MAX_DOWNTIME_S.
+
+usage: python bench_restart.py [num_restarts]
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import supervisor
+
+MAX_DOWNTIME_S = 2.0
+REPO = os.path.dirname(os.path.abspath(__file__))
+
+CONFIG = {
+    "exp_name": "bench_restart",
+    "levels": "L1.csv",
+    "mice": {"SIM0000001": "L1"},
+    "params": {
+        "lick_time": "1",
+        "start_trial_option": "1",
+        "IR_no_RFID_option": "1",
+        "lick_threshold": "3",
+        "time_to_lick_after_stim": "1",
+        "open_valve_duration": "0.02",
+        "open_odor_duration": "0.1",
+        "load_odor_duration": "0.05",
+        "inter_odor_delay": "0.3",
+        "timeout_punishment": "0",
+        "ITI": "1",
+        "simulated_rig": True,
+    },
+}
+
+
+class OverflowSupervisor(supervisor.Supervisor):
+    """Reports a simulated overflow of every child as soon as its FSM is ready, num_restarts times"""
+
+    def __init__(self, config_path, num_restarts):
+        super().__init__(script=supervisor.HEADLESS_SCRIPT, args=[config_path], threshold_mb=None,
+                         max_restarts=num_restarts, startup_timeout_s=30)
+        self.num_restarts = num_restarts
+        self.overflow_at = None  # time.monotonic() of the pending overflow
+        self.ready_s = []        # overflow -> resumed FSM in Idle, per restart
+
+    def _check(self):
+        reason = super()._check()
+        child = self.child
+        if reason is not None or not child.running or child.last_heartbeat.get("state") != "Idle":
+            return reason
+        if self.overflow_at is not None:
+            self.ready_s.append(child.last_heartbeat_time - self.overflow_at)
+            self.overflow_at = None
+        if len(self.ready_s) >= self.num_restarts:
+            self.stop()
+            return None
+        self.overflow_at = time.monotonic()
+        return "simulated overflow"
+
+
+def main():
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    num_restarts = int(args[0]) if args else 3
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder:
+        # the children run in the supervisor's working directory: experiments/ and logs/ go to the temp folder
+        shutil.copy(os.path.join(REPO, "Levels", "L1.csv"), folder)
+        os.symlink(os.path.join(REPO, "stimuli"), os.path.join(folder, "stimuli"))
+        config_path = os.path.join(folder, "bench_restart.json")
+        with open(config_path, "w") as f:
+            json.dump(CONFIG, f)
+        os.chdir(folder)
+        try:
+            sup = OverflowSupervisor(config_path, num_restarts)
+            code = sup.run()
+        finally:
+            os.chdir(cwd)
+
+    ready = np.array(sup.ready_s)
+    down = np.array(sup.downtimes)
+    print("\n==== Restart benchmark (simulated rig) ====")
+    print(f"restarts:         {ready.size} of {num_restarts} (supervisor exit code {code})")
+    if ready.size:
+        print(f"overflow->ready:  mean {ready.mean():.3f} s, max {ready.max():.3f} s")
+    if down.size:
+        print(f"rig downtime:     mean {down.mean():.3f} s, max {down.max():.3f} s")
+    if ready.size < num_restarts or ready.max() > MAX_DOWNTIME_S:
+        print(f"FAIL: a restart took longer than {MAX_DOWNTIME_S} s (or did not finish)")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
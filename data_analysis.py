@@ -9,6 +9,8 @@ import numpy as np
 from scipy.ndimage import gaussian_filter1d
 from datetime import datetime
 import ast
+import os
+import trial_store
 
 def calculate_d_prime(hits, fas, misses, crs):
     hit_rate = hits / (hits + misses) if (hits + misses) > 0 else 0
@@ -266,7 +268,10 @@ class DataAnalysis:
             
         try:
             # טעינת הנתונים ויצירת הגרף
-            go_trials, nogo_trials = self.load_trials_from_csv(self.loaded_file_path, recent_data_count, selected_id)
+            if os.path.exists(trial_store.store_path(self.loaded_file_path)):
+                go_trials, nogo_trials = self.load_trials_from_store(self.loaded_file_path, recent_data_count, selected_id)
+            else:
+                go_trials, nogo_trials = self.load_trials_from_csv(self.loaded_file_path, recent_data_count, selected_id)
             
             if not go_trials and not nogo_trials:
                 messagebox.showwarning("Warning", f"No valid trial data found for Mouse ID: {selected_id}.")
@@ -298,7 +303,11 @@ class DataAnalysis:
         for _, row in df.iterrows():
             label = row["go\\no-go"].strip().lower()
             start_time_str = row["start time"]
-            licks_str = row["licks_time"]
+            # all licks of the trial (baseline, odors and response window) when the log has them
+            if "all licks time" in row and isinstance(row["all licks time"], str):
+                licks_str = row["all licks time"]
+            else:
+                licks_str = row["licks_time"]
 
             try:
                 lick_times = ast.literal_eval(licks_str)
@@ -327,6 +336,29 @@ class DataAnalysis:
 
         return go_trials, nogo_trials
 
+    def load_trials_from_store(self, txt_path, recent_data_count, selected_mouse_id):
+        """Same as load_trials_from_csv, from the binary trial store of the file (trial_store.py)"""
+        store = trial_store.load(txt_path)
+        trials = store.trials
+        rows = np.flatnonzero(np.char.strip(trials['mouse']) == selected_mouse_id)[-recent_data_count:]
+
+        go_trials = []
+        nogo_trials = []
+        for i in rows:
+            # all licks of the trial (baseline, odors and response window) when the store has them
+            licks = trial_store.licks_of(store, i, all_licks=trials['all_licks_stop'][i] > trials['all_licks_start'][i])
+            if not licks.size:
+                continue
+            rel_licks = licks / 1e6
+            rel_licks = rel_licks[(rel_licks >= 0) & (rel_licks <= TRIAL_DURATION_MS)].tolist()
+            label = trials['value'][i].strip().lower()
+            if label == "go":
+                go_trials.append(rel_licks)
+            elif label == "no-go":
+                nogo_trials.append(rel_licks)
+
+        return go_trials, nogo_trials
+
     def compute_binned_matrix(self, trials, bin_edges):
         """חישוב מטריצת bins עבור הנתונים"""
         matrix = []
@@ -0,0 +1,200 @@
+"""
+Incremental sync of an experiment folder to the lab share.
+
+sync_folder(src, dst) keeps a manifest (MANIFEST_FILE, in src) with the size,
+mtime and sha256 of every file as it was last copied to dst, and per file:
+- unchanged (same size and mtime, or same content): nothing is copied
+- grown, with the synced part unchanged (the trial log, the trial store):
+  only the new bytes are appended to the destination file
+- anything else: the file is copied to a temporary file next to the
+  destination and renamed over it, so the share never has a half-written copy
+An append is made after cutting the destination back to the synced size, so
+an interrupted append is redone by the next sync. Files deleted from src are
+left on the share.
+
+max_bytes_per_s caps the copy rate, so a sync does not saturate the network
+or the SD card while the rig is running.
+
+dst can be any folder, e.g. a local one standing in for /mnt/labfolder:
+    python data_sync.py <src folder> <dst folder>
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import time
+from collections import namedtuple
+
+MANIFEST_FILE = ".sync_manifest.json"
+REMOTE_FOLDER = "/mnt/labfolder/Noam/results"  # the lab share, mounted from /etc/fstab
+CHUNK = 1 << 20
+
+SyncReport = namedtuple("SyncReport", ["copied", "appended", "unchanged", "bytes_transferred", "elapsed_s"])
+
+logger = logging.getLogger("rig.data_sync")
+
+
+def _load_manifest(src, dst):
+    try:
+        with open(os.path.join(src, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    # entries describe what was copied to one destination
+    return manifest["files"] if manifest.get("dst") == os.path.abspath(dst) else {}
+
+
+def _save_manifest(src, dst, files):
+    path = os.path.join(src, MANIFEST_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"dst": os.path.abspath(dst), "files": files}, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def _sources(src):
+    """Relative paths of the files of src (the manifest and temporary files excluded)"""
+    for root, dirs, files in os.walk(src):
+        dirs[:] = sorted(d for d in dirs if not d.endswith(".tmp"))
+        for name in sorted(files):
+            if name == MANIFEST_FILE or name.endswith(".tmp"):
+                continue
+            yield os.path.relpath(os.path.join(root, name), src)
+
+
+def _hash_file(path, size, prefix_size=None):
+    """
+    sha256 of the first size bytes of path, in one read.
+    With prefix_size, also returns the sha256 of the first prefix_size bytes.
+    """
+    digest = hashlib.sha256()
+    prefix_digest = None
+    with open(path, "rb") as f:
+        done = 0
+        while done < size:
+            n = min(CHUNK, size - done)
+            if prefix_size is not None and done < prefix_size < done + n:
+                n = prefix_size - done
+            chunk = f.read(n)
+            if not chunk:
+                break
+            digest.update(chunk)
+            done += len(chunk)
+            if done == prefix_size:
+                prefix_digest = digest.copy().hexdigest()
+    if prefix_size == 0:
+        prefix_digest = hashlib.sha256().hexdigest()
+    return digest.hexdigest(), prefix_digest
+
+
+class RateLimiter:
+    """Sleeps as needed to keep the bytes passed to consume() under bytes_per_s (None: no limit)"""
+
+    def __init__(self, bytes_per_s=None):
+        self.bytes_per_s = bytes_per_s
+        self._start = time.monotonic()
+        self._bytes = 0
+
+    def consume(self, n):
+        if not self.bytes_per_s:
+            return
+        self._bytes += n
+        ahead = self._bytes / self.bytes_per_s - (time.monotonic() - self._start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+def _copy_range(src_path, dst_file, start, stop, limiter):
+    with open(src_path, "rb") as f:
+        f.seek(start)
+        remaining = stop - start
+        while remaining:
+            chunk = f.read(min(CHUNK, remaining))
+            if not chunk:
+                break
+            dst_file.write(chunk)
+            remaining -= len(chunk)
+            limiter.consume(len(chunk))
+    return stop - start - remaining
+
+
+def _copy_whole(src_path, dst_path, size, limiter):
+    tmp = dst_path + ".tmp"
+    with open(tmp, "wb") as f:
+        copied = _copy_range(src_path, f, 0, size, limiter)
+        f.flush()
+        os.fsync(f.fileno())
+    shutil.copystat(src_path, tmp)
+    os.replace(tmp, dst_path)
+    return copied
+
+
+def _append(src_path, dst_path, synced_size, size, limiter):
+    with open(dst_path, "r+b") as f:
+        f.truncate(synced_size)
+        f.seek(synced_size)
+        copied = _copy_range(src_path, f, synced_size, size, limiter)
+        f.flush()
+        os.fsync(f.fileno())
+    shutil.copystat(src_path, dst_path)
+    return copied
+
+
+def sync_folder(src, dst, max_bytes_per_s=None):
+    """Brings dst up to date with src, copying only what changed. Returns a SyncReport"""
+    start = time.perf_counter()
+    limiter = RateLimiter(max_bytes_per_s)
+    files = _load_manifest(src, dst)
+    copied = appended = unchanged = transferred = 0
+    for rel_path in _sources(src):
+        src_path = os.path.join(src, rel_path)
+        dst_path = os.path.join(dst, rel_path)
+        try:
+            stat = os.stat(src_path)
+        except FileNotFoundError:
+            continue  # removed while syncing
+        size = stat.st_size  # a file that grows meanwhile is synced up to here
+        entry = files.get(rel_path)
+        try:
+            dst_size = os.path.getsize(dst_path)
+        except OSError:
+            dst_size = None
+        # the destination holds at least the synced bytes (a larger one is an interrupted append)
+        dst_ok = entry is not None and dst_size is not None and dst_size >= entry["size"]
+        if dst_ok and dst_size == entry["size"] == size and entry["mtime_ns"] == stat.st_mtime_ns:
+            unchanged += 1
+            continue
+        prefix_size = entry["size"] if dst_ok and size >= entry["size"] else None
+        digest, prefix_digest = _hash_file(src_path, size, prefix_size)
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        if dst_ok and dst_size == size == entry["size"] and digest == entry["sha256"]:
+            unchanged += 1  # touched, not changed
+        elif prefix_digest is not None and prefix_digest == entry["sha256"]:
+            transferred += _append(src_path, dst_path, entry["size"], size, limiter)
+            appended += 1
+        else:
+            transferred += _copy_whole(src_path, dst_path, size, limiter)
+            copied += 1
+        files[rel_path] = {"size": size, "mtime_ns": stat.st_mtime_ns, "sha256": digest}
+        _save_manifest(src, dst, files)  # after every file: an interrupted sync keeps what it did
+    return SyncReport(copied, appended, unchanged, transferred, time.perf_counter() - start)
+
+
+def upload_to_share(src, remote_folder=REMOTE_FOLDER, max_bytes_per_s=None):
+    """Mounts the lab share and syncs src to remote_folder/<name of src>. Returns the SyncReport"""
+    subprocess.run(["sudo", "systemctl", "daemon-reload"], check=True)
+    subprocess.run(["sudo", "mount", "-a"], check=True)
+    dst = os.path.join(remote_folder, os.path.basename(src))
+    report = sync_folder(src, dst, max_bytes_per_s)
+    logger.info("data updated: %d bytes (%d copied, %d appended, %d unchanged) in %.1f s", report.bytes_transferred,
+                report.copied, report.appended, report.unchanged, report.elapsed_s)
+    return report
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python data_sync.py <src folder> <dst folder>")
+        sys.exit(1)
+    print(sync_folder(sys.argv[1], sys.argv[2]))
@@ -1,9 +1,9 @@
 import json
 from typing import List, Dict, Any
 import trial
-from level import Level
+from level import Level, compile_levels
 from mouse import Mouse
-#from finite_state_machine import FiniteStateMachine
+from finite_state_machine import FiniteStateMachine
 import tkinter as tk
 from tkinter import simpledialog
 import threading
@@ -14,10 +14,16 @@ import tkinter as tk
 from tkinter import messagebox, filedialog
 from datetime import datetime
 import state_io
+import hardware
 import memory_monitor
-import time
-import subprocess
-import shutil
+import data_sync
+import uploader
+import supervisor
+import signal
+import logging
+import rig_logging
+
+logger = logging.getLogger("rig.experiment")
 
 
 ###  use those commands on terminal to push changes to git
@@ -30,16 +36,20 @@ import shutil
 
 ###
 class Experiment:
-    def __init__(self, exp_name, mice_dict: dict[str, Mouse] = None, levels_df = None, exp_params = None, auto_start = False, user_email = None):
+    def __init__(self, exp_name, mice_dict: dict[str, Mouse] = None, levels_df = None, exp_params = None, auto_start = False, user_email = None, progress = None):
         """
         Creating a new experiment
         auto_start: if True, the experiment will start automatically if parameters are available
+        progress: the state_io.Progress of a restarted session (trials done, planned trials, RNG state)
         """
         
         self.exp_params = exp_params
         self.fsm = None
         self.live_w = None
         self.levels_df = levels_df
+        self.levels = None  # level.CompiledLevel per level name, compiled from levels_df and GPIO_dict
+        self.progress = progress
+        self.trial_plans = progress.trial_plans if progress is not None else None
         self.mice_dict = mice_dict
         self.results = []
         self.stim_length = 2
@@ -53,17 +63,13 @@ class Experiment:
             self.user_email = user_email
         # Creating experiment folder
         self.new_txt_file(self.txt_file_name)
-        self.remote_folder = "/mnt/labfolder/Noam/results"
-        self.GPIO_dict = {
-                1: 5,
-                2: 6,
-                3: 13,
-                4: 19,
-                5: 26,
-                6: 21,
-                7: 20,
-                8: 16
-            }
+        self.remote_folder = data_sync.REMOTE_FOLDER
+        # Uploads run on their own thread; the FSM only reports changes through upload_data()
+        self.uploader = uploader.Uploader(self.upload_folder, max_bytes_per_s=uploader.UPLOAD_MAX_BYTES_PER_S)
+        self.uploader.listeners.append(self.show_upload_status)
+        self.GPIO_dict = dict(hardware.odor_gpios)
+        if self.levels_df is not None:
+            self.compile_levels()
         self.root = tk.Tk()
         self.GUI = GUI_sections.TkinterApp(self.root, self, exp_name = self.txt_file_name)
         
@@ -76,23 +82,38 @@ class Experiment:
         self.memory_monitor = memory_monitor.MemoryMonitor(self, threshold_mb=450)
         self.memory_monitor.start_monitoring()
         
+        # A SIGTERM (from the supervisor or the memory monitor) ends the experiment like the End button
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda *args: self.root.quit())
+        if supervisor.supervised():
+            self.root.after(0, self.send_heartbeat)
+
         # Starting the experiment
         self.run_experiment()
         self.root.mainloop()
+        if self.fsm is not None:
+            self.fsm.stop()
+        self.uploader.stop()
         self.root.destroy()
 
     def set_parameters(self, parameters):
         """This method is called by App when the OK button is pressed."""
         self.exp_params = parameters
-        print("\nParameters set in Experiment:\n", self.exp_params,"\n")
+        logger.info("Parameters set in Experiment: %s", self.exp_params)
 
     def set_mice_dict(self, mice_dict):
         """This method is called by App when the OK button is pressed."""
         self.mice_dict = mice_dict
 
     def set_levels_df(self, levels_df):
-        """This method is called by App when the OK button is pressed."""
+        """This method is called by App when the OK button is pressed. Raises ValueError for invalid levels"""
         self.levels_df = levels_df
+        self.compile_levels()
+        self.trial_plans = None  # planned for the old levels
+
+    def compile_levels(self):
+        """Compiles levels_df with the current GPIO_dict for the trials (level.compile_levels)"""
+        self.levels = compile_levels(self.levels_df, self.GPIO_dict)
         
 
     def new_txt_file(self, filename):
@@ -107,22 +128,24 @@ class Experiment:
             with open(self.txt_file_path, 'w') as file:
                 pass
 
-    def save_minimal_state(self):
+    def save_checkpoint(self):
         """
-        Saving the minimal state of the experiment
+        Saves the session setup to the checkpoint (state_io); the progress is saved by the FSM after every trial
         """
         if self.exp_params and self.levels_df is not None and self.mice_dict:
-            state_io.save_minimal_state(
-                self.txt_file_name,
-                self.exp_params,
-                self.levels_df,
-                self.mice_dict,
-                self.txt_file_name,
-                self.txt_file_path,
-                self.user_email
-            )
+            try:
+                path = state_io.save_session(self.txt_file_name, self.exp_params, self.levels_df, self.mice_dict,
+                                             self.txt_file_name, self.txt_file_path, self.user_email)
+                logger.info("State saved to: %s", path)
+            except (OSError, TypeError, ValueError) as e:
+                logger.error("Error saving state: %s", e)
         else:
-            print("Cannot save state - missing required data")
+            logger.warning("Cannot save state - missing required data")
+
+    def send_heartbeat(self):
+        """Tells the supervisor every second that the main loop runs, and where the FSM is"""
+        supervisor.send_heartbeat(self)
+        self.root.after(1000, self.send_heartbeat)
 
     def get_memory_status(self):
         """Returning the current memory status"""
@@ -145,6 +168,9 @@ class Experiment:
         if self.exp_params is None and not self.auto_start:
             self.root.after(100, lambda: self.run_experiment())  # Check again after 100ms
         else:
+            # If this is auto-start, open the live window here, on the Tk main thread, before the FSM that updates it
+            if self.auto_start:
+                self.open_live_window()
             # Continue with the experiment once parameters are set
             # Start experiment in a separate thread to keep the GUI responsive
             threading.Thread(target=self.start_experiment, daemon=True).start()
@@ -152,29 +178,21 @@ class Experiment:
     def start_experiment(self):
         # This method runs the actual experiment (on a separate thread)
         try:
-            # If this is auto-start, open the live window
-            if self.auto_start:
-                self.root.after(200, self.run_live_window)
-                
-            # Create FSM only after live_w is created
-            if self.auto_start and (self.live_w is None):
-                print("[DEBUG] WARNING: LiveWindow not available, waiting...")
-                # Additional wait and another attempt
-                time.sleep(1)
-                self.open_live_window()
-                
             if self.auto_start and (self.live_w is None):
-                print("[DEBUG] ERROR: Failed to create LiveWindow, cannot continue")
+                logger.error("Failed to create LiveWindow, cannot continue")
                 return
                 
             fsm = FiniteStateMachine(self)
             self.fsm = fsm
-            print("FSM created: The experiment has begun.")
+            if self.live_w is not None:
+                self.live_w.profile_listeners.append(fsm.profiler.set_profiling)
+                fsm.profiler.listeners.append(self.live_w.update_profiling)
+            # the supervisor counts a restart as done from the first heartbeat of a running FSM: send it now
+            supervisor.send_heartbeat(self)
+            logger.info("FSM created: The experiment has begun.")
             
-        except Exception as e:
-            print(f"[DEBUG] Error in start_experiment: {e}")
-            import traceback
-            traceback.print_exc()
+        except Exception:
+            logger.exception("Error in start_experiment")
 
     def run_live_window(self):
         self.root.after(0, self.open_live_window)
@@ -183,18 +201,16 @@ class Experiment:
         if self.live_w is None:
             try:
                 self.live_w = live_window.LiveWindow()
-                print("LiveWindow created successfully")
-                # Short wait to ensure the window is created successfully
-                time.sleep(0.5)
+                logger.info("LiveWindow created successfully")
             except Exception as e:
-                print(f"[DEBUG] Error creating LiveWindow: {e}")
+                logger.error("Error creating LiveWindow: %s", e)
                 self.live_w = None
 #         else:
 #             print("[DEBUG] LiveWindow already exists")
         
         # Check that live_w was indeed created
         if self.live_w is None:
-            print("[DEBUG] WARNING: LiveWindow creation failed!")
+            logger.warning("LiveWindow creation failed!")
 
     def change_mouse_level(self, mouse: Mouse, new_level: Level):
         mouse.update_level(new_level)
@@ -214,8 +230,14 @@ class Experiment:
                     messagebox.showerror("Input Error", f"GPIO value at row {index} must be a number.")
                     return
                 temp_dict[index] = int(gpio_val)
+            if self.levels_df is not None:
+                try:
+                    self.levels = compile_levels(self.levels_df, temp_dict)
+                except ValueError as e:
+                    messagebox.showerror("Input Error", str(e))
+                    return
             self.GPIO_dict = temp_dict
-            print(self.GPIO_dict)
+            logger.info("GPIO dict: %s", self.GPIO_dict)
             top.destroy()
 
         def add_row():
@@ -261,22 +283,36 @@ class Experiment:
         save_btn.pack(pady=5)
             
     def upload_data(self):
-        subprocess.run(["sudo", "systemctl", "daemon-reload"], check=True)
-        subprocess.run(["sudo", "mount", "-a"], check=True)
-        src = self.exp_folder_path
-        dst = os.path.join(self.remote_folder, os.path.basename(src))
-        shutil.copytree(src, dst, dirs_exist_ok=True)
-        print("data updated")
+        """Marks the experiment folder for the uploader (returns at once)"""
+        self.uploader.mark_dirty(self.exp_folder_path)
+
+    def upload_folder(self, src, max_bytes_per_s=None):
+        """Runs on the uploader thread"""
+        if self.fsm is not None and src == self.exp_folder_path:
+            self.fsm.trial_writer.flush(timeout=5)  # copy the trials written so far
+        return data_sync.upload_to_share(src, self.remote_folder, max_bytes_per_s)
+
+    def show_upload_status(self, status):
+        if self.live_w is not None and self.live_w.activate_window:
+            self.live_w.update_upload(uploader.format_status(status))
 
 if __name__ == "__main__":
     import sys
+    rig_logging.setup_logging()
     
     # Check if this is a restart
     restart_mode = False
     restart_exp_name = None
     
     # Check command line arguments
-    if len(sys.argv) > 1 and sys.argv[1] == "--restart":
+    if len(sys.argv) > 1 and sys.argv[1] == "--standby":
+        # started by the supervisor ahead of a restart: everything is imported, wait for the session to resume
+        supervisor.notify("ready")
+        restart_exp_name = sys.stdin.readline().strip()
+        restart_mode = bool(restart_exp_name)
+        if not restart_mode:
+            sys.exit(0)
+    elif len(sys.argv) > 1 and sys.argv[1] == "--restart":
         if len(sys.argv) > 2:
             restart_exp_name = sys.argv[2]
             restart_mode = True
@@ -286,24 +322,30 @@ if __name__ == "__main__":
     
     # If this is a restart, try to load the state
     if restart_mode and restart_exp_name:
-        print(f"Attempting to restart experiment: {restart_exp_name}")
+        logger.info("Attempting to restart experiment: %s", restart_exp_name)
         
         # Loading the state
-        state_data = state_io.load_minimal_state(restart_exp_name)
+        try:
+            state = state_io.load_state(restart_exp_name)
+        except (OSError, ValueError, KeyError) as e:
+            logger.error("Error loading state: %s", e)
+            state = None
         
-        if state_data:
-            print("State loaded successfully, starting experiment...")
+        if state:
+            logger.info("State loaded successfully (%s trials done), starting experiment...",
+                        state.progress.trial_count if state.progress else 0)
             # Creating the experiment with loaded parameters
             experiment = Experiment(
                 exp_name=restart_exp_name,
-                mice_dict=state_data['mice_dict'],
-                levels_df=state_data['levels_df'],
-                exp_params=state_data['exp_params'],
+                mice_dict=state.mice_dict,
+                levels_df=state.levels_df,
+                exp_params=state.exp_params,
                 auto_start=True,
-                user_email=state_data['user_email']
+                user_email=state.user_email,
+                progress=state.progress
             )
         else:
-            print(f"Failed to load state for {restart_exp_name}")
+            logger.error("Failed to load state for %s", restart_exp_name)
             sys.exit(1)
     else:
         # Normal startup - creating a new experiment folder
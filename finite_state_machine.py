@@ -1,381 +1,357 @@
 import os
-import serial
 import time
-import lgpio
+import queue
 import threading
+from collections import deque, namedtuple
 from trial import Trial
-from datetime import datetime
-import numpy as np
-import sounddevice as sd
-import psutil
+from trial_planner import TrialPlanner
+from trial_writer import TrialWriter
+import trial_store
+from input_sampler import InputSampler
+from lick_capture import LickCapture
+from beam_monitor import BeamMonitor
+from session_clock import SessionClock
+from metrics_sampler import MetricsSampler, metrics_path
+import profiler
+import state_io
+from audio_engine import AudioEngine, PUNISHMENT_SOUNDS
+import rfid_reader
+from valve_timeline import ValvePulse, ValveSequencer, odor_timeline, compile_timeline
 import gc
-import tracemalloc
-import objgraph
 import logging
-import pandas as pd
-import shutil
-import glob
+import rig_logging
+import hardware
+from hardware import valve_pin, exit_odor_valve_pin
 
-audio_lock = threading.Lock()
-valve_pin = 4 
-IR_pin = 27  
-lick_pin = 17  
-exit_odor_valve_pin = 21
+# ser = serial.Serial(port='/dev/ttyUSB0', baudrate=9600,
+#                     timeout=0.01)  # timeo1  # Change '/dev/ttyS0' to the detected port
 
-# lgpio setup
-h = lgpio.gpiochip_open(0)
-lgpio.gpio_claim_output(h, valve_pin, 0)
-lgpio.gpio_claim_input(h, IR_pin)
-lgpio.gpio_claim_input(h, lick_pin)
-lgpio.gpio_claim_output(h, exit_odor_valve_pin, 0)
+logger = logging.getLogger("rig.fsm")
 
-ports = glob.glob('/dev/ttyUSB*')
-if not ports:
-    raise Exception("No USB serial device found!")
+STOP_TIMEOUT_S = 5  # longest wait in stop() for the executor to leave its state
+STOP_POLL_S = 0.2   # the beam waits check fsm.stopped this often (a mouse can stay in the port for long)
 
-port = ports[0] 
-ser = serial.Serial(port=port, baudrate=9600, timeout=0.01)
-print(f"Connected to {port}")
+def debug_serial_data(data):
+    """Log exact raw content of the serial input (including hidden chars)."""
+    logger.debug("[SERIAL RAW] %r", data)
 
+# ---- waits ----
+# The run() of a state is a generator: it yields what it waits for and is sent the result.
+# The waiting is done by the runtime of the FSM mode: ThreadedWaits blocks the executor
+# thread, async_runtime.AsyncRigRuntime awaits the same waits on its loop.
+Sleep = namedtuple("Sleep", ["seconds"])                          # -> None
+NextTag = namedtuple("NextTag", ["timeout"])                      # -> rfid_reader.TagEvent, or None (timeout, stop())
+BeamEdge = namedtuple("BeamEdge", ["level", "timeout", "since_ns"])  # -> the edge time, or None on timeout
+RunValves = namedtuple("RunValves", ["switches", "on_switch"])    # -> a SwitchRecord per compiled switch
+NewLicks = namedtuple("NewLicks", ["deadline_ns"])                # -> lick times since the last call ([] at the deadline)
+PlaybackStart = namedtuple("PlaybackStart", ["playback", "timeout"])  # -> True once the sound started
 
-# ser = serial.Serial(port='/dev/ttyUSB0', baudrate=9600,
-#                     timeout=0.01)  # timeo1  # Change '/dev/ttyS0' to the detected port
 
-LOG_FILE = "debug_log.txt"
-memory_log_file = "memory_debug_log.txt"
-
-process = psutil.Process(os.getpid())
-tracemalloc.start()
-
-def log_open_files_count():
-    process = psutil.Process(os.getpid())
-    open_files = process.open_files()
-    num_open_files = len(open_files)
-    file_logger.info(f"Open file descriptors: {num_open_files}")
-    
-def log_memory_usage_snap(trial_number=None):
-    with open(memory_log_file, "a") as f:
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        header = f"\n--- Memory snapshot at {now} ---"
-        if trial_number is not None:
-            header += f" (After trial {trial_number})"
-        f.write(header + "\n")
-
-        # tracemalloc - מצב זיכרון לפי קוד
-        snapshot = tracemalloc.take_snapshot()
-        top_stats = snapshot.statistics('lineno')
-        f.write("Top 10 memory allocations by line:\n")
-        for stat in top_stats[:10]:
-            f.write(str(stat) + "\n")
-
-        # objgraph - סוגי האובייקטים הכי נפוצים
-        f.write("\nTop 10 most common object types:\n")
-        common_types = objgraph.most_common_types(limit=10)
-        for obj_type, count in common_types:
-            f.write(f"{obj_type}: {count}\n")
-
-        # ספירת אובייקטים מסוג Trial (דוגמה)
-        count_trial = objgraph.count('Trial')
-        f.write(f"\nCount of 'Trial' objects: {count_trial}\n")
-
-        f.write("--- End of snapshot ---\n")
-
-def log_message(message: str):
-    """Write message to log file with timestamp."""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(LOG_FILE, "a", encoding="utf-8") as f:
-        f.write(f"[{timestamp}] {message}\n")
-
-def log_memory_usage(tag=""):
-    """Log current memory usage in MB."""
-    mem = process.memory_info().rss / (1024 * 1024)  # in MB
-    log_message(f"[MEM] {tag} Memory usage: {mem:.2f} MB")
-
-def log_thread_count(tag=""):
-    """Log number of active threads."""
-    log_message(f"[THREADS] {tag} Active threads: {len(threading.enumerate())}")
+class ThreadedWaits:
+    """The waits of the states in the threaded mode: the executor thread blocks on threading primitives"""
+
+    def __init__(self, fsm):
+        self.fsm = fsm
+        self._woken = threading.Event()  # set by wake(): the sleeps end at once
+        self.handlers = {Sleep: self.sleep, NextTag: self.next_tag, BeamEdge: self.beam_edge,
+                         RunValves: self.run_valves, NewLicks: self.new_licks, PlaybackStart: self.playback_start}
+
+    def run(self, steps):
+        """Runs the run() generator of a state to its end. Returns its event"""
+        result = None
+        while True:
+            try:
+                wait = steps.send(result)
+            except StopIteration as stop:
+                return stop.value
+            result = self.handlers[type(wait)](*wait)
+
+    def wake(self):
+        """Wakes the Idle wait and the sleeps so that the executor sees fsm.stopped (from any thread)"""
+        self._woken.set()
+        try:
+            self.fsm.tags.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def sleep(self, seconds):
+        self._woken.wait(seconds)
+
+    def next_tag(self, timeout):
+        try:
+            return self.fsm.tags.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def beam_edge(self, level, timeout, since_ns):
+        if level:
+            return self.fsm.beam.wait_for_entry(timeout)
+        return self.fsm.beam.wait_for_exit(timeout, since_ns)
+
+    def run_valves(self, switches, on_switch):
+        return self.fsm.valve_sequencer.run(switches, on_switch)
+
+    def new_licks(self, deadline_ns):
+        licks = self.fsm.lick_capture.pop_all()
+        remaining = (deadline_ns - time.monotonic_ns()) / 1e9
+        if not licks and remaining > 0:
+            self.fsm.lick_capture.wait(remaining)
+            licks = self.fsm.lick_capture.pop_all()
+        return licks
+
+    def playback_start(self, playback, timeout):
+        return playback.started.wait(timeout)
 
-def debug_serial_data(data):
-    """Log exact raw content of the serial input (including hidden chars)."""
-    log_message(f"[SERIAL RAW] {repr(data)}")
 
 class State:
+    """
+    A state of the FSM. States are created once and reused: the FSM executor
+    calls enter() every time the state becomes active and then runs run(), a
+    generator of waits (see above) that returns the event for the transition table.
+    """
     def __init__(self, name, fsm):
         self.name = name
         self.fsm = fsm
-        if self.fsm.exp.live_w.activate_window:
-            self.fsm.exp.live_w.deactivate_states_indicators(name)
 
-    def on_event(self, event):
-        pass
+    def enter(self):
+        if self.fsm.exp.live_w.activate_window:
+            self.fsm.exp.live_w.deactivate_states_indicators(self.name)
+
+    def run(self):
+        raise NotImplementedError
+
+    def wait_for_beam(self, level, timeout=None, since_ns=None):
+        """
+        BeamEdge in slices of STOP_POLL_S, so that stop() does not wait for the mouse.
+        Returns the edge time, or None on timeout or stop()
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.fsm.stopped:
+            remaining = STOP_POLL_S if deadline is None else min(STOP_POLL_S, deadline - time.monotonic())
+            if remaining <= 0:
+                return None
+            edge_ns = yield BeamEdge(level, remaining, since_ns)
+            if edge_ns is not None:
+                return edge_ns
+        return None
 
 
 class IdleState(State):
     def __init__(self, fsm):
         super().__init__("Idle", fsm)
-        ser.flushInput()  # clear the data from the serial
+        self.tags = fsm.tags  # rfid_reader.TagEvent of every mouse at the antenna
+        self.tags_since_ns = 0  # tags read before this time.monotonic_ns() are stale
+        self.pending_tag = None  # a tag read during the pause after the last trial (TrialState.finish_trial)
+
+    def enter(self):
+        super().enter()
+        # The tags read before the last mouse left are stale. A tag read after it (during the
+        # wait after the exit or the ITI, or of a mouse already in the port) is read once and must count.
+        self.tags_since_ns = self.fsm.beam.exit_ns or 0
         self.fsm.current_trial.clear_trial()
+        rig_logging.clear_context("trial", "mouse", "level", "value")
         if self.fsm.exp.live_w.activate_window:
             self.fsm.exp.live_w.update_last_rfid('')
             self.fsm.exp.live_w.update_level('')
             self.fsm.exp.live_w.update_score('')
             self.fsm.exp.live_w.update_trial_value('')
 
-        log_memory_usage("Enter Idle")
-
-        threading.Thread(target=self.wait_for_event, daemon=True).start()
-
-    def wait_for_event(self):
+    def run(self):
         minutes_passed = 0
-        last_log_time = time.time()
+        next_log = time.monotonic() + 60
 
-        while True:
+        while not self.fsm.stopped:
+            if self.pending_tag is not None:
+                tag_event, self.pending_tag = self.pending_tag, None
+            else:
+                tag_event = yield NextTag(max(0.0, next_log - time.monotonic()))
 
-            if time.time() - last_log_time > 60:
+            if time.monotonic() >= next_log:
                 minutes_passed += 1
-                last_log_time = time.time()
-                print(f"[IdleState] Waiting for RFID... {minutes_passed} minutes passed")
-
-                if minutes_passed % 30 == 0: 
-                    try:
-                        self.fsm.exp.upload_data()
-
-                    except PermissionError:
-                        print("PermissionError")
-                    except FileNotFoundError:
-                        print("FileNotFoundError")
-                    except Exception as e:
-                        print(f"Exception: {e}")
-                 
-                if minutes_passed % 5 == 0:
-                    log_memory_usage("IdleState periodic check")
-                    #log_thread_count("IdleState periodic check")
-                #if minutes_passed % 10 == 0:
-                    #log_memory_usage_snap()
-                    #log_open_files_count()
-
-            if ser.in_waiting > 0 and not self.fsm.exp.live_w.pause:
-                try:
-                    raw_data = ser.readline()
-                    mouse_id = raw_data.decode('utf-8').rstrip()
-                except Exception as e:
-                    print(f"[IdleState] Error reading RFID: {e}")
-                    continue
+                next_log += 60
+                logger.info("[IdleState] Waiting for RFID... %d minutes passed", minutes_passed)
 
+            if tag_event is not None and self.is_new_tag(tag_event) and not self.fsm.exp.live_w.pause:
+                mouse_id = tag_event.tag
                 if self.recognize_mouse(mouse_id):
                     self.fsm.current_trial.update_current_mouse(self.fsm.exp.mice_dict[mouse_id])
-                    print("\nmouse: " + self.fsm.exp.mice_dict[mouse_id].get_id())
-                    print("Level: " + self.fsm.exp.mice_dict[mouse_id].get_level())
-                    
-
-                    if hasattr(self.fsm.exp, 'live_w') and self.fsm.exp.live_w is not None:
-                        try:
-                            if self.fsm.exp.live_w.activate_window:
-                                self.fsm.exp.live_w.update_last_rfid(mouse_id)
-                                self.fsm.exp.live_w.update_level(self.fsm.exp.mice_dict[mouse_id].get_level())
-                        except Exception as e:
-                            print(f"[IdleState] Warning: Could not update GUI: {e}")
-                    
-                    self.on_event('in_port')
-                    break
-            else:
-                #ser.flushInput()
-                time.sleep(0.05)
+                    logger.info("mouse: %s, level: %s", mouse_id, self.fsm.exp.mice_dict[mouse_id].get_level())
 
-    def on_event(self, event):
-        if event == 'in_port':
-            print("Transitioning from Idle to in_port")
-            self.fsm.state = InPortState(self.fsm)
+                    if self.fsm.exp.live_w.activate_window:
+                        self.fsm.exp.live_w.update_last_rfid(mouse_id)
+                        self.fsm.exp.live_w.update_level(self.fsm.exp.mice_dict[mouse_id].get_level())
+
+                    return 'in_port'
+
+    def is_new_tag(self, tag_event):
+        return tag_event.timestamp_ns >= self.tags_since_ns
 
     def recognize_mouse(self, data: str):
         if data in self.fsm.exp.mice_dict:
             return True
         else:
-            print("mouse ID: '" + data + "' does not exist in the mouse dictionary.")
+            logger.warning("mouse ID: '%s' does not exist in the mouse dictionary.", data)
             return False
 
 
 class InPortState(State):
     def __init__(self, fsm):
         super().__init__("port", fsm)
-        threading.Thread(target=self.wait_for_event, daemon=True).start()
 
-    def wait_for_event(self):
+    def run(self):
         timeout_seconds = 15  # timeout
-        start_time = time.time()
 
-        while lgpio.gpio_read(h, IR_pin) != 1:
-            if time.time() - start_time > timeout_seconds:
-                print("Timeout in InPortState: returning to IdleState")
-                self.on_event("timeout")
-                return
-            time.sleep(0.09)
+        entry_ns = yield from self.wait_for_beam(1, timeout_seconds)
+        if entry_ns is None and not self.fsm.beam.in_port:
+            logger.info("Timeout in InPortState: returning to IdleState")
+            return 'timeout'
+        self.fsm.current_trial.set_entry_time(entry_ns)
 
         if self.fsm.exp.live_w.activate_window:
-            self.fsm.exp.live_w.toggle_indicator("IR", "on")
-            time.sleep(0.1)
-            self.fsm.exp.live_w.toggle_indicator("IR", "off")
-        else:
-            time.sleep(0.1)
-        print("The mouse entered!")
+            self.fsm.exp.live_w.blink("IR", 0.1)
+        logger.info("The mouse entered!")
 
         if self.fsm.exp.exp_params["start_trial_time"] is not None:
-            time.sleep(int(self.fsm.exp.exp_params["start_trial_time"]))
-            print("Sleep before start trial")
+            yield Sleep(int(self.fsm.exp.exp_params["start_trial_time"]))
+            logger.info("Sleep before start trial")
 
-        self.on_event('IR_stim')
-
-    def on_event(self, event):
-        if event == 'IR_stim':
-            print("Transitioning from InPort to Trial")
-            self.fsm.state = TrialState(self.fsm)
-        elif event == 'timeout':
-            print("Transitioning from InPort to Idle due to timeout")
-            self.fsm.state = IdleState(self.fsm)
+        return 'IR_stim'
 
 
 class TrialState(State):
+    baseline_s = 2.0  # lick/IR edges saved with the trial start this long before the trial
+
     def __init__(self, fsm):
         super().__init__("trial", fsm)
-        log_memory_usage("Enter Trial")
         self.got_response = None
-        self.stop_threads = False
-        self.trial_thread = threading.Thread(target=self.run_trial)
-        self.trial_thread.start()
+
+    def enter(self):
+        super().enter()
+        self.got_response = None
+
+    def run(self):
+        yield from self.run_trial()
+        yield from self.finish_trial()
+        return 'trial_over'
 
     def run_trial(self):
-        self.fsm.current_trial.start_time = datetime.now().strftime('%H:%M:%S.%f')  # Get current time
+        self.fsm.current_trial.mark_start()
         self.fsm.current_trial.calculate_stim()
+        trial = self.fsm.current_trial
+        rig_logging.set_context(trial=self.fsm.trial_count + 1, mouse=trial.current_mouse.id,
+                                level=trial.current_mouse.level, value=trial.current_value)
         if self.fsm.exp.live_w.activate_window:
             self.fsm.exp.live_w.update_trial_value(self.fsm.current_trial.current_value)
 
         # Run odor stimulation first, then receive input
-        self.odor_stim()
-        self.receive_input()
+        yield from self.odor_stim()
+        yield from self.receive_input()
         if self.fsm.current_trial.score is None:
             self.fsm.current_trial.score = self.evaluate_response()
-            print("score: " + self.fsm.current_trial.score)
+            logger.info("score: %s", self.fsm.current_trial.score)
             if self.fsm.exp.live_w.activate_window:
                 self.fsm.exp.live_w.update_score(self.fsm.current_trial.score)
 
             if self.fsm.current_trial.score == 'hit':
-                self.give_reward()
+                yield from self.give_reward()
             elif self.fsm.current_trial.score == 'fa':
-                self.give_punishment()
+                yield from self.give_punishment()
         
-        log_memory_usage("After Trial")
-        self.on_event('trial_over')
+        self.fsm.trial_count += 1
         
     def odor_stim(self):
-        first_stim_number = self.fsm.current_trial.first_stim_number
-        first_odor_gpio = self.fsm.exp.GPIO_dict[first_stim_number]
-        second_stim_number = self.fsm.current_trial.second_stim_number
-        second_odor_gpio = self.fsm.exp.GPIO_dict[second_stim_number]
-        stim_duration = float(self.fsm.exp.exp_params["open_odor_duration"])
-        
-        try:
-            # First odor preparation
-            self.valve_on(first_odor_gpio)
-            time.sleep(float(self.fsm.exp.exp_params["load_odor_duration"]))
-            
-            """first odor stim"""
-            if self.fsm.exp.live_w.activate_window:
-                self.fsm.exp.live_w.toggle_indicator("stim", "on")
-            self.valve_on(exit_odor_valve_pin)
-            time.sleep(stim_duration)
-            self.valve_off(exit_odor_valve_pin)
-            self.valve_off(first_odor_gpio)
-            if self.fsm.exp.live_w.activate_window:
-                self.fsm.exp.live_w.toggle_indicator("stim", "off")
-                
-            """then sleep between two odors"""
-            self.valve_on(second_odor_gpio)
-            load_odor_duration = float(self.fsm.exp.exp_params["load_odor_duration"])
-            inter_odor_delay = 1.0
-            inter_delay = max(load_odor_duration, inter_odor_delay)
-            if load_odor_duration > inter_odor_delay:
-                print("[WARNING] The inter-odor delay is shorter than the odor load duration. The wait time between odors is increased due to the load time.")
-            time.sleep(inter_delay)
-                
-            """second odor stim"""
-            if self.fsm.exp.live_w.activate_window:
-                self.fsm.exp.live_w.toggle_indicator("stim", "on")
-            self.valve_on(exit_odor_valve_pin)
-            time.sleep(stim_duration)
-            
-        finally:
-            self.valve_off(exit_odor_valve_pin)
-            #self.valve_off(first_odor_gpio)
-            self.valve_off(second_odor_gpio)
-            if self.fsm.exp.live_w.activate_window:
-                self.fsm.exp.live_w.toggle_indicator("stim", "off")
-        
-        print("Odors completed.")
-            
+        params = self.fsm.exp.exp_params
+        first_odor_gpio = self.fsm.current_trial.first_stim_gpio
+        second_odor_gpio = self.fsm.current_trial.second_stim_gpio
+        pulses = odor_timeline(first_odor_gpio, second_odor_gpio, exit_odor_valve_pin,
+                               load_duration=float(params["load_odor_duration"]),
+                               stim_duration=float(params["open_odor_duration"]),
+                               inter_odor_delay=float(params.get("inter_odor_delay", 1.0)))
+        on_switch = self.show_stim if self.fsm.exp.live_w.activate_window else None
+        records = yield RunValves(compile_timeline(pulses), on_switch)
+
+        for record in records:
+            self.fsm.current_trial.add_valve_event(record.channel, record.level, monotonic_ns=record.actual_ns)
+            self.fsm.switch_log.append(record)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Odors completed. gpio switches: %s", ", ".join(f"{r.channel}:{r.level}" for r in records))
+
+    def show_stim(self, channel, level):
+        if channel == exit_odor_valve_pin:
+            self.fsm.exp.live_w.toggle_indicator("stim", "on" if level else "off")
 
     def receive_input(self):
         if self.fsm.exp.exp_params["lick_time_bin_size"] is not None: # By time
-            time.sleep(int(self.fsm.exp.exp_params["lick_time_bin_size"]))
+            yield Sleep(int(self.fsm.exp.exp_params["lick_time_bin_size"]))
         elif self.fsm.exp.exp_params["lick_time"] == "1": # After stim
             pass
 
         counter = 0
         self.got_response = False
-        previous_lick_state = 0  # Track previous state for edge detection (0 = LOW)
-        print('waiting for licks...')
+        logger.debug('waiting for licks...')
         
         # Use only the post-stimulus time for lick detection
         response_time = int(self.fsm.exp.exp_params["time_to_lick_after_stim"])
         
-        start_time = time.time()
+        # Licks are captured on their rising edge by the lick alerts - drop the ones from before the window
+        self.fsm.lick_capture.clear()
+        deadline_ns = time.monotonic_ns() + int(response_time * 1e9)
         
-        while (time.time() - start_time) < response_time:
-            current_lick_state = lgpio.gpio_read(h, lick_pin)
-            # Only count lick on transition from LOW to HIGH (rising edge)
-            if current_lick_state == 1 and previous_lick_state == 0:  # 1 == HIGH, 0 == LOW
+        while not self.got_response:
+            licks = yield NewLicks(deadline_ns)
+            if not licks and time.monotonic_ns() >= deadline_ns:
+                break
+            for lick_ns in licks:
+                if lick_ns > deadline_ns:
+                    break
                 if self.fsm.exp.live_w.activate_window:
-                    self.fsm.exp.live_w.toggle_indicator("lick", "on")
-                    time.sleep(0.08) #wait for the lick to be visible on the indicator
-                self.fsm.current_trial.add_lick_time()
+                    self.fsm.exp.live_w.blink("lick")  # the live window keeps it visible, no wait here
+                self.fsm.current_trial.add_lick_time(lick_ns)
                 counter += 1
-                
-                if self.fsm.exp.live_w.activate_window:
-                    self.fsm.exp.live_w.toggle_indicator("lick", "off")
-                print("lick detected")
+                logger.debug("lick detected")
 
-                if counter >= int(self.fsm.exp.exp_params["lick_threshold"]) and not self.got_response:
+                if counter >= int(self.fsm.exp.exp_params["lick_threshold"]):
                     self.got_response = True
-                    print('threshold reached')
+                    logger.info('threshold reached')
                     break
-            
-            # Update previous state for next iteration
-            previous_lick_state = current_lick_state
-            time.sleep(0.08)
 
         if not self.got_response:
-            print('no response')
-        print('num of licks: ' + str(counter))
+            logger.info('no response')
+        logger.info('num of licks: %d', counter)
 
     def give_reward(self):
-        self.valve_on(valve_pin)
-        time.sleep(float(self.fsm.exp.exp_params["open_valve_duration"]))
-        self.valve_off(valve_pin)
-
-    def valve_on(self, gpio_number):
-        print("gpio_number: "+str(gpio_number))
-        lgpio.gpio_write(h, gpio_number, 1)
-        
-    def valve_off(self, gpio_number):
-        lgpio.gpio_write(h, gpio_number, 0)
-
-    def give_punishment(self):  # after changing to .npz
-        with audio_lock:
-            sd.stop()
-            try:
-                sd.play(self.fsm.noise, samplerate=self.fsm.noise_Fs, blocking=True)  #sd.wait(
-            finally:
-                sd.stop()
-                time.sleep(float(self.fsm.exp.exp_params["timeout_punishment"])) 
+        self.fsm.current_trial.mark_reward()
+        pulse = ValvePulse(valve_pin, 0.0, float(self.fsm.exp.exp_params["open_valve_duration"]))
+        records = yield RunValves(compile_timeline([pulse]), None)
+        for record in records:
+            self.fsm.current_trial.add_valve_event(record.channel, record.level, monotonic_ns=record.actual_ns)
+
+    def give_punishment(self):
+        # The sound plays from the open stream; the timeout ends timeout_punishment after it
+        playback = self.fsm.audio.play(self.fsm.punishment_sound)
+        yield PlaybackStart(playback, 0.5)
+        self.fsm.current_trial.mark_punishment(playback.onset_ns)
+        logger.info("punishment onset latency: %s ms", playback.latency_ms, extra={"latency_ms": playback.latency_ms})
+        end_ns = playback.end_ns + int(float(self.fsm.exp.exp_params["timeout_punishment"]) * 1e9)
+        yield Sleep(max(0, end_ns - time.monotonic_ns()) / 1e9)
+
+    def pause_after_exit(self, exit_ns, pause_s=1.0):
+        """
+        Waits pause_s after the exit before the next trial, unless a mouse is read meanwhile:
+        its tag ends the pause and is handed to Idle, so its trial starts at once. (Tags read
+        before the exit are stale and dropped, like in Idle.)
+        """
+        if exit_ns is None:
+            return
+        deadline = time.monotonic() + pause_s
+        while not self.fsm.stopped:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            tag_event = yield NextTag(remaining)
+            if tag_event is not None and tag_event.timestamp_ns >= exit_ns:
+                self.fsm.states["Idle"].pending_tag = tag_event
+                return
 
     def evaluate_response(self):
         value = self.fsm.current_trial.current_value
@@ -386,42 +362,155 @@ class TrialState(State):
         elif value == 'catch':
             return 'catch - response' if self.got_response else 'catch - no response'
 
-    def on_event(self, event):
-        if event == 'trial_over':
-            time.sleep(0.5)
-            self.fsm.current_trial.write_trial_to_csv(self.fsm.exp.txt_file_path)
-            if self.fsm.exp.exp_params['ITI_time'] is None:
-                while lgpio.gpio_read(h, IR_pin) == 1:  # 1 == HIGH
-                    time.sleep(0.09)
-                time.sleep(1)  # wait one sec after exit- before pass to the next trial
-            else:
-                time.sleep(int(self.fsm.exp.exp_params['ITI_time']))
-            print("Transitioning from trial to idle")
-            self.fsm.state = IdleState(self.fsm)
+    def finish_trial(self):
+        """Saves the trial and waits for the mouse to leave (or for the ITI)"""
+        self.fsm.current_trial.mark_end()
+        if self.fsm.exp.exp_params['ITI_time'] is None:
+            since_ns = self.fsm.clock.to_monotonic(self.fsm.current_trial.entry_ns)
+            # on stop() the trial is saved without an exit time
+            exit_ns = yield from self.wait_for_beam(0, since_ns=since_ns)
+            self.fsm.current_trial.set_exit_time(exit_ns)
+            self.fsm.current_trial.set_input_window(self.fsm.sampler, self.baseline_s)
+            self.fsm.current_trial.write_trial_to_csv(self.fsm.trial_writer)
+            self.fsm.exp.upload_data()  # only marks the session for the uploader
+            self.fsm.save_progress()
+            yield from self.pause_after_exit(exit_ns)
+        else:
+            if not self.fsm.beam.in_port:
+                self.fsm.current_trial.set_exit_time(self.fsm.beam.exit_ns)
+            self.fsm.current_trial.set_input_window(self.fsm.sampler, self.baseline_s)
+            self.fsm.current_trial.write_trial_to_csv(self.fsm.trial_writer)
+            self.fsm.exp.upload_data()
+            self.fsm.save_progress()
+            yield Sleep(int(self.fsm.exp.exp_params['ITI_time']))
 
 class FiniteStateMachine:
 
-    def __init__(self, experiment=None):
+    # (state, event) -> next state
+    TRANSITIONS = {
+        ("Idle", "in_port"): "port",
+        ("port", "IR_stim"): "trial",
+        ("port", "timeout"): "Idle",
+        ("trial", "trial_over"): "Idle",
+    }
+
+    def __init__(self, experiment=None, backend=None, mode="threaded"):
+        """
+        experiment: experiment object
+        backend: hardware.HardwareBackend - the real rig (default) or hardware.SimulatedBackend
+        mode: "threaded" - the states block on threading primitives
+              "asyncio"  - the states are awaited on one asyncio loop (async_runtime.py)
+        """
         self.exp = experiment
+        self.clock = SessionClock()
+        if backend is None:
+            # the RFID port may already be open for the mice table dialog
+            self.rfid = rfid_reader.shared_reader()
+            backend = hardware.RigBackend(rfid_port=self.rfid.port)
+        else:
+            self.rfid = rfid_reader.RfidReader(backend)
+        # subscribed before the slow part of the start, so a mouse read meanwhile is not lost
+        self.tags = self.rfid.subscribe()
+        self.hw = backend
+        self.sampler = InputSampler(self.hw)  # every lick/IR edge of the session
+        self.lick_capture = LickCapture(self.sampler)
+        self.beam = BeamMonitor(self.hw, self.sampler)
+        self.valve_sequencer = ValveSequencer(self.hw)
+        self.switch_log = deque(maxlen=10000)  # valve_timeline.SwitchRecord of the odor valves
         self.current_trial = Trial(self)
-        self.state = IdleState(self)
-        
-        # Load white noise for punishment
+        params = experiment.exp_params
+        self.planner = TrialPlanner(experiment,
+                                    block_size=int(params["plan_block_size"]) if params.get("plan_block_size") else None,
+                                    max_same_value=int(params["max_same_value"]) if params.get("max_same_value") else None,
+                                    plans=experiment.trial_plans,
+                                    rng_state=experiment.progress.rng_state if experiment.progress else None)
+        # One open results file (and its binary trial store) for the session; the trials are written by a background thread
+        self.trial_writer = TrialWriter(experiment.txt_file_path, Trial.CSV_HEADER,
+                                        flush_every=int(params.get("trial_flush_every") or 1),
+                                        fsync=params.get("trial_fsync", True),
+                                        store=trial_store.TrialStore(trial_store.store_path(experiment.txt_file_path)))
+        # trials done in the session, counting those before a restart
+        self.trial_count = experiment.progress.trial_count if experiment.progress else 0
+        # The progress is checkpointed after every trial, once the trial is on disk
+        self.checkpointer = state_io.Checkpointer(state_io.checkpoint_path(os.path.dirname(experiment.txt_file_path)),
+                                                  before_save=self.trial_writer.flush)
+        self.stopped = False
+        # RSS, threads, fds and GC of the process, sampled on its own thread (replaces the per-state memory logs)
+        self.metrics = MetricsSampler(metrics_path(experiment.txt_file_path), trial_count=lambda: self.trial_count)
+        # Off until switched on from the live window or the control socket (python profiler.py on)
+        self.profiler = profiler.Profiler(profiler.profile_path(experiment.txt_file_path),
+                                          trial_count=lambda: self.trial_count)
         try:
-            #with np.load('/home/educage/Projects/DMTS_olfacto/stimuli/white_noise.npz', mmap_mode='r') as z:
-            with np.load(os.path.join('stimuli', 'white_noise.npz'), mmap_mode='r') as z:
-                self.noise = z['noise']
-                self.noise_Fs = int(z['Fs'])
-        except FileNotFoundError:
-            print("Warning: white_noise.npz not found, punishment audio will not work")
-
- 
+            self.control = profiler.ControlServer(self.profiler, params.get("control_socket") or profiler.CONTROL_SOCKET)
+        except (OSError, AttributeError) as e:  # AttributeError: no Unix sockets (Windows)
+            logger.warning("[FSM] No profiler control socket: %s", e)
+            self.control = None
+
+        # One output stream for the session, at the rate of its punishment sound (no resampling if the device plays it)
+        self.punishment_sound = experiment.exp_params.get("punishment_sound", "white_noise")
+        self.audio = AudioEngine(self.hw, sounds={name: file_name for name, file_name in PUNISHMENT_SOUNDS.items()
+                                                  if name == self.punishment_sound})
+
+        # The states are created once; a single executor thread runs them for the whole session
+        self.states = {state.name: state for state in (IdleState(self), InPortState(self), TrialState(self))}
+        self.state = self.states["Idle"]
+        self.state_since = time.monotonic()  # when the current state was entered (for the supervisor's watchdog)
+        # the runtime does the waiting of the states
+        if mode == "asyncio":
+            from async_runtime import AsyncRigRuntime  # asyncio is loaded only in this mode
+            self.runtime = AsyncRigRuntime(self)
+            target = self.runtime.run
+        elif mode == "threaded":
+            self.runtime = ThreadedWaits(self)
+            target = self._run_loop
+        else:
+            raise ValueError(f"Unknown FSM mode: {mode}")
+        self.mode = mode
+        self.executor = threading.Thread(target=target, name="FSM executor", daemon=True)
+        self.executor.start()
+
+    def _run_loop(self):
+        while not self.stopped:
+            self.state.enter()
+            event = self.runtime.run(self.state.run())
+            if event is not None:
+                self.on_event(event)
+
     def on_event(self, event):
-        self.state.on_event(event)
+        next_state = self.TRANSITIONS.get((self.state.name, event))
+        if next_state is None:
+            logger.warning("[FSM] No transition from '%s' on '%s'", self.state.name, event)
+            return
+        logger.info("Transitioning from %s to %s (%s)", self.state.name, next_state, event)
+        self.state = self.states[next_state]
+        self.state_since = time.monotonic()
+
+    def stop(self, timeout=STOP_TIMEOUT_S):
+        """
+        Stops the executor after the current state is done (waits up to timeout seconds for it),
+        syncs the trials written so far to disk and closes the hardware
+        """
+        self.stopped = True
+        self.runtime.wake()  # ends the Idle wait and the sleeps of the executor
+        self.executor.join(timeout)
+        if self.executor.is_alive():
+            logger.warning("[FSM] The executor did not stop in %.0f s (in %s), closing the rig anyway",
+                           timeout, self.state.name)
+        self.audio.close()
+        self.rfid.stop()
+        self.planner.stop()
+        self.trial_writer.close()
+        self.checkpointer.close()
+        self.metrics.stop()
+        if self.control is not None:
+            self.control.close()
+        self.profiler.stop()
+        self.hw.close()
+
+    def save_progress(self):
+        """Checkpoints the session after a trial (the file is written by the checkpointer thread)"""
+        plans, rng_state = self.planner.state()
+        self.checkpointer.submit(state_io.progress_of(self.trial_count, self.exp.mice_dict, plans, rng_state))
 
     def get_state(self):
         return self.state.name
-
-
-if __name__ == "__main__":
-    fsm = FiniteStateMachine()
@@ -0,0 +1,477 @@
+"""
+Hardware backends for the DMTS rig.
+
+The FSM talks to the rig only through a backend object:
+valves, IR beam, lick sensor, RFID serial reader and audio output.
+
+RigBackend      - the real Raspberry Pi rig (lgpio + pyserial + sounddevice)
+SimulatedBackend - in-process rig with a scripted mouse, for profiling and
+                   benchmarking the FSM on a regular Linux machine
+"""
+import glob
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger("rig.hardware")
+
+# Default pin numbers of the rig
+valve_pin = 4
+IR_pin = 27
+lick_pin = 17
+exit_odor_valve_pin = 21
+odor_gpios = {1: 5, 2: 6, 3: 13, 4: 19, 5: 26, 6: 21, 7: 20, 8: 16}  # odor number -> valve GPIO
+
+# Edges for watch_input()
+RISING = 'rising'
+FALLING = 'falling'
+BOTH = 'both'
+
+
+def realtime_to_monotonic_ns(tick):
+    """
+    Moves a CLOCK_REALTIME timestamp (an lgpio tick) to the monotonic clock. The offset is
+    read at every call: the wall clock steps (NTP, a Pi without an RTC after boot) during a session
+    """
+    return tick + time.monotonic_ns() - time.time_ns()
+
+
+class PollingWatcher:
+    """
+    Fallback for backends without edge alerts.
+    Polls a read function in its own thread and reports level changes as
+    callback(level, time.monotonic_ns()).
+    """
+
+    def __init__(self, read, callback, edge=BOTH, interval=0.001):
+        self.read = read
+        self.callback = callback
+        self.edge = edge
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        previous = self.read()
+        while not self._stop.wait(self.interval):
+            level = self.read()
+            if level == previous:
+                continue
+            previous = level
+            if (self.edge == BOTH or (self.edge == RISING and level == 1)
+                    or (self.edge == FALLING and level == 0)):
+                self.callback(level, time.monotonic_ns())
+
+    def cancel(self):
+        self._stop.set()
+
+
+class SerialRfidPort:
+    """
+    The RFID reader's USB serial port (pyserial).
+    Has the rfid_* methods of HardwareBackend, so rfid_reader.RfidReader can own it
+    before a rig backend exists (e.g. while the mice table dialog is open).
+    """
+
+    def __init__(self, serial_port=None, baudrate=9600):
+        import serial
+
+        if serial_port is None:
+            ports = glob.glob('/dev/ttyUSB*')
+            if not ports:
+                raise Exception("No USB serial device found!")
+            serial_port = ports[0]
+        self.ser = serial.Serial(port=serial_port, baudrate=baudrate, timeout=0.01)
+        logger.info("Connected to %s", serial_port)
+
+    def rfid_in_waiting(self):
+        return self.ser.in_waiting
+
+    def rfid_readline(self):
+        return self.ser.readline()
+
+    def rfid_flush(self):
+        self.ser.flushInput()
+
+    def rfid_fileno(self):
+        return self.ser.fileno()
+
+    def close(self):
+        try:
+            self.ser.close()
+        except Exception:
+            pass
+
+
+class HardwareBackend:
+    """Interface between the FSM and the rig hardware"""
+
+    def __init__(self):
+        self._watchers = []  # edge watchers, cancelled on close()
+
+    # ---- valves ----
+    def valve_on(self, gpio_number):
+        raise NotImplementedError
+
+    def valve_off(self, gpio_number):
+        raise NotImplementedError
+
+    # ---- sensors ----
+    def read_ir(self) -> int:
+        """Returns 1 while the beam is broken (mouse in port), otherwise 0"""
+        raise NotImplementedError
+
+    def read_lick(self) -> int:
+        """Returns 1 while the lick sensor is touched, otherwise 0"""
+        raise NotImplementedError
+
+    def watch_input(self, name, callback, edge=BOTH, debounce_us=0):
+        """
+        Calls callback(level, timestamp_ns) on every edge of the input 'lick' or 'ir'.
+        timestamp_ns is on the time.monotonic_ns() clock.
+        The default implementation polls the input; backends with edge alerts override it.
+        """
+        read = {'lick': self.read_lick, 'ir': self.read_ir}[name]
+        watcher = PollingWatcher(read, callback, edge)
+        self._watchers.append(watcher)
+        return watcher
+
+    # ---- RFID ----
+    def rfid_in_waiting(self) -> int:
+        raise NotImplementedError
+
+    def rfid_readline(self) -> bytes:
+        raise NotImplementedError
+
+    def rfid_flush(self):
+        raise NotImplementedError
+
+    def rfid_fileno(self) -> int:
+        """A file descriptor that is readable while RFID data is waiting (for event loops)"""
+        raise NotImplementedError
+
+    # ---- audio ----
+    def play_audio(self, data, samplerate, blocking=True):
+        raise NotImplementedError
+
+    def stop_audio(self):
+        raise NotImplementedError
+
+    def audio_samplerate(self, preferred=None) -> int:
+        """The output rate for open_audio_stream(): preferred if the device supports it"""
+        raise NotImplementedError
+
+    def open_audio_stream(self, callback, samplerate, blocksize=256):
+        """
+        Opens and starts a mono float32 output stream that calls
+        callback(outdata, frames, dac_delay_s) for every block from the audio thread.
+        outdata is a (frames, 1) array to fill; dac_delay_s is how long until its
+        first frame reaches the DAC. Returns the stream (it has close()).
+        """
+        raise NotImplementedError
+
+    def close(self):
+        for watcher in self._watchers:
+            watcher.cancel()
+
+
+class RigBackend(HardwareBackend):
+    """The real rig: lgpio for the GPIOs, pyserial for the RFID reader and sounddevice for audio"""
+
+    def __init__(self, chip=0, serial_port=None, baudrate=9600,
+                 valve_pin=valve_pin, IR_pin=IR_pin, lick_pin=lick_pin,
+                 exit_odor_valve_pin=exit_odor_valve_pin, rfid_port=None):
+        """rfid_port: an open SerialRfidPort to use instead of opening serial_port"""
+        import lgpio
+
+        super().__init__()
+        self.lgpio = lgpio
+        self.IR_pin = IR_pin
+        self.lick_pin = lick_pin
+
+        # lgpio setup
+        self.h = lgpio.gpiochip_open(chip)
+        self._outputs = set()
+        self._claim_output(valve_pin)
+        self._claim_output(exit_odor_valve_pin)
+        lgpio.gpio_claim_input(self.h, IR_pin)
+        lgpio.gpio_claim_input(self.h, lick_pin)
+
+        self.rfid_port = rfid_port if rfid_port is not None else SerialRfidPort(serial_port, baudrate)
+
+        self._sd = None
+
+    def _claim_output(self, gpio_number):
+        if gpio_number not in self._outputs:
+            self.lgpio.gpio_claim_output(self.h, gpio_number, 0)
+            self._outputs.add(gpio_number)
+
+    def valve_on(self, gpio_number):
+        self._claim_output(gpio_number)
+        self.lgpio.gpio_write(self.h, gpio_number, 1)
+
+    def valve_off(self, gpio_number):
+        self._claim_output(gpio_number)
+        self.lgpio.gpio_write(self.h, gpio_number, 0)
+
+    def read_ir(self):
+        return self.lgpio.gpio_read(self.h, self.IR_pin)
+
+    def watch_input(self, name, callback, edge=BOTH, debounce_us=0):
+        """Edge alerts from lgpio: the pin is reclaimed as an alert input with hardware debounce"""
+        lg = self.lgpio
+        pin = {'lick': self.lick_pin, 'ir': self.IR_pin}[name]
+        lg_edge = {RISING: lg.RISING_EDGE, FALLING: lg.FALLING_EDGE, BOTH: lg.BOTH_EDGES}[edge]
+        lg.gpio_free(self.h, pin)
+        lg.gpio_claim_alert(self.h, pin, lg_edge)
+        if debounce_us:
+            lg.gpio_set_debounce_micros(self.h, pin, debounce_us)
+
+        def _alert(chip, gpio, level, tick):
+            if level == lg.TIMEOUT:  # watchdog report, not an edge
+                return
+            callback(level, realtime_to_monotonic_ns(tick))
+
+        cb = lg.callback(self.h, pin, lg_edge, _alert)
+        self._watchers.append(cb)
+        return cb
+
+    def read_lick(self):
+        return self.lgpio.gpio_read(self.h, self.lick_pin)
+
+    def rfid_in_waiting(self):
+        return self.rfid_port.rfid_in_waiting()
+
+    def rfid_readline(self):
+        return self.rfid_port.rfid_readline()
+
+    def rfid_flush(self):
+        self.rfid_port.rfid_flush()
+
+    def rfid_fileno(self):
+        return self.rfid_port.rfid_fileno()
+
+    @property
+    def sd(self):
+        if self._sd is None:
+            import sounddevice
+            self._sd = sounddevice
+        return self._sd
+
+    def play_audio(self, data, samplerate, blocking=True):
+        self.sd.play(data, samplerate=samplerate, blocking=blocking)
+
+    def stop_audio(self):
+        self.sd.stop()
+
+    def audio_samplerate(self, preferred=None):
+        if preferred is not None:
+            try:
+                self.sd.check_output_settings(samplerate=preferred, channels=1, dtype='float32')
+                return int(preferred)
+            except Exception as e:
+                logger.warning("The audio device does not support %s Hz: %s", preferred, e)
+        return int(self.sd.query_devices(kind='output')['default_samplerate'])
+
+    def open_audio_stream(self, callback, samplerate, blocksize=256):
+        def _callback(outdata, frames, time_info, status):
+            callback(outdata, frames, time_info.outputBufferDacTime - time_info.currentTime)
+
+        stream = self.sd.OutputStream(samplerate=samplerate, channels=1, dtype='float32',
+                                      blocksize=blocksize, latency='low', callback=_callback)
+        stream.start()
+        return stream
+
+    def close(self):
+        super().close()
+        try:
+            for gpio_number in self._outputs:
+                self.lgpio.gpio_write(self.h, gpio_number, 0)
+            self.lgpio.gpiochip_close(self.h)
+        except Exception as e:
+            logger.error("Error closing GPIO chip: %s", e)
+        self.rfid_port.close()
+
+
+class SimulatedAudioStream:
+    """
+    Output stream of the simulated rig (and a null audio device): a thread pulls
+    one block from the callback every block period and throws it away.
+    """
+
+    def __init__(self, callback, samplerate, blocksize=256):
+        import numpy as np
+
+        self.callback = callback
+        self.samplerate = samplerate
+        self.blocksize = blocksize
+        self._block = np.zeros((blocksize, 1), dtype=np.float32)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="Simulated audio", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        period_ns = int(self.blocksize / self.samplerate * 1e9)
+        next_ns = time.monotonic_ns()
+        while not self._stop.is_set():
+            self.callback(self._block, self.blocksize, 0.0)
+            next_ns += period_ns
+            self._stop.wait(max(0, next_ns - time.monotonic_ns()) / 1e9)
+
+    def close(self):
+        self._stop.set()
+
+
+class SimulatedVisit:
+    """
+    One scripted visit of a mouse to the port.
+    mouse_id     - the tag sent by the RFID reader
+    arrive_after - seconds from the end of the previous visit until the RFID read
+    enter_after  - seconds from the RFID read until the beam is broken
+    dwell        - seconds the mouse stays in the port (beam broken)
+    licks        - lick onsets in seconds, relative to the beam break
+    lick_duration - how long each lick keeps the sensor high
+    """
+
+    def __init__(self, mouse_id, arrive_after=0.1, enter_after=0.05, dwell=3.0, licks=(), lick_duration=0.02):
+        self.mouse_id = mouse_id
+        self.arrive_after = arrive_after
+        self.enter_after = enter_after
+        self.dwell = dwell
+        self.licks = list(licks)
+        self.lick_duration = lick_duration
+
+
+class SimulatedBackend(HardwareBackend):
+    """
+    In-process rig. A script thread plays a sequence of SimulatedVisit objects:
+    writes the tag to the simulated serial buffer, breaks the beam, licks and leaves.
+    Every valve switch is recorded with a monotonic timestamp so the timing of the
+    FSM can be measured.
+    """
+
+    def __init__(self, visits=(), log_size=100000, realtime_audio=True, rfid_repeat=0.25,
+                 audio_rates=(44100, 48000, 96000, 192000)):
+        super().__init__()
+        self.visits = visits
+        self.rfid_repeat = rfid_repeat
+        self.audio_rates = audio_rates  # the rates the simulated sound card plays; the first is its default
+        self.realtime_audio = realtime_audio
+        self.ir_state = 0
+        self.lick_state = 0
+        self.valves = {}
+        self.valve_log = deque(maxlen=log_size)  # (time.monotonic_ns(), gpio, level)
+        self.ir_log = deque(maxlen=log_size)     # (time.monotonic_ns(), level)
+        self.audio_log = deque(maxlen=log_size)  # (time.monotonic_ns(), num samples, samplerate)
+        self._rfid_lines = deque()
+        # one byte per waiting line, so that rfid_fileno() is readable like a serial port
+        self._rfid_doorbell_r, self._rfid_doorbell_w = os.pipe()
+        os.set_blocking(self._rfid_doorbell_r, False)
+        self._tag_read = threading.Event()
+        self._stop = threading.Event()
+        self._audio_stop = threading.Event()
+        self._audio_streams = []
+        self.visits_done = threading.Event()
+        self._script_thread = threading.Thread(target=self._run_script, daemon=True)
+        self._script_thread.start()
+
+    def _run_script(self):
+        for visit in self.visits:
+            if self._stop.wait(visit.arrive_after):
+                return
+            # The reader keeps reporting the tag while the mouse is at the antenna
+            self._tag_read.clear()
+            while not self._tag_read.is_set():
+                self._rfid_lines.append(visit.mouse_id.encode('utf-8') + b'\r\n')
+                os.write(self._rfid_doorbell_w, b'\x00')
+                if self._stop.wait(self.rfid_repeat):
+                    return
+            if self._stop.wait(visit.enter_after):
+                return
+            self._set_ir(1)
+            entry = time.monotonic()
+            for lick_time in visit.licks:
+                if lick_time >= visit.dwell:
+                    break
+                if self._stop.wait(max(0.0, entry + lick_time - time.monotonic())):
+                    return
+                self.lick_state = 1
+                time.sleep(visit.lick_duration)
+                self.lick_state = 0
+            if self._stop.wait(max(0.0, entry + visit.dwell - time.monotonic())):
+                return
+            self._set_ir(0)
+        self.visits_done.set()
+
+    def _set_ir(self, level):
+        self.ir_state = level
+        self.ir_log.append((time.monotonic_ns(), level))
+
+    def valve_on(self, gpio_number):
+        self.valves[gpio_number] = 1
+        self.valve_log.append((time.monotonic_ns(), gpio_number, 1))
+
+    def valve_off(self, gpio_number):
+        self.valves[gpio_number] = 0
+        self.valve_log.append((time.monotonic_ns(), gpio_number, 0))
+
+    def read_ir(self):
+        return self.ir_state
+
+    def read_lick(self):
+        return self.lick_state
+
+    def _drain_doorbell(self, num_bytes=4096):
+        try:
+            os.read(self._rfid_doorbell_r, num_bytes)
+        except BlockingIOError:
+            pass
+
+    def rfid_in_waiting(self):
+        waiting = sum(len(line) for line in self._rfid_lines)
+        if not waiting:
+            self._drain_doorbell()
+        return waiting
+
+    def rfid_readline(self):
+        try:
+            line = self._rfid_lines.popleft()
+        except IndexError:
+            return b''
+        self._drain_doorbell(1)
+        self._tag_read.set()
+        return line
+
+    def rfid_flush(self):
+        self._rfid_lines.clear()
+        self._drain_doorbell()
+
+    def rfid_fileno(self):
+        return self._rfid_doorbell_r
+
+    def play_audio(self, data, samplerate, blocking=True):
+        self.audio_log.append((time.monotonic_ns(), len(data), samplerate))
+        if blocking and self.realtime_audio:
+            self._audio_stop.clear()
+            self._audio_stop.wait(len(data) / samplerate)
+
+    def stop_audio(self):
+        self._audio_stop.set()
+
+    def audio_samplerate(self, preferred=None):
+        return int(preferred) if preferred in self.audio_rates else self.audio_rates[0]
+
+    def open_audio_stream(self, callback, samplerate, blocksize=256):
+        stream = SimulatedAudioStream(callback, samplerate, blocksize)
+        self._audio_streams.append(stream)
+        return stream
+
+    def close(self):
+        super().close()
+        self._stop.set()
+        self._audio_stop.set()
+        for stream in self._audio_streams:
+            stream.close()
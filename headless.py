@@ -0,0 +1,236 @@
+"""
+The experiment without a GUI, for unattended cages and runs over SSH.
+
+    python headless.py <config file>          run the session of the config file
+    python headless.py --restart <exp name>   resume a session from its checkpoint (state_io)
+    python supervisor.py --headless <config file>   the same, restarted when needed
+
+Nothing of Tk is imported. There is no live window: the FSM logs the trials
+(rig_logging), the metrics sampler records the process, and a status line
+(trials, state, RSS, uploads) is logged every STATUS_INTERVAL_S. SIGTERM or
+Ctrl-C ends the session like the End button.
+
+The config file is JSON:
+    {
+      "exp_name": "cage3",
+      "levels": "Levels/L1.csv",
+      "mice": {"0007DECB4A": "L1", "0007DECB4B": "L1"},
+      "params": {"lick_time": "1", "start_trial_option": "1", ...},
+      "user_email": "someone@lab.org",
+      "memory_threshold_mb": 450
+    }
+- exp_name: the session folder is experiments/<exp_name>_<dd_mm_yyyy>, as in
+  the GUI. If that session has a checkpoint, it continues from it (the trials
+  done, the planned trials); levels, mice and params come from the config.
+- levels: the levels table (.csv or .xlsx), as loaded in the GUI
+- mice: RFID tag -> level name
+- params: exp_params as the GUI's OK button sets them (REQUIRED_PARAMS; the
+  None ones of the GUI may be left out) plus any optional ones, e.g.
+  "fsm_mode": "asyncio", or "simulated_rig": true to run on
+  hardware.SimulatedBackend with no mouse (bench_restart.py)
+- memory_threshold_mb: RSS above which an unsupervised session restarts
+  itself (default 450); kept in exp_params, so a restarted session keeps it
+"""
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from datetime import datetime
+
+import data_sync
+import hardware
+import rig_logging
+import state_io
+import supervisor
+import uploader
+from finite_state_machine import FiniteStateMachine
+from level import compile_levels
+from mouse import Mouse
+
+STATUS_INTERVAL_S = 60
+
+REQUIRED_PARAMS = ("lick_time", "start_trial_option", "IR_no_RFID_option", "lick_threshold",
+                   "time_to_lick_after_stim", "open_valve_duration", "open_odor_duration",
+                   "load_odor_duration", "inter_odor_delay", "timeout_punishment", "ITI")
+# set by the GUI only for some options; None otherwise
+DEFAULT_PARAMS = {"lick_time_bin_size": None, "start_trial_time": None, "ITI_time": None, "stimulus_length": 2}
+
+logger = logging.getLogger("rig.headless")
+
+
+class NoLiveWindow:
+    """What the FSM reads of the live window: no updates, never paused"""
+    activate_window = False
+    pause = False
+
+
+def load_levels(path):
+    """The levels table as the GUI builds it (the cells of a CSV as text)"""
+    import pandas as pd  # only for a new session; a restart reads the levels from the checkpoint
+    if path.endswith(".xlsx"):
+        return pd.read_excel(path)
+    return pd.read_csv(path, dtype=str, keep_default_na=False)
+
+
+def load_config(path):
+    """
+    Reads a config file. Returns (exp_name, levels_df, mice_dict, exp_params, user_email).
+    Raises ValueError for a missing or invalid entry.
+    """
+    with open(path) as f:
+        config = json.load(f)
+    for key in ("exp_name", "levels", "mice", "params"):
+        if key not in config:
+            raise ValueError(f"{path}: no '{key}'")
+    folder = os.path.dirname(os.path.abspath(path))
+    levels_df = load_levels(os.path.join(folder, config["levels"]))  # relative to the config file
+    exp_params = dict(DEFAULT_PARAMS, **config["params"])
+    missing = [key for key in REQUIRED_PARAMS if exp_params.get(key) in (None, "")]
+    if missing:
+        raise ValueError(f"{path}: params without {', '.join(missing)}")
+    exp_params["memory_threshold_mb"] = config.get("memory_threshold_mb", 450)
+    mice_dict = {str(tag): Mouse(str(tag), str(level)) for tag, level in config["mice"].items()}
+    return config["exp_name"], levels_df, mice_dict, exp_params, config.get("user_email", "")
+
+
+def session_name(exp_name):
+    """The session folder name of a new session, as the GUI makes it"""
+    return f"{exp_name}_{datetime.now().strftime('%d_%m_%Y')}"
+
+
+class HeadlessExperiment:
+    """
+    The parts of experiment.Experiment the FSM uses, without the GUI.
+    run() blocks until stop() (or SIGTERM / Ctrl-C).
+    """
+
+    def __init__(self, exp_name, mice_dict, levels_df, exp_params, user_email="", progress=None, backend=None):
+        """
+        exp_name: the session folder name (experiments/<exp_name>)
+        progress: the state_io.Progress to continue from (None: a new session)
+        backend: hardware.HardwareBackend (default: the rig)
+        Raises ValueError for invalid levels or mice of unknown levels.
+        """
+        self.txt_file_name = exp_name
+        self.exp_params = exp_params
+        self.levels_df = levels_df
+        self.mice_dict = mice_dict
+        self.user_email = user_email
+        self.progress = progress
+        self.trial_plans = progress.trial_plans if progress is not None else None
+        self.memory_threshold_mb = float(exp_params.get("memory_threshold_mb", 450))
+        if backend is None and exp_params.get("simulated_rig"):
+            backend = hardware.SimulatedBackend()
+        self.backend = backend
+        self.GPIO_dict = dict(hardware.odor_gpios)
+        self.levels = compile_levels(levels_df, self.GPIO_dict)
+        unknown = sorted({str(mouse.get_level()) for mouse in mice_dict.values()} - set(self.levels))
+        if unknown:
+            raise ValueError(f"Mice of unknown levels: {unknown}")
+        self.live_w = NoLiveWindow()
+        self.fsm = None
+        self.exp_folder_path = state_io.experiment_folder(exp_name)
+        os.makedirs(self.exp_folder_path, exist_ok=True)
+        self.txt_file_path = os.path.join(self.exp_folder_path, exp_name + ".txt")
+        if not os.path.exists(self.txt_file_path):
+            open(self.txt_file_path, 'w').close()
+        self.remote_folder = data_sync.REMOTE_FOLDER
+        self.uploader = uploader.Uploader(self.upload_folder, max_bytes_per_s=uploader.UPLOAD_MAX_BYTES_PER_S)
+        self.uploader.listeners.append(self.show_upload_status)
+        self._upload_state = None
+        self._stop = threading.Event()
+
+    def run(self):
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda *args: self.stop())
+            signal.signal(signal.SIGINT, lambda *args: self.stop())
+        self.save_checkpoint()
+        self.fsm = FiniteStateMachine(self, backend=self.backend, mode=self.exp_params.get("fsm_mode", "threaded"))
+        logger.info("Headless session %s started (%d trials done, %d mice)",
+                    self.txt_file_name, self.fsm.trial_count, len(self.mice_dict))
+        last_status = time.monotonic()
+        try:
+            # the first heartbeat goes out as soon as the FSM runs (the supervisor times restarts by it)
+            while True:
+                supervisor.send_heartbeat(self)
+                if self._stop.wait(1.0):
+                    break
+                if time.monotonic() - last_status >= STATUS_INTERVAL_S:
+                    last_status = time.monotonic()
+                    self.log_status()
+        finally:
+            self.fsm.stop()
+            self.uploader.stop()
+            logger.info("Headless session %s ended after %d trials", self.txt_file_name, self.fsm.trial_count)
+
+    def stop(self):
+        self._stop.set()
+
+    def log_status(self):
+        sample = self.fsm.metrics.latest()
+        rss_mb = sample["rss"] / 2**20 if sample is not None else 0
+        logger.info("%d trials, %s, RSS %.0f MB, upload %s", self.fsm.trial_count, self.fsm.get_state(), rss_mb,
+                    self._upload_state, extra={"trials": self.fsm.trial_count, "rss_mb": round(rss_mb, 1)})
+        if rss_mb > self.memory_threshold_mb and not supervisor.supervised():
+            # under the supervisor, the supervisor restarts the process itself
+            logger.warning("Memory usage %.0f MB exceeds %d MB, restarting", rss_mb, self.memory_threshold_mb)
+            supervisor.spawn_supervisor(self.txt_file_name, headless=True)
+            self.stop()
+
+    def save_checkpoint(self):
+        try:
+            state_io.save_session(self.txt_file_name, self.exp_params, self.levels_df, self.mice_dict,
+                                  self.txt_file_name, self.txt_file_path, self.user_email)
+        except (OSError, TypeError, ValueError) as e:
+            logger.error("Error saving state: %s", e)
+
+    def upload_data(self):
+        """Marks the experiment folder for the uploader (returns at once)"""
+        self.uploader.mark_dirty(self.exp_folder_path)
+
+    def upload_folder(self, src, max_bytes_per_s=None):
+        """Runs on the uploader thread"""
+        if self.fsm is not None and src == self.exp_folder_path:
+            self.fsm.trial_writer.flush(timeout=5)
+        return data_sync.upload_to_share(src, self.remote_folder, max_bytes_per_s)
+
+    def show_upload_status(self, status):
+        text = uploader.format_status(status)
+        if status.state != self._upload_state:
+            logger.info("Upload: %s", text)
+        self._upload_state = status.state
+
+
+def main(argv):
+    if argv[:1] == ["--standby"]:
+        # started by the supervisor ahead of a restart: everything is imported, wait for the session to resume
+        import pandas  # noqa: F401 - read_json of the checkpoint's levels, imported before the rig goes down
+        supervisor.notify("ready")
+        argv = ["--restart", sys.stdin.readline().strip()]
+        if not argv[1]:
+            return 0
+    if len(argv) == 2 and argv[0] == "--restart":
+        state = state_io.load_state(argv[1])
+        if state is None:
+            logger.error("No saved state for %s", argv[1])
+            return 1
+        experiment = HeadlessExperiment(argv[1], state.mice_dict, state.levels_df, state.exp_params,
+                                        state.user_email, progress=state.progress)
+    elif len(argv) == 1:
+        exp_name, levels_df, mice_dict, exp_params, user_email = load_config(argv[0])
+        name = session_name(exp_name)
+        progress = state_io.load_progress(state_io.checkpoint_path(state_io.experiment_folder(name)))
+        experiment = HeadlessExperiment(name, mice_dict, levels_df, exp_params, user_email, progress=progress)
+    else:
+        print(__doc__)
+        return 1
+    experiment.run()
+    return 0
+
+
+if __name__ == "__main__":
+    rig_logging.setup_logging()
+    sys.exit(main(sys.argv[1:]))
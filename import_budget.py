@@ -0,0 +1,90 @@
+"""
+Import-time budget of the rig's entry points.
+
+Every module of BUDGETS is imported in a fresh interpreter with
+python -X importtime (best of --repeat runs); the check fails if its
+cumulative import time is over the budget, or if it loaded a module of
+LAZY - the heavy dependencies that only some features need and import
+themselves when used (the Data Analysis window, sound playback in the GUI,
+objgraph in the profiler, asyncio in the asyncio FSM mode, pandas outside
+the GUI). The second check does not depend on the machine; the budgets were
+set at about 3x the times of a development PC and can be changed per run.
+
+usage: python import_budget.py [--repeat 3] [--budget-ms MODULE=MS ...] [--top 10]
+       python bench_fsm.py --imports   (the FSM benchmark, then this check)
+exits with 1 when a check fails
+"""
+import re
+import subprocess
+import sys
+
+BUDGETS_MS = {
+    "finite_state_machine": 1000,
+    "headless": 2000,
+    "experiment": 2500,
+}
+
+ANALYSIS = ("matplotlib", "scipy", "data_analysis")
+LAZY = {
+    "finite_state_machine": ANALYSIS + ("pandas", "tkinter", "sounddevice", "objgraph", "asyncio"),
+    "headless": ANALYSIS + ("tkinter", "sounddevice", "objgraph", "asyncio"),
+    "experiment": ANALYSIS + ("sounddevice", "objgraph", "asyncio"),
+}
+
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def import_times(module):
+    """[(name, self us, cumulative us, depth)] of importing module in a new interpreter"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr.strip().splitlines()[-1]}")
+    times = []
+    for line in result.stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            times.append((name, int(self_us), int(cumulative_us), len(indent) // 2))
+    return times
+
+
+def check(module, budget_ms, repeat=3, top=10):
+    """Prints the report of one module. Returns True if it is within its budget and loads none of LAZY"""
+    runs = [import_times(module) for _ in range(repeat)]
+    best = min(runs, key=lambda times: times[-1][2])  # the module itself is the last line
+    total_ms = best[-1][2] / 1000
+    loaded = {name.split(".")[0] for name, _, _, _ in best}
+    eager = [name for name in LAZY.get(module, ()) if name in loaded]
+    ok = total_ms <= budget_ms and not eager
+    print(f"\n==== import {module}: {total_ms:.0f} ms (budget {budget_ms} ms) {'OK' if ok else 'FAILED'} ====")
+    if eager:
+        print(f"loaded at import, should be lazy: {', '.join(eager)}")
+    print("heaviest top-level imports (cumulative ms):")
+    direct = sorted((t for t in best if t[3] == 1), key=lambda t: -t[2])[:top]
+    for name, _, cumulative_us, _ in direct:
+        print(f"  {cumulative_us / 1000:8.1f}  {name}")
+    return ok
+
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description="Checks the import time of the rig's entry points")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--budget-ms", action="append", default=[], metavar="MODULE=MS",
+                        help="change the budget of a module (or add one)")
+    args = parser.parse_args(argv)
+    budgets = dict(BUDGETS_MS)
+    for item in args.budget_ms:
+        module, _, ms = item.partition("=")
+        budgets[module] = float(ms)
+    failed = [module for module, budget_ms in budgets.items() if not check(module, budget_ms, args.repeat, args.top)]
+    if failed:
+        print(f"\nover budget: {', '.join(failed)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,108 @@
+"""
+Continuous recording of the lick and IR inputs for the whole session.
+
+InputSampler is the only subscriber to the backend's edge alerts. Every level
+change of the lick sensor and the IR beam goes into a fixed-size NumPy ring
+buffer (InputRing) and is then passed to the listeners of that channel
+(BeamMonitor, LickCapture, the asyncio runtime).
+A trial can slice any time window from the ring - baseline before the trial,
+odor presentation, response window and exit. The window is a view into the
+ring, unless it spans the ring's wrap point: then only the edges of the
+window are copied (the trial copies its window anyway, the ring is reused).
+"""
+import threading
+
+import numpy as np
+
+import hardware
+
+LICK = 0
+IR = 1
+
+
+class InputRing:
+    """Ring buffer of input edges: time (time.monotonic_ns()), channel (LICK/IR), level"""
+
+    def __init__(self, size=65536):
+        self.size = size
+        self.t = np.zeros(size, dtype=np.int64)
+        self.channel = np.zeros(size, dtype=np.int8)
+        self.level = np.zeros(size, dtype=np.int8)
+        self.count = 0  # edges written since the start; the next one goes to count % size
+        self._write_lock = threading.Lock()  # edges can come from more than one alert thread
+
+    def append(self, channel, level, timestamp_ns):
+        with self._write_lock:
+            i = self.count % self.size
+            self.t[i] = timestamp_ns
+            self.channel[i] = channel
+            self.level[i] = level
+            self.count += 1
+
+    def _slice(self, first, last):
+        """Edges first..last-1 (absolute counters). Views when contiguous in memory, a copy when wrapping"""
+        first = max(first, last - self.size)
+        i, j = first % self.size, last % self.size
+        if first == last:
+            i = j = 0
+        if i < j or first == last:
+            return self.t[i:j], self.channel[i:j], self.level[i:j]
+        return (np.concatenate((self.t[i:], self.t[:j])),
+                np.concatenate((self.channel[i:], self.channel[:j])),
+                np.concatenate((self.level[i:], self.level[:j])))
+
+    def read_since(self, cursor):
+        """Returns ((t, channel, level), new_cursor) with the edges written after cursor"""
+        last = self.count
+        return self._slice(cursor, last), last
+
+    def window(self, start_ns, end_ns):
+        """
+        Edges with start_ns <= t <= end_ns, as (t, channel, level).
+        The two segments of a wrapped ring (older: from the write position to the end,
+        newer: from the start to the write position) are searched one by one
+        """
+        last = self.count
+        if last <= self.size:
+            segments = ((0, last),)
+        else:
+            j = last % self.size
+            segments = ((j, self.size), (0, j))
+        selected = []
+        for lo, hi in segments:
+            t = self.t[lo:hi]
+            a = lo + np.searchsorted(t, start_ns, side='left')
+            b = lo + np.searchsorted(t, end_ns, side='right')
+            if a < b:
+                selected.append(slice(a, b))
+        if not selected:
+            return self.t[:0], self.channel[:0], self.level[:0]
+        if len(selected) == 1:
+            s = selected[0]
+            return self.t[s], self.channel[s], self.level[s]
+        return tuple(np.concatenate([array[s] for s in selected]) for array in (self.t, self.channel, self.level))
+
+
+class InputSampler:
+
+    def __init__(self, backend, ring_size=65536, debounce_us=1000):
+        self.ring = InputRing(ring_size)
+        self.listeners = {LICK: [], IR: []}  # callback(level, timestamp_ns), called from the alert thread
+        backend.watch_input('lick', self._on_lick, edge=hardware.BOTH, debounce_us=debounce_us)
+        backend.watch_input('ir', self._on_ir, edge=hardware.BOTH, debounce_us=debounce_us)
+
+    def _on_lick(self, level, timestamp_ns):
+        self._on_edge(LICK, level, timestamp_ns)
+
+    def _on_ir(self, level, timestamp_ns):
+        self._on_edge(IR, level, timestamp_ns)
+
+    def _on_edge(self, channel, level, timestamp_ns):
+        self.ring.append(channel, level, timestamp_ns)
+        for listener in self.listeners[channel]:
+            listener(level, timestamp_ns)
+
+    def lick_onsets(self, start_ns, end_ns):
+        """time.monotonic_ns() of every lick onset in the window"""
+        t, channel, level = self.ring.window(start_ns, end_ns)
+        return t[(channel == LICK) & (level == 1)]
@@ -1,4 +1,9 @@
-from typing import Any
+import random
+from typing import Any, NamedTuple
+
+import numpy as np
+
+from column_constants import ColumnNames
 
 
 class Level:
@@ -9,3 +14,109 @@ class Level:
 
     def get_parameters(self) -> dict[str, Any]:
         return self.parameters
+
+
+class AliasTable:
+    """
+    Walker/Vose alias table: draws index i with probability weights[i] / sum(weights)
+    in O(1) (one uniform index and one uniform float per draw).
+    All-zero weights draw uniformly, like the old weighted choice did.
+    """
+
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        n = len(weights)
+        total = weights.sum()
+        self.p = weights / total if total > 0 else np.full(n, 1.0 / n)  # the normalized probabilities
+        self.p.flags.writeable = False
+        scaled = self.p * n
+        self.prob = np.ones(n)
+        self.alias = np.arange(n)
+        small = [i for i in range(n) if scaled[i] < 1.0]
+        large = [i for i in range(n) if scaled[i] >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            (small if scaled[l] < 1.0 else large).append(l)
+        # whatever is left is 1 up to rounding errors
+        self.prob.flags.writeable = False
+        self.alias.flags.writeable = False
+        self._n = n
+        self._prob = self.prob.tolist()    # plain lists: faster to index than NumPy scalars
+        self._alias = self.alias.tolist()
+
+    def sample(self, rng=random):
+        i = rng.randrange(self._n)
+        return i if rng.random() < self._prob[i] else self._alias[i]
+
+
+class CompiledLevel(NamedTuple):
+    """
+    One level of levels_df, compiled once when the levels are loaded.
+    Row i of the arrays is one stimulus of the level.
+    """
+    name: str
+    odor_numbers: np.ndarray  # int
+    values: np.ndarray        # "go\\no-go" / "catch" / ... (object)
+    indices: np.ndarray       # int, the 'index' column
+    gpios: np.ndarray         # int, the valve GPIO of each odor
+    p_first: AliasTable
+    p_second: AliasTable
+    p_neurolux: np.ndarray    # float 0-1, the chance of neurolux when the row is the second stimulus
+
+
+def _probabilities(level_rows, column, level_name):
+    try:
+        p = level_rows[column].astype(np.float64).to_numpy()
+    except (TypeError, ValueError):
+        raise ValueError(f"Level '{level_name}': {column} must be numbers")
+    if not np.all(np.isfinite(p)) or np.any(p < 0):
+        raise ValueError(f"Level '{level_name}': {column} must be finite and >= 0")
+    return p
+
+
+def _neurolux(level_rows, level_name):
+    """P(neurolux) / 100 for the rows with 'is neurolux' = Yes, 0 for the others (and for tables without the columns)"""
+    if ColumnNames.IS_NEUROLUX not in level_rows or ColumnNames.P_NEUROLUX not in level_rows:
+        return np.zeros(len(level_rows))
+    p = _probabilities(level_rows, ColumnNames.P_NEUROLUX, level_name)
+    if np.any(p > 100):
+        raise ValueError(f"Level '{level_name}': {ColumnNames.P_NEUROLUX} must be between 0 and 100")
+    is_neurolux = level_rows[ColumnNames.IS_NEUROLUX].astype(str).str.strip().str.lower() == "yes"
+    return np.where(is_neurolux.to_numpy(), p / 100, 0.0)
+
+
+def _frozen(array):
+    array.flags.writeable = False
+    return array
+
+
+def compile_levels(levels_df, GPIO_dict: dict[int, int]) -> dict[str, CompiledLevel]:
+    """
+    Compiles levels_df into {level name: CompiledLevel}.
+    Raises ValueError for invalid probabilities, indices or odors without a GPIO.
+    """
+    levels = {}
+    for level_name, level_rows in levels_df.groupby(ColumnNames.LEVEL_NAME, sort=False):
+        level_name = str(level_name)
+        try:
+            odor_numbers = level_rows[ColumnNames.ODOR_NUMBER].astype(int).to_numpy()
+            indices = level_rows[ColumnNames.INDEX].astype(int).to_numpy()
+        except (TypeError, ValueError):
+            raise ValueError(f"Level '{level_name}': odor numbers and indices must be integers")
+        missing = sorted(set(odor_numbers.tolist()) - set(GPIO_dict))
+        if missing:
+            raise ValueError(f"Level '{level_name}': no GPIO for odor(s) {missing}")
+        levels[level_name] = CompiledLevel(
+            name=level_name,
+            odor_numbers=_frozen(odor_numbers),
+            values=_frozen(level_rows[ColumnNames.VALUE].astype(str).to_numpy(dtype=object)),
+            indices=_frozen(indices),
+            gpios=_frozen(np.array([GPIO_dict[n] for n in odor_numbers.tolist()], dtype=int)),
+            p_first=AliasTable(_probabilities(level_rows, ColumnNames.P_FIRST, level_name)),
+            p_second=AliasTable(_probabilities(level_rows, ColumnNames.P_SECOND, level_name)),
+            p_neurolux=_frozen(_neurolux(level_rows, level_name)),
+        )
+    return levels
@@ -0,0 +1,41 @@
+import threading
+
+import input_sampler
+
+
+class LickCapture:
+    """
+    Reads lick onsets (rising edges of the lick sensor) with their
+    time.monotonic_ns() timestamps from the session's input ring.
+    The capture only keeps a cursor into the ring (InputSampler), so the
+    threshold logic consumes the same stream that is saved with the trial.
+    """
+
+    def __init__(self, sampler):
+        self._sampler = sampler
+        self._cursor = sampler.ring.count
+        self._new_edge = threading.Event()
+        self.listeners = []  # extra callback(level, timestamp_ns) for lick onsets, called from the alert thread
+        sampler.listeners[input_sampler.LICK].append(self._on_edge)
+
+    def _on_edge(self, level, timestamp_ns):
+        if not level:
+            return
+        self._new_edge.set()
+        for listener in self.listeners:
+            listener(level, timestamp_ns)
+
+    def clear(self):
+        """Drops all the licks captured so far"""
+        self._new_edge.clear()
+        self._cursor = self._sampler.ring.count
+
+    def pop_all(self):
+        """Returns the timestamps of the licks captured since the last call"""
+        self._new_edge.clear()
+        (t, channel, level), self._cursor = self._sampler.ring.read_since(self._cursor)
+        return t[(channel == input_sampler.LICK) & (level == 1)].tolist()
+
+    def wait(self, timeout):
+        """Blocks until a new lick is captured or the timeout (seconds) passes"""
+        return self._new_edge.wait(timeout)
@@ -1,13 +1,27 @@
+import logging
 import tkinter as tk
 import sys
+import threading
+import time
+
+logger = logging.getLogger("rig.live_window")
 
 
 class LiveWindow:
+    """
+    Live view of the experiment.
+    The update methods (toggle_indicator, blink, update_*, deactivate_states_indicators)
+    can be called from any thread: they only store the update and return.
+    The Tk main loop applies the pending updates every frame_ms, keeping only the
+    last value of each widget, so e.g. a burst of licks becomes one blink.
+    """
+    frame_ms = 33  # ~30 updates per second
+
     def __init__(self):
         # Create the main window
         self.root = tk.Toplevel()
         self.root.title("Live Window")
-        self.root.geometry("300x530")  # Set the window dimensions to 400x600 pixels
+        self.root.geometry("300x600")  # Set the window dimensions to 400x600 pixels
         
         self.pause = False
         self.activate_window = False
@@ -45,6 +59,9 @@ class LiveWindow:
         # Label for score with frame
         self.create_labeled_frame("score:")
 
+        # Label for the state of the uploads to the lab share
+        self.create_labeled_frame("upload:")
+
         # Frame for buttons to center them
         self.button_frame = tk.Frame(self.root)
         self.button_frame.pack(pady=20)  # Center the button frame vertically with padding
@@ -65,12 +82,50 @@ class LiveWindow:
         self.activate_button_frame.pack(pady=(0, 20))
         self.activate_button = tk.Button(self.activate_button_frame, text="Activate Window", command=self.on_activate_window)
         self.activate_button.pack()
+
+        # Profiling of the rig process (profiler.py); profile_listeners are called with True/False
+        self.profiling = False
+        self.profile_listeners = []
+        self.profile_button = tk.Button(self.activate_button_frame, text="Profiling", command=self.on_profile)
+        self.profile_button.pack(pady=(5, 0))
         
         try:
             self._activate_btn_default_bg = self.activate_button.cget("bg")
         except Exception:
             self._activate_btn_default_bg = None
 
+        # Pending updates from the FSM threads: key -> (function, args), applied by _apply_updates
+        self._pending = {}
+        self._blinks = {}      # bulb name -> blink duration (s), requested since the last frame
+        self._blink_off = {}   # bulb name -> time.monotonic() to turn a blinking bulb off
+        self._pending_lock = threading.Lock()
+        self.root.after(self.frame_ms, self._apply_updates)
+
+    def _post(self, key, func, *args):
+        """Stores an update for the next frame, replacing the pending update of the same widget"""
+        with self._pending_lock:
+            self._pending[key] = (func, args)
+
+    def _apply_updates(self):
+        """Runs in the Tk main loop: applies the updates posted since the last frame"""
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+            blinks, self._blinks = self._blinks, {}
+        try:
+            for func, args in pending.values():
+                func(*args)
+            now = time.monotonic()
+            for bulb_name, duration in blinks.items():
+                self._set_indicator(bulb_name, "on")
+                self._blink_off[bulb_name] = now + duration
+            for bulb_name, off_time in list(self._blink_off.items()):
+                if off_time <= now:
+                    self._set_indicator(bulb_name, "off")
+                    del self._blink_off[bulb_name]
+            self.root.after(self.frame_ms, self._apply_updates)
+        except tk.TclError:
+            pass  # the window was destroyed
+
 
     def create_indicator(self, name):
         frame = tk.Frame(self.root)
@@ -111,9 +166,19 @@ class LiveWindow:
             self.trial_value = value_label  
         elif label_text == "score:":
             self.score_value = value_label  
+        elif label_text == "upload:":
+            self.upload_value = value_label
 
         
     def toggle_indicator(self, bulb_name, turn_to):
+        self._post(("indicator", bulb_name), self._set_indicator, bulb_name, turn_to)
+
+    def blink(self, bulb_name, duration=0.08):
+        """Turns an indicator on for duration seconds (at least one frame); repeated blinks of a frame merge"""
+        with self._pending_lock:
+            self._blinks[bulb_name] = max(duration, self._blinks.get(bulb_name, 0))
+
+    def _set_indicator(self, bulb_name, turn_to):
         # Check current state and toggle the indicator light
         if turn_to == "on":
             fill = "green"
@@ -148,7 +213,38 @@ class LiveWindow:
             bg=(self._activate_btn_default_bg if self._activate_btn_default_bg else "#d9d9d9")  # reset to original or a neutral default
         )
         
+    def on_profile(self):
+        # switching off writes the CPU profile and joins the profiler threads: not on the Tk thread
+        on = not self.profiling
+        self._set_profiling(on)
+        threading.Thread(target=self._switch_profiling, args=(on,), name="Profiling switch", daemon=True).start()
+
+    def _switch_profiling(self, on):
+        for listener in self.profile_listeners:
+            try:
+                listener(on)
+            except Exception:
+                logger.warning("Profiling could not be switched %s", "on" if on else "off", exc_info=True)
+                self._post("profiling", self._set_profiling, not on)
+                return
+
+    def update_profiling(self, on):
+        """Shows whether profiling is on (it can also be switched from the control socket)"""
+        self._post("profiling", self._set_profiling, on)
+
+    def _set_profiling(self, on):
+        self.profiling = on
+        if on:
+            self.profile_button.config(highlightbackground="orange", highlightthickness=3, bg="#ffe0b3")
+        else:
+            self.profile_button.config(
+                highlightthickness=0,
+                bg=(self._activate_btn_default_bg if self._activate_btn_default_bg else "#d9d9d9"))
+        
     def deactivate_states_indicators(self, state_name):
+        self._post("states", self._set_state_indicators, state_name)
+
+    def _set_state_indicators(self, state_name):
         self.idle_bulb.itemconfig(self.indicator_circle, fill="gray")  
         self.in_port_bulb.itemconfig(self.indicator_circle, fill="gray") 
         self.trial_bulb.itemconfig(self.indicator_circle, fill="gray")
@@ -179,16 +275,19 @@ class LiveWindow:
         self.root.quit()
 
     def update_last_rfid(self, rfid):
-        self.last_rfid_value.config(text=rfid)  # Update last RFID label
+        self._post("rfid", self.last_rfid_value.config, {"text": rfid})  # Update last RFID label
 
     def update_score(self, score):
-        self.score_value.config(text=str(score))  # Update score label
+        self._post("score", self.score_value.config, {"text": str(score)})  # Update score label
         
     def update_level(self, level):
-        self.level_value.config(text=str(level))  # Update score label
+        self._post("level", self.level_value.config, {"text": str(level)})  # Update level label
         
     def update_trial_value(self, trial_value):
-        self.trial_value.config(text=str(trial_value))  # Update score label
+        self._post("trial value", self.trial_value.config, {"text": str(trial_value)})  # Update trial value label
+
+    def update_upload(self, text):
+        self._post("upload", self.upload_value.config, {"text": text})  # Update upload status label
 
 # Example usage
 #live_window = LiveWindow()
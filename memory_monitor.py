@@ -1,12 +1,15 @@
 import psutil
 import os
-import sys
+import signal
 import threading
 import time
-import subprocess
 import tkinter as tk
 import smtplib
+import logging
 from General_functions import send_email
+import supervisor
+
+logger = logging.getLogger("rig.memory_monitor")
 
 
 class MemoryMonitor:
@@ -30,7 +33,7 @@ class MemoryMonitor:
             self.monitoring = True
             self.monitor_thread = threading.Thread(target=self._monitor_loop, daemon=True)
             self.monitor_thread.start()
-            print(f"[MemoryMonitor] Memory monitoring started (threshold: {self.threshold_mb}MB)")
+            logger.info("[MemoryMonitor] Memory monitoring started (threshold: %sMB)", self.threshold_mb)
     
     def stop_monitoring(self):
         """Stops memory monitoring"""
@@ -38,14 +41,14 @@ class MemoryMonitor:
             self.monitoring = False
             if self.monitor_thread and self.monitor_thread.is_alive():
                 self.monitor_thread.join(timeout=1)
-            print("[MemoryMonitor] Memory monitoring stopped")
+            logger.info("[MemoryMonitor] Memory monitoring stopped")
     
     def _monitor_loop(self):
         """Main monitoring loop"""
         while self.monitoring:
             try:
                 current_memory = self._get_current_memory_mb()
-                print(f"[MemoryMonitor] Memory usage {current_memory:.1f}MB , threshold {self.threshold_mb}MB")
+                logger.info("[MemoryMonitor] Memory usage %.1fMB , threshold %sMB", current_memory, self.threshold_mb)
                 
                 # Check if memory has reached 100MB below threshold and warning hasn't been shown yet
                 if not self.warning_shown and current_memory > (self.threshold_mb - 100):
@@ -63,24 +66,28 @@ class MemoryMonitor:
                     self.warning_shown = True
                 
                 if current_memory > self.threshold_mb:
-                    print(f"[MemoryMonitor] WARNING: Memory usage {current_memory:.1f}MB exceeds threshold {self.threshold_mb}MB")
+                    logger.warning("[MemoryMonitor] Memory usage %.1fMB exceeds threshold %sMB", current_memory, self.threshold_mb)
                     self._handle_memory_overflow()
                     break  # Exit the loop after handling overflow
                 
                 time.sleep(self.check_interval)
                 
             except Exception as e:
-                print(f"[MemoryMonitor] Error in monitoring loop: {e}")
+                logger.error("[MemoryMonitor] Error in monitoring loop: %s", e)
                 time.sleep(self.check_interval)
     
     def _get_current_memory_mb(self):
         """Returns the current memory usage in MB"""
         try:
+            # the last sample of the FSM's metrics sampler, when the experiment runs
+            fsm = getattr(self.experiment, 'fsm', None)
+            if fsm is not None and fsm.metrics.latest() is not None:
+                return fsm.metrics.latest()["rss"] / (1024 * 1024)
             process = psutil.Process(os.getpid())
             memory_info = process.memory_info()
             return memory_info.rss / (1024 * 1024)  # Conversion to MB
         except Exception as e:
-            print(f"[MemoryMonitor] Error getting memory usage: {e}")
+            logger.error("[MemoryMonitor] Error getting memory usage: %s", e)
             return 0
     
     def _show_memory_warning(self, current_memory):
@@ -134,148 +141,33 @@ When the system reaches the threshold, it will restart automatically."""
                     warning_window.lift()
                     warning_window.focus_force()
                     
-                    print(f"[MemoryMonitor] Memory warning shown: {current_memory:.1f}MB (threshold: {self.threshold_mb}MB)")
+                    logger.warning("[MemoryMonitor] Memory warning shown: %.1fMB (threshold: %sMB)", current_memory, self.threshold_mb)
                     
                 except Exception as e:
-                    print(f"[MemoryMonitor] Error showing warning: {e}")
+                    logger.error("[MemoryMonitor] Error showing warning: %s", e)
             
             # Running the message in a separate thread
             warning_thread = threading.Thread(target=show_warning, daemon=True)
             warning_thread.start()
             
         except Exception as e:
-            print(f"[MemoryMonitor] Error in _show_memory_warning: {e}")
+            logger.error("[MemoryMonitor] Error in _show_memory_warning: %s", e)
 
 
     def _handle_memory_overflow(self):
-        """Handles memory overflow above the threshold"""
-        try:
-            print("[MemoryMonitor] Handling memory overflow - saving state and restarting...")
-            
-            # Saving current state
-            self.experiment.save_minimal_state()
-            
-            # Creating restart script
-            restart_script = self._create_restart_script()
-            
-            # Restarting the experiment
-            self._restart_experiment(restart_script)
-            
-        except Exception as e:
-            print(f"[MemoryMonitor] Error during memory overflow handling: {e}")
-    
-    def _create_restart_script(self):
-        """Creates a Python script that restarts the experiment"""
-        try:
-            # Getting the full path to experiment.py
-            current_dir = os.path.dirname(os.path.abspath(__file__))
-            experiment_path = os.path.join(current_dir, "experiment.py")
-            
-            script_content = f'''#!/usr/bin/env python3
-import sys
-import os
-
-print("[RestartScript] Starting restart process...")
-print("[RestartScript] Current working directory:", os.getcwd())
-
-# Adding the current directory to PATH
-current_dir = os.path.dirname(os.path.abspath(__file__))
-sys.path.insert(0, current_dir)
-print("[RestartScript] Script directory:", current_dir)
-print("[RestartScript] Python interpreter:", sys.executable)
-
-# Checking if experiment.py exists
-experiment_path = "{experiment_path}"
-if os.path.exists(experiment_path):
-    print("[RestartScript] Found experiment.py at:", experiment_path)
-else:
-    print("[RestartScript] ERROR: experiment.py not found at:", experiment_path)
-    sys.exit(1)
-
-print("Restarting experiment automatically...")
-print(f"Experiment name: {self.experiment.txt_file_name}")
-
-# Running the experiment with full path
-cmd = f'"{sys.executable}" "{experiment_path}" --restart {self.experiment.txt_file_name}'
-print("[RestartScript] Running command:", cmd)
-
-# Changing to the correct directory and running
-os.chdir(current_dir)
-result = os.system(cmd)
-print(f"[RestartScript] Command completed with result: {{result}}")
-'''
-            
-            script_path = "restart_experiment.py"
-            with open(script_path, 'w') as f:
-                f.write(script_content)
-            
-            # Granting execution permissions to the script
-            try:
-                os.chmod(script_path, 0o755)
-                print(f"[MemoryMonitor] Made script executable: {script_path}")
-            except Exception as e:
-                print(f"[MemoryMonitor] Warning: Could not make script executable: {e}")
-            
-            print(f"[MemoryMonitor] Restart script created: {script_path}")
-            return script_path
-            
-        except Exception as e:
-            print(f"[MemoryMonitor] Error creating restart script: {e}")
-            return None
-    
-    def _restart_experiment(self, restart_script):
-        """Restarts the experiment"""
+        """
+        Handles memory overflow above the threshold: the process is replaced by a new one that resumes
+        from the checkpoint (see supervisor.py); this one ends like with the End button, closing the trial log
+        """
         try:
-            print(f"[MemoryMonitor] Restarting experiment: {self.experiment.txt_file_name}")
-            
-            # Running the script in the background from the same directory
-            if restart_script and os.path.exists(restart_script):
-                current_dir = os.path.dirname(os.path.abspath(__file__))
-                restart_script_path = os.path.join(current_dir, restart_script)
-                
-                print(f"[MemoryMonitor] Spawning restart script: {restart_script_path}")
-                print(f"[MemoryMonitor] Working directory: {current_dir}")
-                
-                # Running the script with subprocess instead of os.system
-                process = subprocess.Popen([sys.executable, restart_script_path], 
-                                        cwd=current_dir)
-                
-                # Short wait and then exit
-                time.sleep(1)
-                print("[MemoryMonitor] Restart initiated, exiting current process...")
-                
-                # Cleaning up resources before exiting
-                try:
-                    if hasattr(self.experiment, 'live_w') and self.experiment.live_w:
-                        try:
-                            self.experiment.live_w.root.destroy()
-                            time.sleep(0.1)
-                        except:
-                            pass
-                except:
-                    pass
-                
-                try:
-                    if hasattr(self.experiment, 'root') and self.experiment.root:
-                        try:
-                            self.experiment.root.quit()
-                            time.sleep(0.1)
-                        except:
-                            pass
-                except:
-                    pass
-                
-                # Small wait to allow GUI to close
-                time.sleep(0.5)
-                print("[MemoryMonitor] pre os.exist")
-                if process.poll() is None:
-                    print("Child started successfully")
-                # Exiting the current process
-                sys.exit(0)#os._exit(0)
+            logger.info("[MemoryMonitor] Handling memory overflow - saving state and restarting...")
+            self.experiment.save_checkpoint()
+            if supervisor.supervised():
+                # the supervisor stops this process once the new one is ready
+                supervisor.notify("restart", reason=f"memory {self._get_current_memory_mb():.0f} MB")
             else:
-                print("[MemoryMonitor] Restart script not found, cannot restart")
-                
+                supervisor.spawn_supervisor(self.experiment.txt_file_name)
+                logger.info("[MemoryMonitor] Restart initiated, exiting current process...")
+                os.kill(os.getpid(), signal.SIGTERM)
         except Exception as e:
-            print(f"[MemoryMonitor] Error during experiment restart: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.error("[MemoryMonitor] Error during memory overflow handling: %s", e)
@@ -0,0 +1,244 @@
+"""
+Runtime metrics of the rig process.
+
+MetricsSampler is one thread that every interval_s records RSS, USS, thread
+count, open fds, the GC generation counts and the time spent in GC since the
+previous sample, tagged with the number of trials done so far. The samples
+go to:
+- a fixed-size NumPy ring in memory (recent())
+- the session's metrics folder (<session>.metrics, next to the trial log),
+  as raw METRIC_DTYPE records in segment files of segment_records samples;
+  only the last keep_segments files are kept
+
+Summary of a session, with the trials during which the memory grew most
+(and a plot, with matplotlib):
+    python metrics_sampler.py <session .txt or .metrics folder> [--plot]
+"""
+import gc
+import glob
+import logging
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+import psutil
+
+import rig_logging
+
+METRIC_DTYPE = np.dtype([
+    ("time", "M8[ns]"),      # wall clock (UTC)
+    ("trial", "i4"),         # trials done when the sample was taken
+    ("rss", "u8"),           # bytes
+    ("uss", "u8"),           # bytes
+    ("threads", "u2"),
+    ("fds", "u4"),
+    ("gc_count", "u4", 3),   # gc.get_count() per generation
+    ("gc_collections", "u4", 3),  # collections since the start, per generation
+    ("gc_pause_ms", "f4"),   # time in the collector since the previous sample
+])
+
+
+logger = logging.getLogger("rig.metrics")
+stats_logger = logging.getLogger(rig_logging.STATS_LOGGER)  # the samples (not shown on the console)
+
+
+def metrics_path(txt_path):
+    """The metrics folder of a session's trial log"""
+    return os.path.splitext(txt_path)[0] + ".metrics"
+
+
+class GcTimer:
+    """Adds up the time spent in garbage collections (gc.callbacks)"""
+
+    def __init__(self):
+        self.total_s = 0.0
+        self.collections = [0, 0, 0]
+        self._start = None
+        gc.callbacks.append(self._callback)
+
+    def _callback(self, phase, info):
+        if phase == "start":
+            self._start = time.perf_counter()
+        elif self._start is not None:
+            self.total_s += time.perf_counter() - self._start
+            self.collections[info["generation"]] += 1
+            self._start = None
+
+    def close(self):
+        if self._callback in gc.callbacks:
+            gc.callbacks.remove(self._callback)
+
+
+class MetricsSampler:
+
+    def __init__(self, folder, trial_count=lambda: 0, interval_s=10.0, ring_size=8640,
+                 segment_records=8640, keep_segments=30):
+        """
+        folder: where the segment files go (None: ring only)
+        trial_count: returns the number of trials done so far
+        ring_size: samples kept in memory (a day at 10 s)
+        """
+        self.folder = folder
+        self.trial_count = trial_count
+        self.interval_s = interval_s
+        self.segment_records = segment_records
+        self.keep_segments = keep_segments
+        self.ring = np.zeros(ring_size, dtype=METRIC_DTYPE)
+        self.count = 0  # samples taken; the next one goes to count % ring_size
+        self.process = psutil.Process(os.getpid())
+        self.gc_timer = GcTimer()
+        self._last_gc_s = 0.0
+        self._segment = None
+        self._segment_records = 0
+        if folder is not None:
+            os.makedirs(folder, exist_ok=True)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="Metrics sampler", daemon=True)
+        self._thread.start()
+
+    def sample(self):
+        """Takes one sample now and returns it"""
+        record = np.zeros(1, dtype=METRIC_DTYPE)[0]
+        record["time"] = np.datetime64(time.time_ns(), "ns")
+        record["trial"] = self.trial_count()
+        with self.process.oneshot():
+            try:
+                memory = self.process.memory_full_info()
+                record["rss"], record["uss"] = memory.rss, memory.uss
+            except psutil.AccessDenied:
+                record["rss"] = self.process.memory_info().rss
+            record["threads"] = self.process.num_threads()
+            record["fds"] = self.process.num_fds() if hasattr(self.process, "num_fds") else 0
+        record["gc_count"] = gc.get_count()
+        record["gc_collections"] = self.gc_timer.collections
+        gc_s = self.gc_timer.total_s
+        record["gc_pause_ms"] = (gc_s - self._last_gc_s) * 1000
+        self._last_gc_s = gc_s
+        self.ring[self.count % len(self.ring)] = record
+        self.count += 1
+        stats_logger.debug("RSS %.1f MB, USS %.1f MB, %d threads, %d fds, GC %.1f ms", record["rss"] / 2**20,
+                     record["uss"] / 2**20, record["threads"], record["fds"], record["gc_pause_ms"])
+        return record
+
+    def recent(self, n=None):
+        """The last n samples (all the ring by default), oldest first, as a copy"""
+        n = min(self.count, len(self.ring) if n is None else n)
+        idx = np.arange(self.count - n, self.count) % len(self.ring)
+        return self.ring[idx]
+
+    def latest(self):
+        return self.ring[(self.count - 1) % len(self.ring)] if self.count else None
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=5)
+        self.gc_timer.close()
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                record = self.sample()
+                if self.folder is not None:
+                    self._write(record)
+            except Exception as e:
+                logger.error("Sample failed: %s", e)
+            self._stop.wait(self.interval_s)
+
+    def _write(self, record):
+        if self._segment is None or self._segment_records >= self.segment_records:
+            if self._segment is not None:
+                self._segment.close()
+            name = time.strftime("metrics_%Y%m%d_%H%M%S.bin")
+            self._segment = open(os.path.join(self.folder, name), "ab")
+            self._segment_records = 0
+            for old in sorted(glob.glob(os.path.join(self.folder, "metrics_*.bin")))[:-self.keep_segments]:
+                os.remove(old)
+        self._segment.write(record.tobytes())
+        self._segment.flush()
+        self._segment_records += 1
+
+
+def load(folder):
+    """All the samples of a metrics folder (or of a session's .txt), oldest first"""
+    if folder.endswith(".txt"):
+        folder = metrics_path(folder)
+    parts = []
+    for path in sorted(glob.glob(os.path.join(folder, "metrics_*.bin"))):
+        count = os.path.getsize(path) // METRIC_DTYPE.itemsize  # a partial last record is ignored
+        parts.append(np.fromfile(path, dtype=METRIC_DTYPE, count=count))
+    return np.concatenate(parts) if parts else np.zeros(0, dtype=METRIC_DTYPE)
+
+
+def growth_by_trial(samples, field="rss"):
+    """
+    {trial: growth (bytes)} - the change of field between consecutive samples,
+    credited to the trial in progress (the trials done at the later sample).
+    A new process (the trial count going down) starts over.
+    """
+    growth = {}
+    values = samples[field].astype(np.int64)
+    trials = samples["trial"]
+    for i in range(1, len(samples)):
+        if trials[i] < trials[i - 1]:
+            continue
+        growth[int(trials[i])] = growth.get(int(trials[i]), 0) + int(values[i] - values[i - 1])
+    return growth
+
+
+def summarize(samples, top=10):
+    """Text summary of a session's samples"""
+    if len(samples) == 0:
+        return "no samples"
+    mb = 2**20
+    hours = (samples["time"][-1] - samples["time"][0]) / np.timedelta64(1, "h")
+    rss = samples["rss"] / mb
+    lines = [
+        f"samples:   {len(samples)} from {samples['time'][0]} to {samples['time'][-1]} ({hours:.1f} h)",
+        f"trials:    {samples['trial'][0]} .. {samples['trial'][-1]}",
+        f"RSS:       start {rss[0]:.1f} MB, end {rss[-1]:.1f} MB, max {rss.max():.1f} MB"
+        + (f", {(rss[-1] - rss[0]) / hours:+.2f} MB/h" if hours > 0 else ""),
+        f"USS:       start {samples['uss'][0] / mb:.1f} MB, end {samples['uss'][-1] / mb:.1f} MB",
+        f"threads:   min {samples['threads'].min()}, max {samples['threads'].max()}",
+        f"fds:       min {samples['fds'].min()}, max {samples['fds'].max()}",
+        f"GC pauses: total {samples['gc_pause_ms'].sum():.1f} ms, max {samples['gc_pause_ms'].max():.1f} ms per sample",
+    ]
+    trials = samples["trial"].astype(float)
+    if np.ptp(trials) > 0:
+        slope = np.polyfit(trials, rss, 1)[0]
+        lines.append(f"RSS/trial: {slope * 1024:+.1f} KB per trial, r = {np.corrcoef(trials, rss)[0, 1]:.2f}")
+    growth = sorted(growth_by_trial(samples).items(), key=lambda item: -item[1])[:top]
+    if growth:
+        lines.append("largest RSS growth (trial: KB):")
+        lines.extend(f"  {trial}: {delta / 1024:+.0f}" for trial, delta in growth if delta > 0)
+    return "\n".join(lines)
+
+
+def plot(samples):
+    import matplotlib.pyplot as plt
+    fig, axes = plt.subplots(3, 1, sharex=True, figsize=(10, 8))
+    t = samples["time"]
+    axes[0].plot(t, samples["rss"] / 2**20, label="RSS")
+    axes[0].plot(t, samples["uss"] / 2**20, label="USS")
+    axes[0].set_ylabel("MB")
+    axes[0].legend()
+    axes[1].plot(t, samples["threads"], label="threads")
+    axes[1].plot(t, samples["fds"], label="fds")
+    axes[1].legend()
+    axes[2].plot(t, samples["trial"])
+    axes[2].set_ylabel("trials")
+    plt.show()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python metrics_sampler.py <session .txt or .metrics folder> [--plot]")
+        sys.exit(1)
+    samples = load(sys.argv[1])
+    print(summarize(samples))
+    if "--plot" in sys.argv and len(samples):
+        plot(samples)
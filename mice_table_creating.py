@@ -2,12 +2,16 @@ import tkinter as tk
 from tkinter import simpledialog, messagebox, ttk
 from tkinter import scrolledtext
 from tkinter import filedialog
-import serial
-import threading
+import logging
+import queue
 import General_functions
+import rfid_reader
 import pandas as pd
 from mouse import Mouse
 import os
+
+logger = logging.getLogger("rig.rfid")
+
 # Main application
 class MainApp:
     def __init__(self, master, GUI):
@@ -18,8 +22,7 @@ class MainApp:
         self.mice_list = None
         self.mice_dict = None
         self.option_vars = []
-        self.stop_event = threading.Event()
-        self.serial_thread = None
+        self.rfid_tags = None  # subscriber queue of rfid_reader, while the mice table dialog is open
         self.miceTableFrame = tk.LabelFrame(self.master)
         self.miceTableFrame.grid(row=0, column=0, padx=10, pady=10)
         self.miceBtnsFrame = tk.LabelFrame(master)
@@ -86,15 +89,13 @@ class MainApp:
         if len(self.main_GUI.levels_list) == 0:
             messagebox.showerror("Error", "You must first set levels for the experiment.")
             return
-        if self.serial_thread is not None and self.serial_thread.is_alive():
-            # Stop the existing thread if it's running
-            self.stop_event.set()
-            self.serial_thread.join()  # Wait for it to finish
-            self.stop_event.clear()  # Reset the event
-        self.stop_event.clear()  # Clear event flag
-        self.serial_thread = threading.Thread(target=self.read_from_serial)
-        self.serial_thread.start()
-        
+        self.stop_reading_tags()
+        try:
+            reader = rfid_reader.shared_reader()
+            self.rfid_tags = reader.subscribe()
+        except Exception:
+            logger.exception("Could not open the RFID reader for the mice table")
+
                 # Create a new Toplevel window
         self.parameter_window = tk.Toplevel(self.master)
         self.parameter_window.title("mice table")
@@ -123,27 +124,32 @@ class MainApp:
         self.done_button = tk.Button(self.parameter_window, text="Done", command=self.save_and_close)
         self.done_button.pack()
 
-        threading.Thread(target=self.read_from_serial, daemon=True).start()
+        self.parameter_window.protocol("WM_DELETE_WINDOW", self.close_parameter_window)
+        self.read_tags()
         # Wait for the parameter_window to close before proceeding
         self.parameter_window.wait_window()  # This makes the window modal-like
         
-    def read_from_serial(self):
-        try:
-            # Setup Serial Connection (adjust COM4 and 9600 to your needs)
-            ser = serial.Serial(port='/dev/ttyUSB0',baudrate=9600,timeout=0.01)#timeout=1  # Change '/dev/ttyS0' to the detected port
-            while not self.stop_event.is_set():#True:
-                if ser.in_waiting > 0:
-                    line = ser.readline().decode('utf-8').strip()
-                    self.display_data(line)
-        except serial.SerialException as e:
-            print(f"Serial error: {e}")
-        finally:
-            if self.serial_thread:
-                try:
-                    ser.close()
-                except Exception:
-                    pass
-                
+    def read_tags(self):
+        """Shows the tags from the RFID reader; runs in the Tk loop while the dialog is open"""
+        if self.rfid_tags is None:
+            return
+        while True:
+            try:
+                event = self.rfid_tags.get_nowait()
+            except queue.Empty:
+                break
+            self.display_data(event.tag)
+        self.parameter_window.after(100, self.read_tags)
+
+    def stop_reading_tags(self):
+        if self.rfid_tags is not None:
+            rfid_reader.shared_reader().unsubscribe(self.rfid_tags)
+            self.rfid_tags = None
+
+    def close_parameter_window(self):
+        self.stop_reading_tags()
+        self.parameter_window.destroy()
+
     def display_data(self, data):
         # Allow editing the text widget by setting it to normal
         self.data_display.config(state=tk.NORMAL)
@@ -177,7 +183,7 @@ class MainApp:
         self.unique_data_display.config(state=tk.DISABLED)
 
     def save_and_close(self):
-        self.stop_event.set()
+        self.stop_reading_tags()
         text_content = self.unique_data_display.get("1.0", tk.END).strip()
         
         # Split the content by lines
@@ -121,6 +121,16 @@ class ParametersApp:
         self.load_odor_duration_entry.pack(side=tk.LEFT, padx=10)
         self.load_odor_duration_frame.pack(anchor=tk.W,pady=10)
 
+#####################################################################
+        
+        self.inter_odor_delay_frame = tk.Frame(root)
+        self.inter_odor_delay_label = tk.Label(self.inter_odor_delay_frame, text="inter-odor delay (sec):", font=self.font_style)
+        self.inter_odor_delay_label.pack(side=tk.LEFT)
+        self.inter_odor_delay_entry = tk.Entry(self.inter_odor_delay_frame, font=self.font_style, width=5)
+        self.inter_odor_delay_entry.insert(0,"1")
+        self.inter_odor_delay_entry.pack(side=tk.LEFT, padx=10)
+        self.inter_odor_delay_frame.pack(anchor=tk.W,pady=10)
+
 #####################################################################
         
         self.timeout_punishment_frame = tk.Frame(root)
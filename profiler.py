@@ -0,0 +1,368 @@
+"""
+Profiling of the running rig, off until it is asked for.
+
+Nothing is traced while profiling is off: tracemalloc is not started, objgraph
+is not imported and no profiling thread runs, so the FSM pays nothing for it.
+It is switched on at runtime, from the live window ("Profiling" button: all
+of the below) or with a command on the control socket:
+    python profiler.py on | off | status
+    python profiler.py tracemalloc on [every N] | tracemalloc off | snapshot
+    python profiler.py diff <trial A> <trial B> [lineno|filename|traceback]
+    python profiler.py objgraph on | objgraph off | growth
+    python profiler.py cpu on [interval ms] | cpu off
+Everything goes to the session's profile folder (<session>.profile, next to
+the trial log):
+- tracemalloc/trial_<n>.snap: a snapshot after trial n (every N trials while
+  tracemalloc is on); diff A B writes diff_<A>_<B>.txt, the allocations that
+  grew the most from trial A to trial B. Offline:
+      python profiler.py --diff <profile folder> <trial A> <trial B>
+- objgraph.txt: the object types whose count grew, after every trial
+- cpu_<time>.folded / cpu_<time>.txt: a sampling profile of all the threads
+  (the stacks of every thread every interval ms, so waits show up too), in
+  the folded format of flamegraph.pl / speedscope and as a top list
+"""
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+CONTROL_SOCKET = "rig_control.sock"
+
+logger = logging.getLogger("rig.profiler")
+
+# allocations of the profiling itself and of imports, left out of the diffs
+_IGNORED = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+)
+
+
+def profile_path(txt_path):
+    """The profile folder of a session's trial log"""
+    return os.path.splitext(txt_path)[0] + ".profile"
+
+
+def _snapshot_file(folder, trial):
+    return os.path.join(folder, "tracemalloc", f"trial_{trial:06d}.snap")
+
+
+def diff_snapshots(folder, trial_a, trial_b, key="lineno", top=25):
+    """Text report of the allocations that changed most from the snapshot of trial_a to that of trial_b"""
+    before = tracemalloc.Snapshot.load(_snapshot_file(folder, trial_a)).filter_traces(_IGNORED)
+    after = tracemalloc.Snapshot.load(_snapshot_file(folder, trial_b)).filter_traces(_IGNORED)
+    stats = after.compare_to(before, key)
+    total = sum(stat.size_diff for stat in stats)
+    lines = [f"tracemalloc: trial {trial_a} -> trial {trial_b}, {total / 1024:+.1f} KiB in total",
+             f"top {top} by {key}:"]
+    for stat in stats[:top]:
+        lines.append(str(stat))
+        if key == "traceback":
+            lines.extend("    " + line for line in stat.traceback.format())
+    return "\n".join(lines)
+
+
+class CpuSampler:
+    """Samples the stack of every thread (but its own) every interval_s"""
+
+    def __init__(self, interval_s=0.01):
+        self.interval_s = interval_s
+        self.stacks = Counter()  # (thread name, frame, ..., frame) outermost first -> samples
+        self.samples = 0
+        self.started = time.time()
+        self.stopped = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="CPU sampler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval_s):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=5)
+        self.stopped = time.time()
+
+    def write(self, folder):
+        """Writes the folded stacks and the top list; returns the path of the top list"""
+        os.makedirs(folder, exist_ok=True)
+        base = os.path.join(folder, time.strftime("cpu_%Y%m%d_%H%M%S", time.localtime(self.started)))
+        with open(base + ".folded", "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(";".join(frame.replace(";", ",") for frame in stack) + f" {count}\n")
+        own = Counter()    # (thread, function) -> samples at the top of the stack
+        total = Counter()  # (thread, function) -> samples anywhere in the stack
+        for stack, count in self.stacks.items():
+            own[stack[0], stack[-1]] += count
+            for frame in set(stack[1:]):
+                total[stack[0], frame] += count
+        with open(base + ".txt", "w") as f:
+            f.write(f"{self.samples} samples every {self.interval_s * 1000:.0f} ms "
+                    f"over {(self.stopped or time.time()) - self.started:.0f} s\n\nby own samples:\n")
+            for (thread, frame), count in own.most_common(40):
+                f.write(f"{count / self.samples:7.1%}  {thread}: {frame}\n")
+            f.write("\nby total samples:\n")
+            for (thread, frame), count in total.most_common(40):
+                f.write(f"{count / self.samples:7.1%}  {thread}: {frame}\n")
+        return base + ".txt"
+
+
+class Profiler:
+
+    def __init__(self, folder, trial_count=lambda: 0, poll_s=0.5):
+        """
+        folder: the session's profile folder (created on the first output)
+        trial_count: returns the number of trials done so far
+        """
+        self.folder = folder
+        self.trial_count = trial_count
+        self.poll_s = poll_s
+        self.listeners = []  # called with active (bool) when profiling is switched on or off
+        self.snapshot_every = 0  # trials between tracemalloc snapshots (0: tracemalloc off)
+        self.objgraph = None     # the objgraph module, while growth reports are on
+        self.cpu = None
+        self._lock = threading.Lock()
+        self._watcher = None
+        self._watcher_stop = threading.Event()
+
+    @property
+    def active(self):
+        return bool(self.snapshot_every or self.objgraph or self.cpu)
+
+    def set_profiling(self, on):
+        """Switches everything on (tracemalloc every trial, objgraph, CPU) or off"""
+        if on:
+            self.start_tracemalloc()
+            try:
+                self.start_objgraph()
+            except ImportError:
+                logger.warning("objgraph is not installed, no growth reports")
+            self.start_cpu()
+        else:
+            self.stop()
+
+    def start_tracemalloc(self, every=1, nframes=10):
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(nframes)
+            self.snapshot_every = max(1, every)
+        self._changed()
+
+    def stop_tracemalloc(self):
+        with self._lock:
+            self.snapshot_every = 0
+            tracemalloc.stop()
+        self._changed()
+
+    def snapshot(self, trial=None):
+        """Saves a tracemalloc snapshot labeled with trial (the trials done so far by default)"""
+        if not tracemalloc.is_tracing():
+            raise RuntimeError("tracemalloc is off")
+        trial = self.trial_count() if trial is None else trial
+        snapshot = tracemalloc.take_snapshot()  # unfiltered: filtering is slow, it is done by the diff
+        path = _snapshot_file(self.folder, trial)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        snapshot.dump(path)
+        return path
+
+    def diff(self, trial_a, trial_b, key="lineno", top=25):
+        report = diff_snapshots(self.folder, trial_a, trial_b, key, top)
+        with open(os.path.join(self.folder, "tracemalloc", f"diff_{trial_a}_{trial_b}.txt"), "w") as f:
+            f.write(report + "\n")
+        return report
+
+    def start_objgraph(self):
+        with self._lock:
+            if self.objgraph is None:
+                import objgraph
+                objgraph.growth(limit=0)  # the baseline of the first report
+                self.objgraph = objgraph
+        self._changed()
+
+    def stop_objgraph(self):
+        with self._lock:
+            self.objgraph = None
+        self._changed()
+
+    def growth(self, limit=20):
+        """Appends to objgraph.txt the object types that grew since the last report"""
+        objgraph = self.objgraph
+        if objgraph is None:
+            raise RuntimeError("objgraph is off")
+        growth = objgraph.growth(limit=limit)
+        lines = [f"--- {time.strftime('%Y-%m-%d %H:%M:%S')}, after trial {self.trial_count()} ---"]
+        lines.extend(f"{name:<40} {count:>10} {delta:+8}" for name, count, delta in growth)
+        lines.append(f"Trial objects: {objgraph.count('Trial')}")
+        os.makedirs(self.folder, exist_ok=True)
+        with open(os.path.join(self.folder, "objgraph.txt"), "a") as f:
+            f.write("\n".join(lines) + "\n")
+        return "\n".join(lines)
+
+    def start_cpu(self, interval_s=0.01):
+        with self._lock:
+            if self.cpu is None:
+                self.cpu = CpuSampler(interval_s)
+        self._changed()
+
+    def stop_cpu(self):
+        """Stops the CPU sampler and writes its profile; returns the path of the top list (None if it was off)"""
+        with self._lock:
+            cpu, self.cpu = self.cpu, None
+        if cpu is None:
+            return None
+        cpu.stop()
+        path = cpu.write(self.folder)
+        self._changed()
+        return path
+
+    def stop(self):
+        """Switches everything off, writing the CPU profile"""
+        self.stop_cpu()
+        self.stop_objgraph()
+        if self.snapshot_every or tracemalloc.is_tracing():
+            self.stop_tracemalloc()
+
+    def status(self):
+        parts = [f"tracemalloc every {self.snapshot_every} trials" if self.snapshot_every else "tracemalloc off",
+                 "objgraph on" if self.objgraph else "objgraph off",
+                 f"cpu on ({self.cpu.samples} samples)" if self.cpu else "cpu off"]
+        return f"trial {self.trial_count()}: " + ", ".join(parts) + f" -> {self.folder}"
+
+    def command(self, line):
+        """Runs a control command (see the module docstring); returns the reply text"""
+        words = line.split()
+        try:
+            if words == ["status"]:
+                pass
+            elif words in (["on"], ["off"]):
+                self.set_profiling(words[0] == "on")
+            elif words[:2] == ["tracemalloc", "on"]:
+                self.start_tracemalloc(int(words[3]) if words[2:3] == ["every"] else 1)
+            elif words == ["tracemalloc", "off"]:
+                self.stop_tracemalloc()
+            elif words == ["snapshot"]:
+                return self.snapshot()
+            elif words[:1] == ["diff"] and len(words) in (3, 4):
+                return self.diff(int(words[1]), int(words[2]), *words[3:])
+            elif words == ["objgraph", "on"]:
+                self.start_objgraph()
+            elif words == ["objgraph", "off"]:
+                self.stop_objgraph()
+            elif words == ["growth"]:
+                return self.growth()
+            elif words[:2] == ["cpu", "on"]:
+                self.start_cpu(float(words[2]) / 1000 if len(words) > 2 else 0.01)
+            elif words == ["cpu", "off"]:
+                return self.stop_cpu() or "cpu was off"
+            else:
+                return f"unknown command: {line.strip()}"
+        except Exception as e:
+            return f"error: {type(e).__name__}: {e}"
+        return self.status()
+
+    def _changed(self):
+        """Starts the trial watcher while anything is on (stops it otherwise) and tells the listeners"""
+        active = self.active
+        if active and self._watcher is None:
+            self._watcher_stop.clear()
+            self._watcher = threading.Thread(target=self._watch, name="Profiler", daemon=True)
+            self._watcher.start()
+        elif not active and self._watcher is not None:
+            self._watcher_stop.set()
+            if self._watcher is not threading.current_thread():
+                self._watcher.join(timeout=5)
+            self._watcher = None
+        for listener in self.listeners:
+            try:
+                listener(active)
+            except Exception as e:
+                logger.error("Listener failed: %s", e)
+
+    def _watch(self):
+        """The per-trial reports, taken when the trial count changes"""
+        last = self.trial_count()
+        while not self._watcher_stop.wait(self.poll_s):
+            trial = self.trial_count()
+            if trial == last:
+                continue
+            last = trial
+            try:
+                if self.snapshot_every and trial % self.snapshot_every == 0:
+                    self.snapshot(trial)
+                if self.objgraph is not None:
+                    self.growth()
+            except Exception as e:
+                logger.error("Report after trial %d failed: %s", trial, e)
+
+
+class ControlServer:
+    """Runs the profiler commands sent to a Unix socket, one command per connection"""
+
+    def __init__(self, profiler, path=CONTROL_SOCKET):
+        self.profiler = profiler
+        self.path = path
+        if os.path.exists(path):
+            os.remove(path)  # left by a process that did not exit cleanly
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(path)
+        os.chmod(path, 0o600)
+        self._socket.listen()
+        self._thread = threading.Thread(target=self._run, name="Profiler control", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                connection, _ = self._socket.accept()
+            except OSError:
+                return  # closed
+            with connection:
+                try:
+                    connection.settimeout(5)
+                    line = connection.makefile("r").readline()
+                    connection.sendall(self.profiler.command(line).encode() + b"\n")
+                except OSError as e:
+                    logger.warning("Control connection failed: %s", e)
+
+    def close(self):
+        self._socket.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def send(command, path=CONTROL_SOCKET, timeout=60):
+    """Sends one command to a running rig; returns the reply"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(path)
+        s.sendall(command.encode() + b"\n")
+        return s.makefile("r").read().rstrip("\n")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 5 and sys.argv[1] == "--diff":
+        print(diff_snapshots(sys.argv[2], int(sys.argv[3]), int(sys.argv[4])))
+    elif len(sys.argv) > 1:
+        print(send(" ".join(sys.argv[1:])))
+    else:
+        print(__doc__)
+        sys.exit(1)
@@ -0,0 +1,157 @@
+"""
+The RFID reader service.
+
+RfidReader is the only code that reads the RFID serial port. Its thread blocks
+on the port's fd (select), splits the bytes into frames, validates the tags and
+publishes every new tag as a TagEvent to the subscribers (the FSM, the mice
+table dialog, ...).
+The reader keeps reporting a tag while the mouse is at the antenna, so repeated
+reads of the same tag within dedupe_s of its last published event are dropped.
+"""
+import logging
+import os
+import queue
+import re
+import select
+import threading
+import time
+from collections import namedtuple
+
+import hardware
+
+logger = logging.getLogger("rig.rfid")
+
+TagEvent = namedtuple("TagEvent", ["tag", "timestamp_ns"])  # time.monotonic_ns() of the read
+
+TAG_PATTERN = re.compile(r"[0-9A-Za-z]{4,32}")  # e.g. 0007DECB4A
+FRAME_END = b"\n"
+FRAME_JUNK = b"\r\x02\x03 \t"  # line ending, STX/ETX of readers that send them, spaces
+
+
+class RfidReader:
+
+    def __init__(self, port, dedupe_s=1.0, poll_timeout=0.5):
+        """
+        port: an object with rfid_in_waiting/rfid_readline/rfid_fileno
+              (a hardware.HardwareBackend or hardware.SerialRfidPort)
+        dedupe_s: repeated reads of a tag within this window are not published
+        """
+        self.port = port
+        self.dedupe_s = dedupe_s
+        self.poll_timeout = poll_timeout  # only bounds how long stop() waits for the thread
+        self.listeners = []  # extra callback(TagEvent), called from the reader thread
+        self._subscribers = []
+        self._subscribers_lock = threading.Lock()
+        self._last_published = {}  # tag -> time.monotonic_ns() of its last event
+        self._buffer = b""
+        self._stop = threading.Event()
+        self._wake_r, self._wake_w = os.pipe()  # stop() wakes the select with a byte
+        self._thread = threading.Thread(target=self._run, name="RFID reader", daemon=True)
+        self._thread.start()
+
+    # ---- subscribers ----
+    def subscribe(self, maxsize=100):
+        """Returns a queue.Queue that gets every TagEvent from now on"""
+        q = queue.Queue(maxsize)
+        with self._subscribers_lock:
+            self._subscribers.append(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self._subscribers_lock:
+            if q in self._subscribers:
+                self._subscribers.remove(q)
+
+    @staticmethod
+    def drain(q):
+        """Drops the events waiting in a subscriber queue"""
+        while True:
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                return
+
+    # ---- reading ----
+    def _run(self):
+        try:
+            fd = self.port.rfid_fileno()
+        except Exception as e:
+            logger.error("No RFID port: %s", e)
+            return
+        while not self._stop.is_set():
+            try:
+                readable, _, _ = select.select([fd, self._wake_r], [], [], self.poll_timeout)
+                if fd not in readable:
+                    continue
+                while self.port.rfid_in_waiting() > 0:
+                    self._feed(self.port.rfid_readline())
+            except Exception as e:
+                if self._stop.is_set():
+                    return
+                logger.error("Error reading RFID: %s", e)
+                self._stop.wait(self.poll_timeout)
+
+    def _feed(self, data):
+        """Adds raw bytes from the port; readline() may return a partial frame on its timeout"""
+        self._buffer += data
+        *frames, self._buffer = self._buffer.split(FRAME_END)
+        for frame in frames:
+            tag = self.parse_frame(frame)
+            if tag is not None:
+                self._on_tag(tag, time.monotonic_ns())
+
+    @staticmethod
+    def parse_frame(frame):
+        """Returns the tag of one frame (without the line ending), or None if it is not a valid tag"""
+        try:
+            tag = frame.strip(FRAME_JUNK).decode("ascii")
+        except UnicodeDecodeError:
+            logger.debug("Dropped a non-ASCII frame: %r", frame)
+            return None
+        if not TAG_PATTERN.fullmatch(tag):
+            if tag:
+                logger.debug("Dropped an invalid tag: %r", tag)
+            return None
+        return tag
+
+    def _on_tag(self, tag, timestamp_ns):
+        last_ns = self._last_published.get(tag)
+        if last_ns is not None and timestamp_ns - last_ns < self.dedupe_s * 1e9:
+            return
+        self._last_published[tag] = timestamp_ns
+        event = TagEvent(tag, timestamp_ns)
+        with self._subscribers_lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                pass  # a subscriber that does not read must not block the others
+        for listener in self.listeners:
+            listener(event)
+
+    def stop(self):
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        os.write(self._wake_w, b"\0")
+        self._thread.join(timeout=2 * self.poll_timeout)
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+
+_shared_reader = None
+_shared_lock = threading.Lock()
+
+
+def shared_reader(port=None, **kwargs):
+    """
+    The process-wide reader of the rig's RFID port, created on the first call
+    (with port, or a new hardware.SerialRfidPort).
+    The mice table dialog and the FSM both use it, so the port is opened once.
+    """
+    global _shared_reader
+    with _shared_lock:
+        if _shared_reader is None:
+            _shared_reader = RfidReader(port if port is not None else hardware.SerialRfidPort(), **kwargs)
+        return _shared_reader
@@ -0,0 +1,149 @@
+"""
+Logging of the rig (FSM, memory monitor, GUI).
+
+setup_logging() puts one QueueHandler on the "rig" logger, so a log call only
+builds a record and puts it on a queue; a QueueListener thread formats it and
+writes it to:
+- LOG_FILE, one JSON object per line, rotated when it reaches max_bytes or
+  at midnight; rotated files are gzipped and the last backup_count are kept
+- the console, as plain text (like the prints it replaces), except the
+  periodic numbers of the STATS_LOGGER loggers
+
+Modules log to children of "rig" (logging.getLogger("rig.fsm") ...). Records
+carry the current context (set_context(mouse=..., trial=...)) as JSON fields,
+plus any extra={...} fields of the call. With %-style arguments a call below
+the logger's level returns after one level check, without formatting.
+"""
+import atexit
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import threading
+import time
+from datetime import datetime
+
+LOG_DIR = "logs"
+LOG_FILE = os.path.join(LOG_DIR, "rig.jsonl")
+STATS_LOGGER = "rig.stats"
+
+# Attributes of every LogRecord; anything else on a record came from extra={...}
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "context"}
+
+_context = {}
+_context_lock = threading.Lock()
+_listener = None
+
+
+def set_context(**fields):
+    """Adds fields (None removes one) to the context of the records logged from now on, from any thread"""
+    global _context
+    with _context_lock:
+        context = dict(_context)
+        for key, value in fields.items():
+            if value is None:
+                context.pop(key, None)
+            else:
+                context[key] = value
+        _context = context  # replaced, never changed in place: records keep the dict they got
+
+
+def clear_context(*keys):
+    set_context(**{key: None for key in keys})
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """Queues the record with the current context; the formatting is left to the listener thread"""
+
+    def prepare(self, record):
+        record.context = _context
+        # the message is built now: the arguments may change after the call
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_text = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="microseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "context", {}))
+        entry.update({key: value for key, value in vars(record).items() if key not in _RECORD_ATTRS})
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class RotatingJsonlHandler(logging.handlers.RotatingFileHandler):
+    """Rotates at max_bytes or when the day changes; the rotated files are gzipped"""
+
+    def __init__(self, filename, max_bytes, backup_count):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True)
+        self.namer = lambda name: name + ".gz"
+        self.rotator = self._gzip
+        self._day = time.localtime().tm_yday
+
+    def shouldRollover(self, record):
+        if time.localtime(record.created).tm_yday != self._day:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        self._day = time.localtime().tm_yday
+        super().doRollover()
+
+    @staticmethod
+    def _gzip(source, dest):
+        with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(source)
+
+
+def setup_logging(level=logging.INFO, log_file=LOG_FILE, max_bytes=10 * 2**20, backup_count=20, console=True):
+    """Starts the logging thread (once per process). Returns the "rig" logger"""
+    global _listener
+    logger = logging.getLogger("rig")
+    logger.setLevel(level)
+    if _listener is not None:
+        return logger
+    os.makedirs(os.path.dirname(log_file) or ".", exist_ok=True)
+    file_handler = RotatingJsonlHandler(log_file, max_bytes, backup_count)
+    file_handler.setFormatter(JsonFormatter())
+    handlers = [file_handler]
+    if console:
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(logging.Formatter("%(message)s"))
+        console_handler.addFilter(lambda record: not record.name.startswith(STATS_LOGGER))
+        handlers.append(console_handler)
+    log_queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    logger.addHandler(ContextQueueHandler(log_queue))
+    logger.propagate = False
+    atexit.register(shutdown_logging)
+    return logger
+
+
+def shutdown_logging():
+    """Writes the queued records and stops the logging thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+        logger = logging.getLogger("rig")
+        for handler in list(logger.handlers):
+            if isinstance(handler, ContextQueueHandler):
+                logger.removeHandler(handler)
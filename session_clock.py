@@ -0,0 +1,46 @@
+import time
+from datetime import datetime
+
+
+class SessionClock:
+    """
+    Time base of a session.
+    All in-trial events are stored as integer nanosecond offsets from the session
+    anchor (a time.monotonic_ns() reading), so they are immune to NTP slews and
+    midnight. The anchor is paired once with the wall clock, and offsets are
+    mapped back to wall time only when they are written out.
+    """
+
+    def __init__(self):
+        self.anchor_monotonic_ns = time.monotonic_ns()
+        self.anchor_wall_ns = time.time_ns()
+
+    def now(self) -> int:
+        """Offset (ns) of the current moment"""
+        return time.monotonic_ns() - self.anchor_monotonic_ns
+
+    def offset(self, monotonic_ns: int) -> int:
+        """Offset (ns) of a time.monotonic_ns() timestamp, e.g. a GPIO edge"""
+        return monotonic_ns - self.anchor_monotonic_ns
+
+    def to_monotonic(self, offset_ns):
+        """time.monotonic_ns() timestamp of an offset (None stays None)"""
+        if offset_ns is None:
+            return None
+        return self.anchor_monotonic_ns + offset_ns
+
+    def to_datetime(self, offset_ns: int) -> datetime:
+        """Wall-clock time of an offset"""
+        return datetime.fromtimestamp((self.anchor_wall_ns + offset_ns) / 1e9)
+
+    def to_wall_ns(self, offset_ns):
+        """Wall-clock ns since the epoch of an offset (None stays None)"""
+        if offset_ns is None:
+            return None
+        return self.anchor_wall_ns + offset_ns
+
+    def to_time_str(self, offset_ns):
+        """Legacy 'HH:MM:SS.ffffff' format of the trial log (None stays None)"""
+        if offset_ns is None:
+            return None
+        return self.to_datetime(offset_ns).strftime('%H:%M:%S.%f')
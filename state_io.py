@@ -1,75 +1,241 @@
-import pickle
+"""
+Checkpoint of a session, for restarting it where it stopped.
+
+The checkpoint is the folder experiments/<exp name>/checkpoint with two JSON
+files, each replaced atomically (written to a .tmp file, fsynced, renamed
+over the old one), so a crash leaves either the old or the new version:
+- SESSION_FILE: what the session was started with - exp_params, the levels
+  table (pandas "table" JSON, with its dtypes) and the mice. Saved when the
+  parameters are set.
+- PROGRESS_FILE: where the session is - trials done, the level of every
+  mouse, the planned trials and the state of the planner's RNG. Saved after
+  every trial by a Checkpointer thread, after the trial log is flushed, so
+  it is never ahead of the trials on disk.
+Both carry SCHEMA_VERSION; a newer file than this code can read is refused
+rather than misread.
+
+Sessions saved before the checkpoint (minimal_state.pkl) are still loaded.
+"""
+import json
+import logging
 import os
-from typing import Dict, Any, Optional
-import pandas as pd
+import pickle
+import threading
+import time
+from collections import namedtuple
+from io import StringIO
 
-def save_minimal_state(exp_name: str, exp_params, levels_df, mice_dict, txt_file_name: str, txt_file_path: str, user_email: str = "") -> str:
-    """
-    שומר את המצב המינימלי של הניסוי בתיקיית הניסוי
-    מחזיר את הנתיב שבו נשמר המצב
-    """
-    try:
-        # יצירת תיקיית הניסוי אם לא קיימת
-        folder_path = os.path.join(os.getcwd(), "experiments", exp_name)
-        os.makedirs(folder_path, exist_ok=True)
-        
-        # נתיב לקובץ המצב
-        state_file_path = os.path.join(folder_path, "minimal_state.pkl")
-        
-        # הכנת הנתונים לשמירה
-        state_data = {
-            'exp_params': exp_params,
-            'levels_df': levels_df,
-            'mice_dict': mice_dict,
-            'txt_file_name': txt_file_name,
-            'txt_file_path': txt_file_path,
-            'user_email': user_email,
-        }
-        
-        # שמירה עם pickle
-        with open(state_file_path, 'wb') as f:
-            pickle.dump(state_data, f)
-        
-        print(f"State saved to: {state_file_path}")
-        return state_file_path
-        
-    except Exception as e:
-        print(f"Error saving state: {e}")
+from mouse import Mouse
+from trial_planner import TrialPlan
+
+SCHEMA_VERSION = 1
+CHECKPOINT_DIR = "checkpoint"
+SESSION_FILE = "session.json"
+PROGRESS_FILE = "progress.json"
+LEGACY_STATE_FILE = "minimal_state.pkl"
+
+logger = logging.getLogger("rig.checkpoint")
+
+# progress of a session; trial_plans: {mouse id: [TrialPlan, ...]}, rng_state: random.Random.getstate() or None
+Progress = namedtuple("Progress", ["trial_count", "mice_levels", "trial_plans", "rng_state", "saved_at"])
+# what load_state() returns; progress is None if no trial was saved
+SessionState = namedtuple("SessionState", ["exp_params", "levels_df", "mice_dict", "txt_file_name",
+                                           "txt_file_path", "user_email", "progress"])
+
+
+def experiment_folder(exp_name):
+    return os.path.join(os.getcwd(), "experiments", exp_name)
+
+
+def checkpoint_path(exp_folder):
+    """The checkpoint folder of an experiment folder (the folder of its trial log)"""
+    return os.path.join(exp_folder, CHECKPOINT_DIR)
+
+
+def _json_default(value):
+    if hasattr(value, "item"):  # NumPy scalars
+        return value.item()
+    return str(value)
+
+
+def write_json_atomic(path, data):
+    """Writes data to path as JSON: temporary file, fsync, rename, fsync of the folder"""
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, default=_json_default, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    if hasattr(os, "O_DIRECTORY"):  # the rename itself survives a power cut (not on Windows)
+        fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def _read_json(path, kind):
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if data.get("kind") != kind:
+        raise ValueError(f"{path} is not a {kind} checkpoint")
+    if data.get("version", 0) > SCHEMA_VERSION:
+        raise ValueError(f"{path} has version {data['version']}; this code reads up to {SCHEMA_VERSION}")
+    return data
+
+
+def save_session(exp_name, exp_params, levels_df, mice_dict, txt_file_name, txt_file_path, user_email=""):
+    """Saves what the session is started with. Returns the path of the file"""
+    folder = checkpoint_path(experiment_folder(exp_name))
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, SESSION_FILE)
+    write_json_atomic(path, {
+        "kind": "session",
+        "version": SCHEMA_VERSION,
+        "saved_at": time.time(),
+        "exp_params": exp_params,
+        "levels": json.loads(levels_df.to_json(orient="table", index=False)),
+        "mice": {mouse_id: str(mouse.get_level()) for mouse_id, mouse in mice_dict.items()},
+        "txt_file_name": txt_file_name,
+        "txt_file_path": txt_file_path,
+        "user_email": user_email,
+    })
+    return path
+
+
+def progress_of(trial_count, mice_dict, trial_plans, rng_state):
+    """A Progress of the running session (cheap: for the FSM thread)"""
+    return Progress(trial_count, {mouse_id: str(mouse.get_level()) for mouse_id, mouse in mice_dict.items()},
+                    trial_plans, rng_state, time.time())
+
+
+def save_progress(folder, progress):
+    """folder: the checkpoint folder"""
+    os.makedirs(folder, exist_ok=True)
+    write_json_atomic(os.path.join(folder, PROGRESS_FILE), {
+        "kind": "progress",
+        "version": SCHEMA_VERSION,
+        "saved_at": progress.saved_at,
+        "trial_count": progress.trial_count,
+        "mice_levels": progress.mice_levels,
+        "trial_plans": {mouse_id: [list(plan) for plan in plans] for mouse_id, plans in progress.trial_plans.items()},
+        "rng_state": progress.rng_state,
+    })
+
+
+def load_progress(folder):
+    """The Progress saved in a checkpoint folder, or None if none was saved"""
+    path = os.path.join(folder, PROGRESS_FILE)
+    if not os.path.exists(path):
         return None
+    data = _read_json(path, "progress")
+    rng_state = data["rng_state"]
+    if rng_state is not None:
+        version, internal, gauss_next = rng_state
+        rng_state = (version, tuple(internal), gauss_next)
+    return Progress(
+        trial_count=data["trial_count"],
+        mice_levels=data["mice_levels"],
+        trial_plans={mouse_id: [TrialPlan(*plan) for plan in plans] for mouse_id, plans in data["trial_plans"].items()},
+        rng_state=rng_state,
+        saved_at=data["saved_at"],
+    )
 
-def load_minimal_state(exp_name: str) -> Optional[Dict[str, Any]]:
+
+def load_state(exp_name):
     """
-    טוען את המצב המינימלי של הניסוי מתיקיית הניסוי
-    מחזיר None אם לא נמצא קובץ מצב
+    The SessionState of a session (from its checkpoint, or from minimal_state.pkl
+    for older sessions), or None if there is none. Raises ValueError for a file
+    of a newer schema or a corrupted one.
     """
-    try:
-        # נתיב לקובץ המצב
-        folder_path = os.path.join(os.getcwd(), "experiments", exp_name)
-        state_file_path = os.path.join(folder_path, "minimal_state.pkl")
-        
-        # בדיקה אם קובץ המצב קיים
-        if not os.path.exists(state_file_path):
-            print(f"No state file found at: {state_file_path}")
-            return None
-        
-        # טעינת המצב
-        with open(state_file_path, 'rb') as f:
-            state_data = pickle.load(f)
-        
-        print(f"State loaded from: {state_file_path}")
-        return state_data
-        
-    except Exception as e:
-        print(f"Error loading state: {e}")
+    folder = checkpoint_path(experiment_folder(exp_name))
+    path = os.path.join(folder, SESSION_FILE)
+    if not os.path.exists(path):
+        return _load_legacy_state(exp_name)
+    import pandas as pd  # not needed by the FSM process, which only saves
+    data = _read_json(path, "session")
+    progress = load_progress(folder)
+    levels = progress.mice_levels if progress is not None else data["mice"]
+    return SessionState(
+        exp_params=data["exp_params"],
+        levels_df=pd.read_json(StringIO(json.dumps(data["levels"])), orient="table"),
+        mice_dict={mouse_id: Mouse(mouse_id, level) for mouse_id, level in levels.items()},
+        txt_file_name=data["txt_file_name"],
+        txt_file_path=data["txt_file_path"],
+        user_email=data["user_email"],
+        progress=progress,
+    )
+
+
+def _load_legacy_state(exp_name):
+    path = os.path.join(experiment_folder(exp_name), LEGACY_STATE_FILE)
+    if not os.path.exists(path):
         return None
+    with open(path, 'rb') as f:
+        data = pickle.load(f)
+    plans = data.get('trial_plans')
+    return SessionState(data['exp_params'], data['levels_df'], data['mice_dict'], data['txt_file_name'],
+                        data['txt_file_path'], data.get('user_email', ""),
+                        None if plans is None else Progress(0, {}, plans, None, None))
+
 
 def check_if_restart_available(exp_name: str) -> bool:
+    """True if the session has a checkpoint (or an older minimal_state.pkl)"""
+    return (os.path.exists(os.path.join(checkpoint_path(experiment_folder(exp_name)), SESSION_FILE))
+            or os.path.exists(os.path.join(experiment_folder(exp_name), LEGACY_STATE_FILE)))
+
+
+class Checkpointer:
     """
-    בודק אם יש קובץ מצב זמין לניסוי מסוים
+    Saves the progress of a session on its own thread. submit() only stores the
+    progress; the thread saves the latest one (older ones not saved yet are
+    skipped), after calling before_save (e.g. TrialWriter.flush).
     """
-    try:
-        folder_path = os.path.join(os.getcwd(), "experiments", exp_name)
-        state_file_path = os.path.join(folder_path, "minimal_state.pkl")
-        return os.path.exists(state_file_path)
-    except:
-        return False
+
+    def __init__(self, folder, before_save=None):
+        """folder: the checkpoint folder"""
+        self.folder = folder
+        self.before_save = before_save
+        self._pending = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="Checkpointer", daemon=True)
+        self._thread.start()
+
+    def submit(self, progress):
+        with self._lock:
+            self._pending = progress
+            self._idle.clear()
+        self._wake.set()
+
+    def flush(self, timeout=None):
+        """Waits until the last submitted progress is saved. False on timeout"""
+        return self._idle.wait(timeout)
+
+    def close(self, timeout=10.0):
+        """Saves the last submitted progress and stops the thread"""
+        self._stopped = True
+        self._wake.set()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            with self._lock:
+                progress, self._pending = self._pending, None
+            if progress is not None:
+                try:
+                    if self.before_save is not None:
+                        self.before_save()
+                    save_progress(self.folder, progress)
+                except (OSError, TypeError, ValueError) as e:
+                    logger.error("Could not save the progress: %s", e)
+            with self._lock:
+                if self._pending is None:
+                    self._idle.set()
+            if self._stopped and self._pending is None:
+                return
@@ -0,0 +1,202 @@
+"""
+Stimulus bank: all the stimuli of a folder in one packed raw PCM file.
+
+np.load(..., mmap_mode='r') is ignored for .npz archives, so every stimulus
+used to be decompressed into RAM. The bank stores the samples as float32 in
+one file (BANK_FILE) that is memory-mapped, with a JSON index (INDEX_FILE) of
+name -> offset, length, sample rate and sha256 of the samples.
+Only the pages of the stimuli that are used become resident; the last
+cache_size stimuli that were read are kept in RAM (LRU).
+
+The bank is built only by the converter, from the .npz/.npy files of the folder:
+    python stimulus_bank.py [folder] [--rate FILE=HZ ...]
+A .npy file has no sample rate; its rate is read from SAMPLERATES_FILE in the
+folder ({"file.npy": rate in Hz}), where --rate also records it. A .npy file
+without a rate is skipped rather than packed with a guessed one.
+The bank files are not tracked by git (.gitignore). open_bank() never builds
+the bank; when it is missing or stale the stimuli are read from their files.
+"""
+import glob
+import hashlib
+import json
+import logging
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+BANK_FILE = "stimuli.bank"
+INDEX_FILE = "stimuli_bank.json"
+SAMPLERATES_FILE = "samplerates.json"
+DTYPE = np.float32
+ALIGN = 64  # bytes, every stimulus starts on a cache line
+DOWNMIX = "mean"  # multi-channel sources are averaged to mono; banks built otherwise are stale
+
+logger = logging.getLogger("rig.stimuli")
+
+
+def npy_samplerates(folder):
+    """{file name: rate} of the .npy files of folder (SAMPLERATES_FILE)"""
+    try:
+        with open(os.path.join(folder, SAMPLERATES_FILE)) as f:
+            return {name: int(rate) for name, rate in json.load(f).items()}
+    except FileNotFoundError:
+        return {}
+
+
+def _load_source(path, npy_samplerates):
+    """Returns (samples, samplerate) of a .npz (data/noise + rate/Fs) or .npy file"""
+    if path.endswith(".npy"):
+        samplerate = npy_samplerates.get(os.path.basename(path))
+        if samplerate is None:
+            raise ValueError(f"no sample rate in {SAMPLERATES_FILE}")
+        return np.load(path), samplerate
+    with np.load(path) as z:
+        data = z["noise"] if "noise" in z.files else z["data"]
+        samplerate = int(z["Fs"] if "Fs" in z.files else z["rate"])
+    return data, samplerate
+
+
+def _sources(folder, npy_samplerates):
+    """The files the bank is built from: the .npz files and the .npy files with a known rate"""
+    npy = [path for path in glob.glob(os.path.join(folder, "*.npy")) if os.path.basename(path) in npy_samplerates]
+    return sorted(glob.glob(os.path.join(folder, "*.npz")) + npy)
+
+
+def build_bank(folder="stimuli", samplerates=None):
+    """
+    Packs the .npz/.npy files of folder into BANK_FILE + INDEX_FILE. Returns the index.
+    samplerates: {file name: rate} of .npy files, added to SAMPLERATES_FILE
+    """
+    rates = npy_samplerates(folder)
+    if samplerates:
+        rates.update(samplerates)
+        with open(os.path.join(folder, SAMPLERATES_FILE), "w") as f:
+            json.dump(rates, f, indent=1, sort_keys=True)
+    for path in sorted(glob.glob(os.path.join(folder, "*.npy"))):
+        if os.path.basename(path) not in rates:
+            print(f"[StimulusBank] Skipped {path}: no sample rate (--rate {os.path.basename(path)}=HZ)")
+    entries = {}
+    bank_path = os.path.join(folder, BANK_FILE)
+    tmp_path = bank_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        for path in _sources(folder, rates):
+            try:
+                data, samplerate = _load_source(path, rates)
+            except Exception as e:
+                print(f"[StimulusBank] Skipped {path}: {e}")
+                continue
+            samples = np.asarray(data, dtype=DTYPE)
+            if samples.ndim > 1:
+                samples = samples.mean(axis=1)  # the same downmix as audio_engine.load_sound
+            samples = np.ascontiguousarray(samples)
+            f.write(b"\0" * (-f.tell() % ALIGN))
+            offset = f.tell()
+            raw = samples.tobytes()
+            f.write(raw)
+            stat = os.stat(path)
+            entries[os.path.basename(path)] = {
+                "offset": offset,             # bytes
+                "length": len(samples),       # samples
+                "samplerate": samplerate,
+                "sha256": hashlib.sha256(raw).hexdigest(),
+                "source_mtime_ns": stat.st_mtime_ns,
+                "source_size": stat.st_size,
+            }
+    os.replace(tmp_path, bank_path)
+    index = {"dtype": np.dtype(DTYPE).str, "downmix": DOWNMIX, "stimuli": entries}
+    index_path = os.path.join(folder, INDEX_FILE)
+    with open(index_path + ".tmp", "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(index_path + ".tmp", index_path)  # the index last: a bank with an index is complete
+    print(f"[StimulusBank] Packed {len(entries)} stimuli into {bank_path}")
+    return index
+
+
+def is_stale(folder="stimuli"):
+    """True if the bank is missing or a source file was added or changed since it was built"""
+    try:
+        with open(os.path.join(folder, INDEX_FILE)) as f:
+            index = json.load(f)
+        entries = index["stimuli"]
+    except (OSError, ValueError, KeyError):
+        return True
+    if index.get("downmix") != DOWNMIX:
+        return True
+    if not os.path.exists(os.path.join(folder, BANK_FILE)):
+        return True
+    for path in _sources(folder, npy_samplerates(folder)):
+        entry = entries.get(os.path.basename(path))
+        stat = os.stat(path)
+        if entry is None or entry["source_mtime_ns"] != stat.st_mtime_ns or entry["source_size"] != stat.st_size:
+            return True
+    return False
+
+
+class StimulusBank:
+
+    def __init__(self, folder="stimuli", cache_size=8):
+        with open(os.path.join(folder, INDEX_FILE)) as f:
+            index = json.load(f)
+        self.entries = index["stimuli"]
+        self._pcm = np.memmap(os.path.join(folder, BANK_FILE), dtype=np.dtype(index["dtype"]), mode="r")
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # name -> samples in RAM, most recently used last
+
+    def names(self):
+        return list(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def samplerate(self, name):
+        return self.entries[name]["samplerate"]
+
+    def view(self, name):
+        """The samples of a stimulus as a read-only view of the mapped file (nothing is read until used)"""
+        entry = self.entries[name]
+        start = entry["offset"] // self._pcm.itemsize
+        return self._pcm[start:start + entry["length"]]
+
+    def get(self, name):
+        """Returns (samples, samplerate); the samples stay in RAM while the stimulus is among the last cache_size used"""
+        samples = self._cache.get(name)
+        if samples is None:
+            samples = np.array(self.view(name))
+            samples.flags.writeable = False
+            self._cache[name] = samples
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(name)
+        return samples, self.samplerate(name)
+
+    def verify(self, name):
+        """True if the stored samples match the checksum of the index"""
+        return hashlib.sha256(self.view(name).tobytes()).hexdigest() == self.entries[name]["sha256"]
+
+
+def open_bank(folder="stimuli", cache_size=8):
+    """The StimulusBank of folder, or None if it was not built or is stale (python stimulus_bank.py builds it)"""
+    try:
+        if is_stale(folder):
+            logger.info("No up-to-date stimulus bank in %s, the stimuli are read from their files", folder)
+            return None
+        return StimulusBank(folder, cache_size)
+    except (OSError, ValueError) as e:
+        logger.warning("Could not open the stimulus bank of %s: %s", folder, e)
+        return None
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Packs the stimuli of a folder into its stimulus bank")
+    parser.add_argument("folder", nargs="?", default="stimuli")
+    parser.add_argument("--rate", action="append", default=[], metavar="FILE=HZ",
+                        help="the sample rate of a .npy file (kept in samplerates.json)")
+    args = parser.parse_args()
+    rates = {}
+    for item in args.rate:
+        name, _, rate = item.partition("=")
+        rates[name] = int(rate)
+    build_bank(args.folder, rates)
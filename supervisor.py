@@ -0,0 +1,345 @@
+"""
+Supervisor of the rig process.
+
+    python supervisor.py [--restart <exp name>] [--threshold-mb 450] [--max-restarts 5]
+    python supervisor.py --headless <config file> | --headless --restart <exp name>
+
+runs experiment.py (or headless.py) as a child and restarts it from the session checkpoint
+(state_io) when it:
+- uses more than threshold_mb of RSS, or asks for a restart (MemoryMonitor)
+- stops sending heartbeats (the Tk main loop sends one every second)
+- stays in a state other than Idle longer than stuck_s (a stuck trial)
+- exits with an error
+An exit with code 0 that was not asked for is the end of the experiment, and
+the supervisor exits too.
+
+A restart is warm: a standby child (experiment.py --standby) is started while
+the old one is still running trials and waits, with everything imported, for
+the name of the session on its stdin. Only then the old child is stopped
+(SIGTERM: it closes the trial log and the checkpoint and exits) and the
+standby resumes from the checkpoint, so the rig is down for about the time it
+takes to build the experiment, not to start Python. The downtime of every
+restart is logged (downtime_s) to SUPERVISOR_LOG_FILE.
+
+Restarts after a crash wait backoff_s, doubled for every child that did not
+live min_uptime_s, up to max_backoff_s; after max_restarts restarts within
+restart_window_s the supervisor gives up.
+
+The child side: a child reports to the supervisor with notify() over the pipe
+in RIG_SUPERVISOR_FD; notify() does nothing in an unsupervised process.
+"""
+import json
+import logging
+import os
+import select
+import signal
+import subprocess
+import sys
+import time
+from collections import deque
+
+import psutil
+
+import rig_logging
+
+FD_ENV = "RIG_SUPERVISOR_FD"
+SUPERVISOR_LOG_FILE = os.path.join(rig_logging.LOG_DIR, "supervisor.jsonl")
+EXPERIMENT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "experiment.py")
+HEADLESS_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "headless.py")
+
+logger = logging.getLogger("rig.supervisor")
+
+# ---- child side ----
+_fd = int(os.environ[FD_ENV]) if os.environ.get(FD_ENV) else None
+if _fd is not None:
+    os.set_blocking(_fd, False)  # a message that does not fit is dropped, the child never blocks on it
+
+
+def supervised():
+    return _fd is not None
+
+
+def notify(kind, **fields):
+    """Sends one message (ready / heartbeat / restart) to the supervisor, if there is one"""
+    if _fd is None:
+        return
+    try:
+        os.write(_fd, (json.dumps({"type": kind, **fields}, default=str) + "\n").encode())
+    except OSError:
+        pass
+
+
+def send_heartbeat(experiment):
+    """Tells the supervisor that the experiment's process is alive, and where its FSM is"""
+    fsm = experiment.fsm
+    notify("heartbeat", exp=experiment.txt_file_name, running=fsm is not None,
+           trial=fsm.trial_count if fsm else 0, state=fsm.state.name if fsm else None,
+           state_s=time.monotonic() - fsm.state_since if fsm else 0)
+
+
+def spawn_supervisor(exp_name, headless=False):
+    """
+    Starts a supervisor that restarts exp_name once this process has exited
+    (for an unsupervised process that has to restart)
+    """
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), "--restart", exp_name,
+                             "--wait-pid", str(os.getpid())] + (["--headless"] if headless else []),
+                            cwd=os.getcwd(), start_new_session=True)
+
+
+# ---- supervisor side ----
+class Child:
+    """One experiment.py (or headless.py) process and the pipe of its messages"""
+
+    def __init__(self, script, args):
+        read_fd, write_fd = os.pipe()
+        env = dict(os.environ, **{FD_ENV: str(write_fd)})
+        self.process = subprocess.Popen([sys.executable, script] + args, env=env,
+                                        pass_fds=(write_fd,), stdin=subprocess.PIPE)
+        os.close(write_fd)
+        os.set_blocking(read_fd, False)
+        self.fd = read_fd
+        self.ps = psutil.Process(self.process.pid)
+        self.started = time.monotonic()
+        self.last_heartbeat = None  # the last heartbeat message
+        self.last_heartbeat_time = None
+        self.ready = False
+        self.restart_reason = None
+        self._buffer = b""
+
+    def read(self):
+        """Reads the messages that arrived; returns the new messages"""
+        messages = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            self._buffer += data
+        *lines, self._buffer = self._buffer.split(b"\n")
+        for line in lines:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            messages.append(message)
+            if message["type"] == "ready":
+                self.ready = True
+            elif message["type"] == "heartbeat":
+                self.last_heartbeat = message
+                self.last_heartbeat_time = time.monotonic()
+            elif message["type"] == "restart":
+                self.restart_reason = message.get("reason", "asked by the child")
+        return messages
+
+    @property
+    def running(self):
+        """The experiment of the child runs (its FSM was created)"""
+        return bool(self.last_heartbeat and self.last_heartbeat.get("running"))
+
+    def go(self, exp_name):
+        """Lets a standby child resume exp_name"""
+        self.process.stdin.write(exp_name.encode() + b"\n")
+        self.process.stdin.flush()
+
+    def rss_mb(self):
+        try:
+            return self.ps.memory_info().rss / 2**20
+        except psutil.Error:
+            return 0
+
+    def stop(self, timeout):
+        """SIGTERM, then SIGKILL after timeout seconds"""
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                logger.warning("[Supervisor] Child %d did not stop in %.0f s, killing it", self.process.pid, timeout)
+                self.process.kill()
+                self.process.wait()
+        self.close()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self.process.stdin:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+
+
+class Supervisor:
+
+    def __init__(self, exp_name=None, script=EXPERIMENT_SCRIPT, args=(), threshold_mb=450, heartbeat_timeout_s=30,
+                 startup_timeout_s=120, stuck_s=600, stop_timeout_s=10, max_restarts=5, restart_window_s=60 * 60,
+                 backoff_s=2, max_backoff_s=5 * 60, min_uptime_s=60, poll_s=0.5):
+        """
+        exp_name: restart this session from its checkpoint; None: start script with args for a new session
+        script: experiment.py or headless.py (both take --restart <exp name> and --standby)
+        threshold_mb: RSS of the child above which it is restarted (None: only when the child asks)
+        heartbeat_timeout_s: longest silence of a running child
+        startup_timeout_s: longest time before the first heartbeat (or before a standby is ready)
+        stuck_s: longest time in a state other than Idle
+        """
+        self.exp_name = exp_name
+        self.script = script
+        self.args = list(args)
+        self.threshold_mb = threshold_mb
+        self.heartbeat_timeout_s = heartbeat_timeout_s
+        self.startup_timeout_s = startup_timeout_s
+        self.stuck_s = stuck_s
+        self.stop_timeout_s = stop_timeout_s
+        self.max_restarts = max_restarts
+        self.restart_window_s = restart_window_s
+        self.backoff_s = backoff_s
+        self.max_backoff_s = max_backoff_s
+        self.min_uptime_s = min_uptime_s
+        self.poll_s = poll_s
+        self.child = None
+        self.restarts = deque()  # time.monotonic() of the restarts in the window
+        self.downtimes = []      # seconds the rig was down, per restart
+        self._short_lives = 0    # consecutive children that died before min_uptime_s
+        self._down_since = None  # time.monotonic() the last restart stopped the rig
+        self._stopped = False
+
+    def run(self):
+        """Runs until the experiment ends (or too many restarts). Returns the exit code"""
+        signal.signal(signal.SIGTERM, lambda *args: self.stop())
+        self.child = Child(self.script, ["--restart", self.exp_name] if self.exp_name else self.args)
+        while not self._stopped:
+            reason = self._check()
+            if reason is None:
+                continue
+            if reason == "ended":
+                logger.info("[Supervisor] The experiment ended")
+                return 0
+            if not self._restart(reason):
+                return 1
+        if self.child is not None:
+            self.child.stop(self.stop_timeout_s)
+        return 0
+
+    def stop(self):
+        self._stopped = True
+
+    def _wait_messages(self, child, timeout):
+        if child.fd is not None:
+            select.select([child.fd], [], [], timeout)
+            child.read()
+        else:
+            time.sleep(timeout)
+
+    def _check(self):
+        """Waits up to poll_s; returns why the child must be restarted, "ended", or None"""
+        child = self.child
+        self._wait_messages(child, self.poll_s)
+        if child.last_heartbeat is not None:
+            self.exp_name = child.last_heartbeat.get("exp") or self.exp_name
+        if child.running and self._down_since is not None:
+            self._record_downtime()
+        code = child.process.poll()
+        if code is not None:
+            child.read()
+            if code == 0 and child.restart_reason is None:
+                return "ended"
+            return child.restart_reason or f"exited with code {code}"
+        now = time.monotonic()
+        if child.restart_reason is not None:
+            return child.restart_reason
+        if self.threshold_mb is not None:
+            rss = child.rss_mb()
+            if rss > self.threshold_mb:
+                return f"RSS {rss:.0f} MB > {self.threshold_mb} MB"
+        if child.last_heartbeat_time is None:
+            # a new session waits for the operator's setup; a restarted one must come up
+            if self.exp_name is not None and now - child.started > self.startup_timeout_s:
+                return f"no heartbeat {self.startup_timeout_s} s after the start"
+        elif now - child.last_heartbeat_time > self.heartbeat_timeout_s:
+            return f"no heartbeat for {now - child.last_heartbeat_time:.0f} s"
+        state = child.last_heartbeat and child.last_heartbeat.get("state")
+        if state not in (None, "Idle") and child.last_heartbeat.get("state_s", 0) > self.stuck_s:
+            return f"stuck in {state} for {child.last_heartbeat['state_s']:.0f} s"
+        return None
+
+    def _restart(self, reason):
+        """Replaces the child; False if it gave up"""
+        now = time.monotonic()
+        old = self.child
+        crashed = old.process.poll() is not None
+        while self.restarts and now - self.restarts[0] > self.restart_window_s:
+            self.restarts.popleft()
+        if len(self.restarts) >= self.max_restarts:
+            logger.error("[Supervisor] %d restarts in %.0f min, giving up (%s)",
+                         len(self.restarts), self.restart_window_s / 60, reason)
+            old.stop(self.stop_timeout_s)
+            return False
+        if self.exp_name is None:
+            logger.error("[Supervisor] The child stopped before a session was started (%s), nothing to restart", reason)
+            old.stop(self.stop_timeout_s)
+            return False
+        self.restarts.append(now)
+        logger.warning("[Supervisor] Restarting %s: %s", self.exp_name, reason)
+        if crashed:
+            self._down_since = self._down_since or now
+            old.close()
+            self._short_lives = self._short_lives + 1 if now - old.started < self.min_uptime_s else 0
+            if self._short_lives:
+                delay = min(self.max_backoff_s, self.backoff_s * 2 ** (self._short_lives - 1))
+                logger.warning("[Supervisor] The child lived %.0f s, waiting %.1f s", now - old.started, delay)
+                time.sleep(delay)
+        standby = Child(self.script, ["--standby"])
+        # the old child keeps running trials while the standby imports
+        while not standby.ready:
+            self._wait_messages(standby, self.poll_s)
+            if standby.process.poll() is not None or time.monotonic() - standby.started > self.startup_timeout_s:
+                logger.error("[Supervisor] The standby child did not start, starting %s directly", self.exp_name)
+                standby.stop(self.stop_timeout_s)
+                old.stop(self.stop_timeout_s)
+                self._down_since = self._down_since or time.monotonic()
+                self.child = Child(self.script, ["--restart", self.exp_name])
+                return True
+        if not crashed:
+            self._down_since = time.monotonic()
+            old.stop(self.stop_timeout_s)  # releases the hardware
+        standby.go(self.exp_name)
+        self.child = standby
+        return True
+
+    def _record_downtime(self):
+        downtime = time.monotonic() - self._down_since
+        self._down_since = None
+        self.downtimes.append(downtime)
+        logger.info("[Supervisor] %s is running again after %.2f s", self.exp_name, downtime,
+                    extra={"downtime_s": round(downtime, 3), "restarts": len(self.restarts)})
+
+
+def _wait_for_exit(pid):
+    try:
+        psutil.Process(pid).wait()
+    except psutil.NoSuchProcess:
+        pass
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Runs experiment.py and restarts it from its checkpoint when needed")
+    parser.add_argument("config", nargs="?", help="the config file of a new headless session")
+    parser.add_argument("--headless", action="store_true", help="run headless.py instead of experiment.py")
+    parser.add_argument("--restart", metavar="EXP_NAME", help="resume this session (default: start a new one)")
+    parser.add_argument("--threshold-mb", type=float, default=450)
+    parser.add_argument("--max-restarts", type=int, default=5)
+    parser.add_argument("--wait-pid", type=int, help="start after this process has exited")
+    args = parser.parse_args()
+    rig_logging.setup_logging(log_file=SUPERVISOR_LOG_FILE)
+    if args.wait_pid:
+        _wait_for_exit(args.wait_pid)
+    if args.headless and not (args.config or args.restart):
+        parser.error("--headless needs a config file or --restart")
+    sys.exit(Supervisor(args.restart, script=HEADLESS_SCRIPT if args.headless else EXPERIMENT_SCRIPT,
+                        args=[args.config] if args.config else [],
+                        threshold_mb=args.threshold_mb, max_restarts=args.max_restarts).run())
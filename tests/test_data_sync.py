@@ -0,0 +1,84 @@
+import json
+import os
+
+import pytest
+
+import data_sync
+
+
+@pytest.fixture
+def folders(tmp_path):
+    src, dst = tmp_path / "src", tmp_path / "dst"
+    (src / "exp.trials").mkdir(parents=True)
+    (src / "exp.txt").write_bytes(b"header\nrow 1\n")
+    (src / "exp.trials" / "trials.bin").write_bytes(b"\0" * 64)
+    return str(src), str(dst)
+
+
+def read(folder, rel_path):
+    with open(os.path.join(folder, rel_path), "rb") as f:
+        return f.read()
+
+
+def test_first_sync_copies_everything(folders):
+    src, dst = folders
+    report = data_sync.sync_folder(src, dst)
+    assert (report.copied, report.appended, report.unchanged) == (2, 0, 0)
+    assert read(dst, "exp.txt") == read(src, "exp.txt")
+    assert read(dst, "exp.trials/trials.bin") == read(src, "exp.trials/trials.bin")
+    assert not os.path.exists(os.path.join(dst, data_sync.MANIFEST_FILE))  # the manifest stays in src
+
+
+def test_only_the_delta_is_transferred(folders):
+    src, dst = folders
+    data_sync.sync_folder(src, dst)
+    with open(os.path.join(src, "exp.txt"), "ab") as f:
+        f.write(b"row 2\n")
+
+    report = data_sync.sync_folder(src, dst)
+    assert (report.copied, report.appended, report.unchanged) == (0, 1, 1)
+    assert report.bytes_transferred == len(b"row 2\n")
+    assert read(dst, "exp.txt") == b"header\nrow 1\nrow 2\n"
+
+    report = data_sync.sync_folder(src, dst)
+    assert (report.copied, report.appended, report.unchanged, report.bytes_transferred) == (0, 0, 2, 0)
+
+
+def test_touched_file_is_not_copied(folders):
+    src, dst = folders
+    data_sync.sync_folder(src, dst)
+    os.utime(os.path.join(src, "exp.txt"), ns=(1, 1))
+    report = data_sync.sync_folder(src, dst)
+    assert (report.copied, report.appended, report.unchanged, report.bytes_transferred) == (0, 0, 2, 0)
+
+
+def test_rewritten_file_is_copied_whole(folders):
+    src, dst = folders
+    data_sync.sync_folder(src, dst)
+    with open(os.path.join(src, "exp.txt"), "wb") as f:
+        f.write(b"header\nrow X\nrow 2\n")  # grown, but the synced part changed
+    report = data_sync.sync_folder(src, dst)
+    assert (report.copied, report.appended) == (1, 0)
+    assert read(dst, "exp.txt") == b"header\nrow X\nrow 2\n"
+
+
+def test_interrupted_append_is_redone(folders):
+    src, dst = folders
+    data_sync.sync_folder(src, dst)
+    with open(os.path.join(src, "exp.txt"), "ab") as f:
+        f.write(b"row 2\n")
+    with open(os.path.join(dst, "exp.txt"), "ab") as f:
+        f.write(b"ro")  # an append cut short; the manifest still has the old size
+    report = data_sync.sync_folder(src, dst)
+    assert report.appended == 1
+    assert read(dst, "exp.txt") == b"header\nrow 1\nrow 2\n"
+
+
+def test_manifest_of_another_destination_is_ignored(folders, tmp_path):
+    src, dst = folders
+    data_sync.sync_folder(src, dst)
+    other = str(tmp_path / "other")
+    report = data_sync.sync_folder(src, other)
+    assert report.copied == 2
+    with open(os.path.join(src, data_sync.MANIFEST_FILE)) as f:
+        assert json.load(f)["dst"] == os.path.abspath(other)
@@ -0,0 +1,120 @@
+"""The FSM on the simulated rig (hardware.SimulatedBackend), in both runtime modes"""
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+
+import hardware
+from column_constants import ColumnNames
+from finite_state_machine import FiniteStateMachine
+from level import compile_levels
+from mouse import Mouse
+
+MOUSE_ID = "SIM0000001"
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(autouse=True)
+def in_repo(monkeypatch):
+    monkeypatch.chdir(REPO)  # the stimuli folder is relative to the working directory
+
+
+def make_experiment(txt_file_path):
+    """A minimal stand-in for experiment.Experiment with no GUI (like bench_fsm's)"""
+    levels_df = pd.DataFrame(
+        [["L1", 1, "go\\no-go", 100, 100, 1],  # the same odor twice: a go trial
+         ["L1", 2, "go\\no-go", 0, 0, 2]],
+        columns=[ColumnNames.LEVEL_NAME, ColumnNames.ODOR_NUMBER, ColumnNames.VALUE,
+                 ColumnNames.P_FIRST, ColumnNames.P_SECOND, ColumnNames.INDEX])
+    exp_params = {
+        "lick_time": "1",
+        "lick_time_bin_size": None,
+        "start_trial_option": "1",
+        "start_trial_time": None,
+        "IR_no_RFID_option": "1",
+        "lick_threshold": "3",
+        "time_to_lick_after_stim": "1",
+        "open_valve_duration": "0.02",
+        "open_odor_duration": "0.1",
+        "load_odor_duration": "0.05",
+        "inter_odor_delay": "0.3",
+        "timeout_punishment": "0",
+        "ITI": "1",
+        "ITI_time": None,
+        "stimulus_length": 2,
+    }
+    return SimpleNamespace(
+        exp_params=exp_params,
+        levels_df=levels_df,
+        mice_dict={MOUSE_ID: Mouse(MOUSE_ID, "L1")},
+        GPIO_dict={1: 5, 2: 6},
+        levels=compile_levels(levels_df, {1: 5, 2: 6}),
+        trial_plans=None,
+        progress=None,
+        live_w=SimpleNamespace(activate_window=False, pause=False),
+        txt_file_path=txt_file_path,
+        upload_data=lambda: None,
+    )
+
+
+def wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+def last_levels(valve_log):
+    levels = {}
+    for t, gpio, level in valve_log:
+        levels[gpio] = level
+    return levels
+
+
+@pytest.mark.parametrize("mode", ["threaded", "asyncio"])
+def test_trial_on_the_simulated_rig(tmp_path, mode):
+    licks = [0.7 + 0.1 * i for i in range(6)]  # in the response window, after the odors
+    backend = hardware.SimulatedBackend(
+        [hardware.SimulatedVisit(MOUSE_ID, arrive_after=0.05, enter_after=0.02, dwell=2.5, licks=licks)],
+        realtime_audio=False)
+    exp = make_experiment(str(tmp_path / "exp.txt"))
+    fsm = FiniteStateMachine(exp, backend=backend, mode=mode)
+    try:
+        assert wait_for(lambda: fsm.trial_count >= 1 and fsm.get_state() == "Idle", 15)
+    finally:
+        fsm.stop()
+
+    rows = pd.read_csv(exp.txt_file_path, dtype=str)
+    assert len(rows) == 1
+    assert rows["mouse ID"][0] == MOUSE_ID
+    assert rows["value"][0] == "go"
+    # the exit valve opened twice, once per odor, 0.1 + max(0.05, 0.3) s apart
+    exit_on = [t for t, gpio, level in backend.valve_log if gpio == hardware.exit_odor_valve_pin and level == 1]
+    assert len(exit_on) == 2
+    assert abs((exit_on[1] - exit_on[0]) / 1e9 - 0.4) < 0.02
+    on = {gpio for t, gpio, level in backend.valve_log if level == 1}
+    assert on == {5, hardware.exit_odor_valve_pin, hardware.valve_pin}  # the odor, and the reward for the licks
+    assert set(last_levels(backend.valve_log).values()) == {0}  # every valve closed again
+
+
+@pytest.mark.parametrize("mode", ["threaded", "asyncio"])
+def test_stop_with_the_mouse_in_the_port(tmp_path, mode):
+    backend = hardware.SimulatedBackend(
+        [hardware.SimulatedVisit(MOUSE_ID, arrive_after=0.05, enter_after=0.02, dwell=30)], realtime_audio=False)
+    exp = make_experiment(str(tmp_path / "exp.txt"))
+    fsm = FiniteStateMachine(exp, backend=backend, mode=mode)
+    # after the 1 s response window, the trial waits for the mouse to leave
+    assert wait_for(lambda: fsm.get_state() == "trial", 5)
+    time.sleep(2.5)
+
+    start = time.monotonic()
+    fsm.stop()
+    assert time.monotonic() - start < 2
+    assert not fsm.executor.is_alive()
+    assert "Trial planner" not in [thread.name for thread in threading.enumerate()]
+    assert len(pd.read_csv(exp.txt_file_path)) == 1  # the trial is saved without an exit
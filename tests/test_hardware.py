@@ -0,0 +1,63 @@
+import time
+
+import hardware
+
+
+class FakeLgpio:
+    """The part of lgpio that RigBackend.watch_input uses; keeps the alert functions"""
+    RISING_EDGE, FALLING_EDGE, BOTH_EDGES, TIMEOUT = 0, 1, 2, 2
+
+    def __init__(self):
+        self.alerts = {}
+
+    def gpio_free(self, h, pin):
+        pass
+
+    def gpio_claim_alert(self, h, pin, edge):
+        pass
+
+    def gpio_set_debounce_micros(self, h, pin, debounce_us):
+        pass
+
+    def callback(self, h, pin, edge, func):
+        self.alerts[pin] = func
+        return self
+
+    def cancel(self):
+        pass
+
+
+def make_rig():
+    rig = object.__new__(hardware.RigBackend)  # no GPIO chip here
+    hardware.HardwareBackend.__init__(rig)
+    rig.lgpio = FakeLgpio()
+    rig.h = 0
+    rig.IR_pin = hardware.IR_pin
+    rig.lick_pin = hardware.lick_pin
+    return rig
+
+
+def test_alert_timestamps_follow_a_wall_clock_step(monkeypatch):
+    rig = make_rig()
+    edges = []
+    rig.watch_input('lick', lambda level, timestamp_ns: edges.append(timestamp_ns))
+    alert = rig.lgpio.alerts[hardware.lick_pin]
+
+    alert(0, hardware.lick_pin, 1, time.time_ns())
+    # the wall clock (and the lgpio ticks with it) steps an hour forward after the registration
+    step_ns = 3600 * 10**9
+    real_time_ns = time.time_ns
+    monkeypatch.setattr(time, "time_ns", lambda: real_time_ns() + step_ns)
+    alert(0, hardware.lick_pin, 0, time.time_ns())
+
+    now_ns = time.monotonic_ns()
+    for timestamp_ns in edges:
+        assert abs(timestamp_ns - now_ns) < 50 * 10**6
+
+
+def test_watchdog_reports_are_not_edges():
+    rig = make_rig()
+    edges = []
+    rig.watch_input('ir', lambda level, timestamp_ns: edges.append(level))
+    rig.lgpio.alerts[hardware.IR_pin](0, hardware.IR_pin, FakeLgpio.TIMEOUT, time.time_ns())
+    assert edges == []
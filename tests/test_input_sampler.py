@@ -0,0 +1,69 @@
+import numpy as np
+
+import input_sampler
+from input_sampler import InputRing
+
+
+def fill(ring, timestamps):
+    for k, timestamp_ns in enumerate(timestamps):
+        ring.append(k % 2, (k // 2) % 2, timestamp_ns)
+
+
+def test_window_before_the_ring_wraps_is_a_view():
+    ring = InputRing(size=16)
+    fill(ring, range(100, 110))
+    t, channel, level = ring.window(103, 106)
+    assert t.tolist() == [103, 104, 105, 106]
+    assert channel.tolist() == [1, 0, 1, 0]
+    assert np.shares_memory(t, ring.t)
+
+
+def test_window_across_the_wrap_point():
+    ring = InputRing(size=16)
+    fill(ring, range(100, 140))  # 40 edges: the ring keeps 124..139, 124..131 at its end
+    assert ring.window(0, 1000)[0].tolist() == list(range(124, 140))
+    t, channel, level = ring.window(126, 133)
+    assert t.tolist() == list(range(126, 134))
+    assert channel.tolist() == [k % 2 for k in range(26, 34)]
+    assert level.tolist() == [(k // 2) % 2 for k in range(26, 34)]
+
+
+def test_window_in_one_segment_of_a_wrapped_ring_is_a_view():
+    ring = InputRing(size=16)
+    fill(ring, range(100, 140))
+    older = ring.window(124, 126)[0]
+    newer = ring.window(133, 137)[0]
+    assert older.tolist() == [124, 125, 126] and np.shares_memory(older, ring.t)
+    assert newer.tolist() == list(range(133, 138)) and np.shares_memory(newer, ring.t)
+
+
+def test_empty_and_overwritten_windows():
+    ring = InputRing(size=16)
+    assert ring.window(0, 10)[0].size == 0
+    fill(ring, range(100, 140))
+    assert ring.window(100, 123)[0].size == 0  # overwritten
+    assert ring.window(200, 300)[0].size == 0
+
+
+def test_read_since_across_the_wrap_point():
+    ring = InputRing(size=8)
+    fill(ring, range(10))
+    cursor = 6
+    fill(ring, range(10, 14))
+    (t, channel, level), cursor = ring.read_since(cursor)
+    assert t.tolist() == list(range(6, 14))
+    assert cursor == 14
+
+
+class _NoInputs:
+    def watch_input(self, name, callback, edge=None, debounce_us=0):
+        setattr(self, name, callback)
+
+
+def test_sampler_lick_onsets():
+    backend = _NoInputs()
+    sampler = input_sampler.InputSampler(backend, ring_size=64)
+    for k in range(10):
+        backend.lick(k % 2, 1000 + k)   # onsets at 1001, 1003, ...
+        backend.ir(k % 2, 1000 + k)
+    assert sampler.lick_onsets(1005, 1009).tolist() == [1005, 1007, 1009]
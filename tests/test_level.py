@@ -0,0 +1,82 @@
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from column_constants import ColumnNames
+from level import AliasTable, compile_levels
+
+
+def levels_table(rows):
+    return pd.DataFrame(rows, columns=[ColumnNames.LEVEL_NAME, ColumnNames.ODOR_NUMBER, ColumnNames.VALUE,
+                                       ColumnNames.P_FIRST, ColumnNames.P_SECOND, ColumnNames.INDEX])
+
+
+def table_probabilities(table):
+    """The probability of every index, rebuilt from the prob / alias columns"""
+    n = len(table.prob)
+    p = np.zeros(n)
+    for i in range(n):
+        p[i] += table.prob[i] / n
+        p[table.alias[i]] += (1 - table.prob[i]) / n
+    return p
+
+
+@pytest.mark.parametrize("weights", [[1], [1, 1], [1, 3], [0, 2, 5, 0, 1], [0.1, 0.2, 0.7], [50, 50, 0]])
+def test_alias_table_encodes_the_weights(weights):
+    table = AliasTable(weights)
+    expected = np.asarray(weights, dtype=float) / sum(weights)
+    np.testing.assert_allclose(table.p, expected)
+    np.testing.assert_allclose(table_probabilities(table), expected, atol=1e-12)
+
+
+def test_alias_table_all_zero_weights_draw_uniformly():
+    table = AliasTable([0, 0, 0, 0])
+    np.testing.assert_allclose(table_probabilities(table), 0.25)
+
+
+def test_alias_table_samples():
+    table = AliasTable([1, 0, 3])
+    rng = random.Random(1)
+    draws = np.bincount([table.sample(rng) for _ in range(20000)], minlength=3) / 20000
+    assert draws[1] == 0
+    assert abs(draws[2] - 0.75) < 0.02
+
+
+def test_compile_levels():
+    levels = compile_levels(levels_table([
+        ["L1", 1, "go\\no-go", 50, 0, 1],
+        ["L1", 2, "go\\no-go", 50, 100, 2],
+        ["L2", 2, "catch", 1, 1, 1],
+    ]), {1: 5, 2: 6})
+
+    assert list(levels) == ["L1", "L2"]
+    l1 = levels["L1"]
+    assert l1.odor_numbers.tolist() == [1, 2]
+    assert l1.gpios.tolist() == [5, 6]
+    assert l1.indices.tolist() == [1, 2]
+    assert l1.values.tolist() == ["go\\no-go", "go\\no-go"]
+    np.testing.assert_allclose(l1.p_first.p, [0.5, 0.5])
+    np.testing.assert_allclose(l1.p_second.p, [0, 1])
+    np.testing.assert_allclose(l1.p_neurolux, [0, 0])  # a table without the neurolux columns
+    assert not l1.gpios.flags.writeable
+    assert levels["L2"].gpios.tolist() == [6]
+
+
+def test_compile_levels_neurolux():
+    df = levels_table([["L1", 1, "go\\no-go", 1, 1, 1], ["L1", 2, "go\\no-go", 1, 1, 2]])
+    df[ColumnNames.IS_NEUROLUX] = ["Yes", "no"]
+    df[ColumnNames.P_NEUROLUX] = [30, 80]
+    np.testing.assert_allclose(compile_levels(df, {1: 5, 2: 6})["L1"].p_neurolux, [0.3, 0])
+
+
+@pytest.mark.parametrize("rows, message", [
+    ([["L1", 3, "go\\no-go", 1, 1, 1]], "no GPIO"),
+    ([["L1", 1, "go\\no-go", -1, 1, 1]], "finite and >= 0"),
+    ([["L1", 1, "go\\no-go", "a lot", 1, 1]], "must be numbers"),
+    ([["L1", 1, "go\\no-go", 1, 1, "first"]], "integers"),
+])
+def test_compile_levels_rejects_invalid_tables(rows, message):
+    with pytest.raises(ValueError, match=message):
+        compile_levels(levels_table(rows), {1: 5, 2: 6})
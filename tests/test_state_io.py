@@ -0,0 +1,78 @@
+import json
+import os
+import random
+
+import pandas as pd
+import pytest
+
+import state_io
+from column_constants import ColumnNames
+from mouse import Mouse
+from trial_planner import TrialPlan
+
+
+@pytest.fixture
+def exp_name(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # experiments/ is relative to the working directory
+    return "exp1"
+
+
+def levels_table():
+    return pd.DataFrame([["L1", 1, "go\\no-go", 50.0, 50.0, 1], ["L2", 2, "catch", 0.5, 1.5, 2]],
+                        columns=[ColumnNames.LEVEL_NAME, ColumnNames.ODOR_NUMBER, ColumnNames.VALUE,
+                                 ColumnNames.P_FIRST, ColumnNames.P_SECOND, ColumnNames.INDEX])
+
+
+def test_session_and_progress_round_trip(exp_name):
+    levels_df = levels_table()
+    mice = {"M1": Mouse("M1", "L1"), "M2": Mouse("M2", "L2")}
+    params = {"ITI": "1", "lick_time_bin_size": None, "stimulus_length": 2}
+    state_io.save_session(exp_name, params, levels_df, mice, "exp1.txt", "/data/exp1.txt", "a@b.c")
+    assert state_io.check_if_restart_available(exp_name)
+
+    state = state_io.load_state(exp_name)
+    assert state.exp_params == params
+    pd.testing.assert_frame_equal(state.levels_df, levels_df)
+    assert {m: mouse.get_level() for m, mouse in state.mice_dict.items()} == {"M1": "L1", "M2": "L2"}
+    assert (state.txt_file_name, state.txt_file_path, state.user_email) == ("exp1.txt", "/data/exp1.txt", "a@b.c")
+    assert state.progress is None
+
+    rng = random.Random(7)
+    rng.random()
+    plans = {"M1": [TrialPlan("L1", 0, 1, "go\\no-go", False), TrialPlan("L1", 1, 0, "go\\no-go", True)], "M2": []}
+    mice["M1"].update_level("L2")
+    progress = state_io.progress_of(12, mice, plans, rng.getstate())
+    state_io.save_progress(state_io.checkpoint_path(state_io.experiment_folder(exp_name)), progress)
+
+    state = state_io.load_state(exp_name)
+    assert state.progress.trial_count == 12
+    assert state.progress.trial_plans == plans
+    assert state.mice_dict["M1"].get_level() == "L2"  # the levels of the progress win over the session's
+    resumed = random.Random()
+    resumed.setstate(state.progress.rng_state)
+    assert resumed.random() == rng.random()
+
+
+def test_no_checkpoint(exp_name):
+    assert not state_io.check_if_restart_available(exp_name)
+    assert state_io.load_state(exp_name) is None
+
+
+def test_newer_checkpoint_is_refused(exp_name):
+    path = state_io.save_session(exp_name, {}, levels_table(), {}, "exp1.txt", "exp1.txt")
+    with open(path) as f:
+        data = json.load(f)
+    data["version"] = state_io.SCHEMA_VERSION + 1
+    with open(path, "w") as f:
+        json.dump(data, f)
+    with pytest.raises(ValueError, match="version"):
+        state_io.load_state(exp_name)
+
+
+def test_atomic_write_leaves_no_temporary_file(tmp_path):
+    path = str(tmp_path / "a.json")
+    state_io.write_json_atomic(path, {"kind": "x"})
+    state_io.write_json_atomic(path, {"kind": "y"})
+    assert os.listdir(tmp_path) == ["a.json"]
+    with open(path) as f:
+        assert json.load(f) == {"kind": "y"}
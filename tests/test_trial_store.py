@@ -0,0 +1,94 @@
+import os
+
+import numpy as np
+import pytest
+
+import trial_store
+from trial_store import TrialRow, TrialStore
+from trial_writer import TrialWriter
+
+
+def make_row(start=1_000, licks=(), all_licks=(), **fields):
+    row = TrialRow(start=start, end=start + 500, entry=start + 10, exit=None, reward=None, punishment=None,
+                   mouse="SIM0000001", level="L1", first_index=1, first_stim="a.npz", second_index="",
+                   second_stim=None, value="go\\no-go", score=1, neurolux=False, licks=list(licks),
+                   all_licks=list(all_licks))
+    return row._replace(**fields)
+
+
+def test_append_and_load(tmp_path):
+    store = TrialStore(str(tmp_path / "s.trials"))
+    store.append(make_row(start=1_000, licks=[5, 7], all_licks=[1, 5, 7]))
+    store.append(make_row(start=2_000, licks=[], all_licks=[3], mouse="SIM0000002"))
+    store.close()
+
+    loaded = trial_store.load(str(tmp_path / "s.txt"))  # the path of the CSV log finds its store
+    trials = loaded.trials
+    assert len(trials) == 2
+    assert trials["start"].astype(np.int64).tolist() == [1_000, 2_000]
+    assert np.isnat(trials["exit"]).all()
+    assert trials["mouse"].tolist() == ["SIM0000001", "SIM0000002"]
+    assert trials["second_index"].tolist() == [-1, -1]
+    assert trials["score"].tolist() == ["1", "1"]
+    assert trial_store.licks_of(loaded, 0).tolist() == [5, 7]
+    assert trial_store.licks_of(loaded, 1).tolist() == []
+    assert trial_store.licks_of(loaded, 1, all_licks=True).tolist() == [3]
+
+
+def test_load_of_an_empty_store(tmp_path):
+    TrialStore(str(tmp_path)).close()
+    loaded = trial_store.load(str(tmp_path))
+    assert len(loaded.trials) == 0 and len(loaded.licks) == 0
+
+
+def test_repair_drops_an_interrupted_append(tmp_path):
+    folder = str(tmp_path)
+    store = TrialStore(folder)
+    store.append(make_row(licks=[5, 7], all_licks=[1]))
+    store.close()
+    # a crash after the licks of the next trial and part of its record were written
+    with open(os.path.join(folder, trial_store.LICKS_FILE), "ab") as f:
+        f.write(np.array([9, 11], dtype=np.int64).tobytes())
+    with open(os.path.join(folder, trial_store.TRIALS_FILE), "ab") as f:
+        f.write(b"\1" * (trial_store.TRIAL_DTYPE.itemsize // 2))
+
+    store = TrialStore(folder)
+    store.append(make_row(licks=[3], all_licks=[2]))
+    store.close()
+
+    loaded = trial_store.load(folder)
+    assert len(loaded.trials) == 2
+    assert loaded.licks.tolist() == [5, 7, 3]
+    assert trial_store.licks_of(loaded, 1).tolist() == [3]
+    assert trial_store.licks_of(loaded, 1, all_licks=True).tolist() == [2]
+
+
+def test_text_longer_than_its_column_is_rejected(tmp_path):
+    store = TrialStore(str(tmp_path))
+    with pytest.raises(ValueError, match="level"):
+        store.append(make_row(level="L" * 17, licks=[1]))
+    store.close()
+    loaded = trial_store.load(str(tmp_path))
+    assert len(loaded.trials) == 0 and len(loaded.licks) == 0  # nothing of the trial was written
+
+
+def test_store_of_another_version_is_refused(tmp_path):
+    TrialStore(str(tmp_path)).close()
+    with open(tmp_path / trial_store.SCHEMA_FILE, "w") as f:
+        f.write('{"version": 99}')
+    with pytest.raises(ValueError, match="version"):
+        TrialStore(str(tmp_path))
+
+
+def test_trial_submitted_after_close_reaches_the_store(tmp_path):
+    path = str(tmp_path / "s.txt")
+    writer = TrialWriter(path, ("a", "b"), store=TrialStore(trial_store.store_path(path)))
+    writer.submit((1, 2), make_row(licks=[1]))
+    writer.close()
+    writer.submit((3, 4), make_row(licks=[2]))
+
+    with open(path) as f:
+        assert f.read().splitlines() == ["a,b", "1,2", "3,4"]
+    loaded = trial_store.load(path)
+    assert len(loaded.trials) == 2
+    assert loaded.licks.tolist() == [1, 2]
@@ -1,25 +1,39 @@
-from datetime import datetime
-import csv
-import random
 import os
-from column_constants import ColumnNames
+import input_sampler
+from trial_store import TrialRow
 class Trial:
+    CSV_HEADER = ('date', 'start time', 'end time', 'mouse ID', 'level', 'value',' first stim index', 'first stim name', 'second stim index', 'second stim name','score', 'licks_time', 'entry time', 'exit time', 'all licks time')
+
     def __init__(self,fsm):
         self.fsm = fsm
         self.current_mouse = None
-        self.first_stim_df = None
+        self.first_stim_number = None
         self.first_stim_index = None
+        self.first_stim_gpio = None
         self.first_stim_path = None
-        self.second_stim_df = None
+        self.second_stim_number = None
         self.second_stim_index = None
+        self.second_stim_gpio = None
         self.second_stim_path = None
         self.current_value = None #go\no-go
+        self.neurolux = False
         self.current_exp_parameters = None
         self.score = None
-        self.start_time = None
+        # Event times: int ns offsets from the session anchor (fsm.clock)
+        self.start_ns = None
+        self.end_ns = None
+        self.entry_ns = None  # beam break of this visit
+        self.exit_ns = None   # beam restore of this visit
+        self.reward_ns = None
+        self.punishment_ns = None
+        self.valve_events = []  # (offset ns, gpio, level) for every valve switch
+        # Lick/IR edges from the pre-trial baseline until the exit (input_sampler.InputRing columns)
+        self.input_t_ns = None
+        self.input_channel = None
+        self.input_level = None
 
         
-        self.licks_time = []
+        self.licks_ns = []
 
     def update_current_mouse(self, new_mouse: 'Mouse'):
         self.current_mouse = new_mouse
@@ -43,39 +57,17 @@ class Trial:
     #     self.current_stim_index = self.current_stim_df.iloc[0]['Index']
     #     go_probability = self.current_stim_df.iloc[0]['Go Probability']
     #     self.current_value = self.calculate_go_no_go(go_probability)
-    def calculate_stim(self): #determine if the trial is go\nogo\catch using random
-        level_name = self.current_mouse.get_level()
-        level_rows = self.fsm.exp.levels_df.loc[self.fsm.exp.levels_df[ColumnNames.LEVEL_NAME] == level_name]
-        first_stim_index = self.weighted_random_choice(ColumnNames.P_FIRST, level_rows)
-        second_stim_index = self.weighted_random_choice(ColumnNames.P_SECOND, level_rows)
-        self.first_stim_df = self.fsm.exp.levels_df.loc[(self.fsm.exp.levels_df[ColumnNames.LEVEL_NAME] == level_name)&(self.fsm.exp.levels_df[ColumnNames.INDEX] == first_stim_index)]
-        self.second_stim_df = self.fsm.exp.levels_df.loc[(self.fsm.exp.levels_df[ColumnNames.LEVEL_NAME] == level_name)&(self.fsm.exp.levels_df[ColumnNames.INDEX] == second_stim_index)]
-        self.first_stim_number = self.first_stim_df.iloc[0][ColumnNames.ODOR_NUMBER]
-        self.second_stim_number = self.second_stim_df.iloc[0][ColumnNames.ODOR_NUMBER]
-        self.first_stim_index = self.first_stim_df.iloc[0][ColumnNames.INDEX]
-        self.second_stim_index = self.second_stim_df.iloc[0][ColumnNames.INDEX]
-        self.current_value = self.calculate_value()
-
-    def weighted_random_choice(self, probabilities_column, level_rows):
-        probabilities = level_rows[probabilities_column].tolist()
-        indices = level_rows[ColumnNames.INDEX].tolist()
-        total_probability = sum(probabilities)
-        
-        if total_probability == 0:
-            # If all probabilities are 0, choose randomly
-            return random.choice(indices)
-        
-        normalized_probabilities = [p / total_probability for p in probabilities]
-        chosen_index = random.choices(indices, weights=normalized_probabilities, k=1)[0]
-        return chosen_index
-
-    def calculate_value(self):
-        if self.second_stim_df.iloc[0][ColumnNames.VALUE] == "catch":
-            return "catch"
-        elif self.first_stim_index==self.second_stim_index:
-            return "go"
-        else:
-            return "no-go"
+    def calculate_stim(self): # the next planned trial of the mouse (trial_planner.TrialPlan)
+        plan = self.fsm.planner.next_plan(self.current_mouse.get_id(), self.current_mouse.get_level())
+        level = self.fsm.exp.levels[plan.level]  # level.CompiledLevel
+        self.first_stim_number = int(level.odor_numbers[plan.first])
+        self.second_stim_number = int(level.odor_numbers[plan.second])
+        self.first_stim_index = int(level.indices[plan.first])
+        self.second_stim_index = int(level.indices[plan.second])
+        self.first_stim_gpio = int(level.gpios[plan.first])
+        self.second_stim_gpio = int(level.gpios[plan.second])
+        self.current_value = plan.value
+        self.neurolux = plan.neurolux
 
     def end_trial(self): # the trial is over - go to save it
         pass
@@ -86,29 +78,100 @@ class Trial:
         self.score = None
         self.current_stim = None
         self.current_value = None  # go\no-go\catch
+        self.neurolux = False
         self.current_stim_path = None
-        self.start_time = None
+        self.start_ns = None
+        self.end_ns = None
+        self.entry_ns = None
+        self.exit_ns = None
+        self.reward_ns = None
+        self.punishment_ns = None
+        self.valve_events = []
+        self.input_t_ns = None
+        self.input_channel = None
+        self.input_level = None
         self.current_stim_index = None
-        self.licks_time = []
+        self.licks_ns = []
+
+    def mark_start(self):
+        self.start_ns = self.fsm.clock.now()
+
+    def mark_end(self):
+        self.end_ns = self.fsm.clock.now()
+
+    def mark_reward(self):
+        self.reward_ns = self.fsm.clock.now()
+
+    def mark_punishment(self, onset_ns=None):
+        """onset_ns: time.monotonic_ns() of the sound onset (default: now)"""
+        self.punishment_ns = self.fsm.clock.now() if onset_ns is None else self.fsm.clock.offset(onset_ns)
+
+    def add_valve_event(self, gpio_number, level, monotonic_ns=None):
+        t = self.fsm.clock.now() if monotonic_ns is None else self.fsm.clock.offset(monotonic_ns)
+        self.valve_events.append((t, gpio_number, level))
+
+    def set_entry_time(self, entry_ns):
+        """entry_ns: time.monotonic_ns() of the beam break"""
+        if entry_ns is not None:
+            self.entry_ns = self.fsm.clock.offset(entry_ns)
+
+    def set_exit_time(self, exit_ns):
+        """exit_ns: time.monotonic_ns() of the beam restore"""
+        if exit_ns is not None:
+            self.exit_ns = self.fsm.clock.offset(exit_ns)
+
+    def add_lick_time(self, lick_ns=None):
+        """lick_ns: time.monotonic_ns() of the lick onset (default: now)"""
+        self.licks_ns.append(self.fsm.clock.now() if lick_ns is None else self.fsm.clock.offset(lick_ns))
+
+    def set_input_window(self, sampler, baseline_s):
+        """
+        Keeps the lick and IR edges from baseline_s before the start of the trial
+        until the exit (or now, if the mouse is still in the port).
+        The ring is reused for the whole session, so the window is copied.
+        """
+        clock = self.fsm.clock
+        anchor = clock.anchor_monotonic_ns
+        end_ns = self.exit_ns if self.exit_ns is not None else clock.now()
+        t, channel, level = sampler.ring.window(anchor + self.start_ns - int(baseline_s * 1e9), anchor + end_ns)
+        self.input_t_ns = t - anchor
+        self.input_channel = channel.copy()
+        self.input_level = level.copy()
 
-    def add_lick_time(self):
-        current_datetime = datetime.now()
-        self.licks_time.append(current_datetime.strftime('%H:%M:%S.%f'))
+    def all_lick_onsets(self):
+        """Offsets (ns) of every lick onset in the input window, including the baseline"""
+        if self.input_t_ns is None:
+            return []
+        onsets = (self.input_channel == input_sampler.LICK) & (self.input_level == 1)
+        return self.input_t_ns[onsets].tolist()
 # Function to write trial results
-    def write_trial_to_csv(self, txt_file_name):
-        header = ['date', 'start time', 'end time', 'mouse ID', 'level', 'value',' first stim index', 'first stim name', 'second stim index', 'second stim name','score', 'licks_time'] # Define the header if the file does not exist yet
-        current_datetime = datetime.now()
-        date = current_datetime.strftime('%Y-%m-%d')  # Get current date
-        end_time = current_datetime.strftime('%H:%M:%S.%f')  # Get current time
+    def write_trial_to_csv(self, trial_writer):
+        """Hands the trial to the session's trial_writer.TrialWriter as an immutable record (no disk I/O here)"""
+        # The legacy string columns are derived from the ns offsets only here
+        clock = self.fsm.clock
+        if self.end_ns is None:
+            self.mark_end()
+        date = clock.to_datetime(self.start_ns).strftime('%Y-%m-%d')
+        start_time = clock.to_time_str(self.start_ns)
+        end_time = clock.to_time_str(self.end_ns)
+        # the lists are written as their str(), like csv.writer does
+        licks_time = str([clock.to_time_str(t) for t in self.licks_ns])
+        all_licks_ns = self.all_lick_onsets()
+        all_licks_time = str([clock.to_time_str(t) for t in all_licks_ns])
         first_stim_name = self.first_stim_number
         second_stim_name = self.second_stim_number
-        trial_data = [date, self.start_time, end_time, self.current_mouse.id, self.current_mouse.level, self.current_value, self.first_stim_index, first_stim_name, self.second_stim_index, second_stim_name, self.score , self.licks_time]
-        with open(txt_file_name, mode='a', newline='') as file:
-            writer = csv.writer(file)
-            # Check if the file is empty to write the header
-            if file.tell() == 0:  # Check if the file is empty
-                writer.writerow(header)  # Write the header
-            writer.writerow(trial_data)
+        trial_data = (date, start_time, end_time, self.current_mouse.id, self.current_mouse.level, self.current_value, self.first_stim_index, first_stim_name, self.second_stim_index, second_stim_name, self.score , licks_time, clock.to_time_str(self.entry_ns), clock.to_time_str(self.exit_ns), all_licks_time)
+        # the same trial with typed columns for the binary store
+        store_row = TrialRow(start=clock.to_wall_ns(self.start_ns), end=clock.to_wall_ns(self.end_ns),
+                             entry=clock.to_wall_ns(self.entry_ns), exit=clock.to_wall_ns(self.exit_ns),
+                             reward=clock.to_wall_ns(self.reward_ns), punishment=clock.to_wall_ns(self.punishment_ns),
+                             mouse=self.current_mouse.id, level=self.current_mouse.level,
+                             first_index=self.first_stim_index, first_stim=first_stim_name,
+                             second_index=self.second_stim_index, second_stim=second_stim_name,
+                             value=self.current_value, score=self.score, neurolux=self.neurolux,
+                             licks=tuple(t - self.start_ns for t in self.licks_ns),
+                             all_licks=tuple(t - self.start_ns for t in all_licks_ns))
+        trial_writer.submit(trial_data, store_row)
 
 
 
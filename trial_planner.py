@@ -0,0 +1,190 @@
+"""
+Look-ahead trial planning.
+
+TrialPlanner keeps a queue of the next trials of every mouse (stimulus pair,
+go/no-go/catch value and neurolux flag), so the trial only pops a ready plan.
+The queues are refilled by a background thread after every pop.
+
+Two ways to fill a queue:
+- independent draws from the level's P(first) / P(second) alias tables
+- blocks of block_size trials in which every pair appears in proportion to
+  P(first) * P(second), shuffled
+Both can be limited to max_same_value consecutive trials with the same value.
+
+The queues are plain lists of TrialPlan (snapshot()); they are saved with the
+state of the RNG (state()) after every trial, so a restarted session continues
+the same sequence.
+"""
+import logging
+import random
+import threading
+from collections import deque, namedtuple
+
+import numpy as np
+
+# first / second: rows of the level's level.CompiledLevel arrays
+TrialPlan = namedtuple("TrialPlan", ["level", "first", "second", "value", "neurolux"])
+
+logger = logging.getLogger("rig.planner")
+
+
+def pair_value(level, first, second):
+    """go\\no-go\\catch of a stimulus pair of a level.CompiledLevel"""
+    if level.values[second] == "catch":
+        return "catch"
+    elif level.indices[first] == level.indices[second]:
+        return "go"
+    else:
+        return "no-go"
+
+
+class TrialPlanner:
+
+    def __init__(self, exp, lookahead=20, block_size=None, max_same_value=None, plans=None, seed=None,
+                 rng_state=None):
+        """
+        exp: the experiment; its compiled levels (exp.levels) are read on every refill
+        lookahead: trials kept ready per mouse
+        block_size: None for independent draws, otherwise the number of trials per block
+        max_same_value: None, or the longest allowed run of trials with the same value
+        plans: {mouse id: [TrialPlan, ...]} from snapshot() of a previous session
+        rng_state: the RNG state from state() of a previous session (instead of seed)
+        """
+        self.exp = exp
+        self.lookahead = lookahead
+        self.block_size = block_size
+        self.max_same_value = max_same_value
+        self.rng = random.Random(seed)
+        if rng_state is not None:
+            self.rng.setstate(rng_state)
+        self._plans = {}        # mouse id -> deque of TrialPlan
+        self._last_values = {}  # mouse id -> values of the last planned trials (for max_same_value)
+        self._to_refill = {}    # mouse id -> level name
+        self._lock = threading.Lock()
+        self._refill_needed = threading.Event()
+        self._stopped = False
+        for mouse_id, mouse_plans in (plans or {}).items():
+            if all(self._is_valid(plan) for plan in mouse_plans):
+                self._plans[mouse_id] = deque(mouse_plans)
+                self._last_values[mouse_id] = deque((plan.value for plan in mouse_plans), maxlen=max_same_value or 1)
+        self._thread = threading.Thread(target=self._refill_loop, name="Trial planner", daemon=True)
+        self._thread.start()
+
+    def _is_valid(self, plan):
+        level = self.exp.levels.get(plan.level)
+        return level is not None and max(plan.first, plan.second) < len(level.indices)
+
+    def next_plan(self, mouse_id, level_name):
+        """Pops the next trial of the mouse (plans of another level are dropped)"""
+        with self._lock:
+            queue = self._plans.setdefault(mouse_id, deque())
+            if queue and queue[0].level != level_name:
+                logger.info("Level of %s changed to %s: dropped %d plans", mouse_id, level_name, len(queue))
+                queue.clear()
+                # the run of the old level's values does not carry over to the new level
+                self._last_values.pop(mouse_id, None)
+            if not queue:
+                # first trial of the mouse (or of its new level) - plan it here
+                queue.extend(self._generate(mouse_id, level_name))
+            plan = queue.popleft()
+            self._to_refill[mouse_id] = level_name
+        self._refill_needed.set()
+        return plan
+
+    def snapshot(self):
+        """{mouse id: [TrialPlan, ...]} of the planned trials, for the session state"""
+        with self._lock:
+            return {mouse_id: list(queue) for mouse_id, queue in self._plans.items()}
+
+    def state(self):
+        """(snapshot(), the RNG state) taken together, for the checkpoint of the session"""
+        with self._lock:
+            return {mouse_id: list(queue) for mouse_id, queue in self._plans.items()}, self.rng.getstate()
+
+    def stop(self):
+        """Ends the refill thread (after the refill it is doing)"""
+        self._stopped = True
+        self._refill_needed.set()
+        self._thread.join(timeout=1)
+
+    def _refill_loop(self):
+        while True:
+            self._refill_needed.wait()
+            self._refill_needed.clear()
+            if self._stopped:
+                return
+            with self._lock:
+                to_refill, self._to_refill = self._to_refill, {}
+            for mouse_id, level_name in to_refill.items():
+                self._refill(mouse_id, level_name)
+
+    def _refill(self, mouse_id, level_name):
+        with self._lock:
+            queue = self._plans[mouse_id]
+            while len(queue) < self.lookahead and (not queue or queue[-1].level == level_name):
+                queue.extend(self._generate(mouse_id, level_name))
+
+    # ---- generation (called with _lock held) ----
+    def _generate(self, mouse_id, level_name):
+        level = self.exp.levels[level_name]
+        last_values = self._last_values.setdefault(mouse_id, deque(maxlen=self.max_same_value or 1))
+        if self.block_size:
+            pairs = self._order(self._block_pairs(level), level, last_values)
+        else:
+            # lazy, so every draw sees the values of the ones before it
+            pairs = (self._draw_pair(level, last_values) for _ in range(self.lookahead))
+        plans = []
+        for first, second in pairs:
+            value = pair_value(level, first, second)
+            last_values.append(value)
+            neurolux = self.rng.random() < level.p_neurolux[second]
+            plans.append(TrialPlan(level_name, first, second, value, neurolux))
+        return plans
+
+    def _breaks_run(self, value, last_values):
+        """True if value would make a run longer than max_same_value"""
+        if not self.max_same_value or len(last_values) < self.max_same_value:
+            return False
+        return all(v == value for v in last_values)
+
+    def _draw_pair(self, level, last_values, attempts=20):
+        for _ in range(attempts):
+            pair = level.p_first.sample(self.rng), level.p_second.sample(self.rng)
+            if not self._breaks_run(pair_value(level, *pair), last_values):
+                break
+        return pair
+
+    def _block_pairs(self, level):
+        """The pairs of one block: block_size * P(first) * P(second) of each pair, rounded by largest remainder"""
+        p = np.outer(level.p_first.p, level.p_second.p).ravel()
+        expected = p * self.block_size
+        counts = np.floor(expected).astype(int)
+        remainder = self.block_size - counts.sum()
+        if remainder:
+            counts[np.argsort(counts - expected, kind="stable")[:remainder]] += 1
+        n = len(level.indices)
+        return [divmod(int(k), n) for k in np.repeat(np.arange(len(p)), counts)]
+
+    def _order(self, pairs, level, last_values, attempts=20):
+        """
+        Orders the block so no run of equal values is longer than max_same_value.
+        Greedy: picks a random pair among the ones that keep the runs short; if the
+        block cannot be finished that way in any attempt, the last ordering is used.
+        """
+        for _ in range(attempts):
+            remaining = list(pairs)
+            values = deque(last_values, maxlen=last_values.maxlen)
+            ordered = []
+            ok = True
+            while remaining:
+                allowed = [i for i, pair in enumerate(remaining)
+                           if not self._breaks_run(pair_value(level, *pair), values)]
+                if not allowed:
+                    ok = False
+                    allowed = range(len(remaining))
+                pair = remaining.pop(self.rng.choice(allowed))
+                values.append(pair_value(level, *pair))
+                ordered.append(pair)
+            if ok:
+                break
+        return ordered
@@ -0,0 +1,278 @@
+"""
+Columnar binary store of the trials, written next to the CSV trial log.
+
+The store of <session>.txt is the folder <session>.trials with:
+- trials.bin: one fixed-width record (TRIAL_DTYPE) per trial
+- licks.bin / all_licks.bin: int64 lick onsets of all the trials, in ns from
+  the start of their trial; the licks of trial i are
+  licks[trials['licks_start'][i]:trials['licks_stop'][i]]
+- schema.json: the record dtype
+Times are datetime64[ns] (UTC, NaT when missing). Everything is read with
+np.memmap, so load() copies nothing; to_dataframe() builds pandas columns on
+the mapped arrays. pandas is imported only by to_dataframe() and the conversion
+(the FSM process never needs it).
+
+The FSM appends through trial_writer.TrialWriter. Old CSV logs are converted with
+    python trial_store.py [experiments folder]
+"""
+import ast
+import csv
+import glob
+import json
+import os
+import shutil
+import sys
+from collections import namedtuple
+from datetime import datetime
+
+import numpy as np
+
+TRIALS_FILE = "trials.bin"
+LICKS_FILE = "licks.bin"
+ALL_LICKS_FILE = "all_licks.bin"
+SCHEMA_FILE = "schema.json"
+VERSION = 1
+NAT = np.iinfo(np.int64).min  # int64 of datetime64('NaT')
+
+TRIAL_DTYPE = np.dtype([
+    ("start", "M8[ns]"),
+    ("end", "M8[ns]"),
+    ("entry", "M8[ns]"),
+    ("exit", "M8[ns]"),
+    ("reward", "M8[ns]"),
+    ("punishment", "M8[ns]"),
+    ("mouse", "U32"),
+    ("level", "U16"),
+    ("first_index", "i2"),   # -1: none
+    ("first_stim", "U32"),
+    ("second_index", "i2"),
+    ("second_stim", "U32"),
+    ("value", "U8"),
+    ("score", "U24"),
+    ("neurolux", "?"),
+    ("licks_start", "i8"),
+    ("licks_stop", "i8"),
+    ("all_licks_start", "i8"),
+    ("all_licks_stop", "i8"),
+])
+
+# One trial as handed to TrialStore.append(): times in wall-clock ns since the epoch (None: missing),
+# licks / all_licks in ns from the start of the trial
+TrialRow = namedtuple("TrialRow", ["start", "end", "entry", "exit", "reward", "punishment", "mouse", "level",
+                                   "first_index", "first_stim", "second_index", "second_stim",
+                                   "value", "score", "neurolux", "licks", "all_licks"])
+
+# Trials = load(): the record array and the two lick arrays
+Trials = namedtuple("Trials", ["trials", "licks", "all_licks"])
+
+
+def store_path(txt_path):
+    """The store folder of a CSV trial log"""
+    return os.path.splitext(txt_path)[0] + ".trials"
+
+
+def _int_or(value, default=-1):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+class TrialStore:
+    """Appends trials to a store folder. Not thread-safe: used by the trial writer thread only"""
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        schema_path = os.path.join(folder, SCHEMA_FILE)
+        if os.path.exists(schema_path):
+            with open(schema_path) as f:
+                schema = json.load(f)
+            if schema.get("version") != VERSION:
+                raise ValueError(f"{folder}: store version {schema.get('version')}, expected {VERSION}")
+        else:
+            with open(schema_path, "w") as f:
+                json.dump({"version": VERSION, "dtype": TRIAL_DTYPE.descr}, f, indent=1)
+        self._trials = open(os.path.join(folder, TRIALS_FILE), "ab")
+        self._licks = open(os.path.join(folder, LICKS_FILE), "ab")
+        self._all_licks = open(os.path.join(folder, ALL_LICKS_FILE), "ab")
+        self._repair()
+
+    def _repair(self):
+        """Drops a partial record and the licks no record points to (an interrupted append)"""
+        size = self._trials.tell()
+        self._trials.truncate(size - size % TRIAL_DTYPE.itemsize)
+        self._trials.seek(0, os.SEEK_END)
+        last = None
+        if self._trials.tell():
+            last = np.fromfile(self._trials.name, dtype=TRIAL_DTYPE, offset=self._trials.tell() - TRIAL_DTYPE.itemsize)[0]
+        for file, field in ((self._licks, "licks_stop"), (self._all_licks, "all_licks_stop")):
+            file.truncate(int(last[field]) * 8 if last is not None else 0)
+            file.seek(0, os.SEEK_END)
+
+    def append(self, row):
+        """
+        Writes one TrialRow (the licks first: a record never points past the end of the lick files)
+        Raises ValueError, before writing anything, if a text field does not fit its column
+        """
+        record = np.zeros(1, dtype=TRIAL_DTYPE)
+        for name in ("start", "end", "entry", "exit", "reward", "punishment"):
+            value = getattr(row, name)
+            record[name] = np.int64(NAT if value is None else value).view("M8[ns]")
+        for name in ("mouse", "level", "first_stim", "second_stim", "value", "score"):
+            value = "" if getattr(row, name) is None else str(getattr(row, name))
+            width = TRIAL_DTYPE[name].itemsize // 4
+            if len(value) > width:
+                # numpy would silently cut it; nothing is written
+                raise ValueError(f"{name} {value!r} is longer than the {width} characters of the store")
+            record[name] = value
+        record["first_index"] = _int_or(row.first_index)
+        record["second_index"] = _int_or(row.second_index)
+        record["neurolux"] = bool(row.neurolux)
+        for file, licks, field in ((self._licks, row.licks, "licks"), (self._all_licks, row.all_licks, "all_licks")):
+            licks = np.asarray(licks, dtype=np.int64)
+            start = file.tell() // 8
+            file.write(licks.tobytes())
+            record[field + "_start"] = start
+            record[field + "_stop"] = start + len(licks)
+        self._trials.write(record.tobytes())
+
+    def flush(self, fsync=False):
+        for file in (self._licks, self._all_licks, self._trials):
+            file.flush()
+            if fsync:
+                os.fsync(file.fileno())
+
+    def close(self):
+        self.flush(fsync=True)
+        for file in (self._licks, self._all_licks, self._trials):
+            file.close()
+
+
+def _map(path, dtype, count=None):
+    if count is None:
+        count = os.path.getsize(path) // np.dtype(dtype).itemsize
+    if count == 0:
+        return np.zeros(0, dtype=dtype)  # np.memmap cannot map an empty file
+    return np.memmap(path, dtype=dtype, mode="r", shape=(count,))
+
+
+def load(folder):
+    """Trials of a store folder (or of a CSV log path), memory-mapped read-only"""
+    if folder.endswith(".txt"):
+        folder = store_path(folder)
+    with open(os.path.join(folder, SCHEMA_FILE)) as f:
+        schema = json.load(f)
+    dtype = np.dtype([tuple(field) for field in schema["dtype"]])
+    trials = _map(os.path.join(folder, TRIALS_FILE), dtype)
+    return Trials(trials, _map(os.path.join(folder, LICKS_FILE), np.int64),
+                  _map(os.path.join(folder, ALL_LICKS_FILE), np.int64))
+
+
+def licks_of(store, i, all_licks=False):
+    """Lick onsets (ns from the trial start) of trial i of a load() result, as a view"""
+    if all_licks:
+        return store.all_licks[store.trials["all_licks_start"][i]:store.trials["all_licks_stop"][i]]
+    return store.licks[store.trials["licks_start"][i]:store.trials["licks_stop"][i]]
+
+
+def to_dataframe(store):
+    """The trial records of a load() result as a DataFrame, one column per field"""
+    import pandas as pd
+    trials = store.trials
+    return pd.DataFrame({name: trials[name] for name in trials.dtype.names}, copy=False)
+
+
+# ---- conversion of CSV logs ----
+def _wall_ns(date, time_str):
+    """Wall-clock ns of a log's date + 'HH:MM:SS.ffffff' local time (None for empty cells)"""
+    if not isinstance(time_str, str) or not time_str.strip():
+        return None
+    return int(datetime.strptime(f"{date} {time_str.strip()}", "%Y-%m-%d %H:%M:%S.%f").timestamp() * 1e6) * 1000
+
+
+def _relative_licks(date, start, licks_str):
+    try:
+        licks = ast.literal_eval(licks_str) if isinstance(licks_str, str) else []
+    except (ValueError, SyntaxError):
+        licks = []
+    out = []
+    for lick in licks:
+        t = _wall_ns(date, lick)
+        if t is not None:
+            if t < start - 12 * 3600 * 10**9:
+                t += 24 * 3600 * 10**9  # after midnight
+            out.append(t - start)
+    return out
+
+
+def _row_from_csv(row):
+    """TrialRow of a CSV log row (the current header or the older single-stimulus one)"""
+    date = row["date"]
+    start = _wall_ns(date, row["start time"])
+    def wall(column):
+        t = _wall_ns(date, row.get(column))
+        if t is not None and start is not None and t < start - 12 * 3600 * 10**9:
+            t += 24 * 3600 * 10**9
+        return t
+    if "value" in row:
+        first = (row.get(" first stim index"), row.get("first stim name"))
+        second = (row.get("second stim index"), row.get("second stim name"))
+        value = row["value"]
+    else:
+        first = (row.get("stim index"), row.get("stim name"))
+        second = (None, None)
+        value = row.get("go\\no-go")
+    return TrialRow(start=start, end=wall("end time"), entry=wall("entry time"), exit=wall("exit time"),
+                    reward=None, punishment=None,
+                    mouse=str(row["mouse ID"]).strip(), level=row.get("level"),
+                    first_index=first[0], first_stim=first[1], second_index=second[0], second_stim=second[1],
+                    value=value, score=row.get("score"), neurolux=False,
+                    licks=_relative_licks(date, start, row.get("licks_time")),
+                    all_licks=_relative_licks(date, start, row.get("all licks time")))
+
+
+def is_trial_log(path):
+    """True if the file starts with a trial log header"""
+    try:
+        with open(path, newline="") as f:
+            header = next(csv.reader(f), [])
+    except (OSError, UnicodeDecodeError):
+        return False
+    return "start time" in header and "licks_time" in header
+
+
+def convert_txt(txt_path):
+    """(Re)builds the store of a CSV trial log. Returns the number of trials"""
+    import pandas as pd
+    folder = store_path(txt_path)
+    tmp = folder + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    df = pd.read_csv(txt_path, dtype=str, keep_default_na=False)
+    store = TrialStore(tmp)
+    converted = 0
+    for row in df.to_dict("records"):
+        try:
+            store.append(_row_from_csv(row))
+            converted += 1
+        except (KeyError, ValueError) as e:
+            print(f"[TrialStore] Skipped a row of {txt_path}: {e}")
+    store.close()
+    shutil.rmtree(folder, ignore_errors=True)
+    os.replace(tmp, folder)
+    return converted
+
+
+def convert_all(experiments_folder="experiments"):
+    """Converts every experiments/*/*.txt trial log whose store is missing or older than the log"""
+    for txt_path in sorted(glob.glob(os.path.join(experiments_folder, "*", "*.txt"))):
+        if not is_trial_log(txt_path):
+            continue
+        trials_path = os.path.join(store_path(txt_path), TRIALS_FILE)
+        if os.path.exists(trials_path) and os.path.getmtime(trials_path) >= os.path.getmtime(txt_path):
+            continue
+        print(f"[TrialStore] {txt_path}: {convert_txt(txt_path)} trials")
+
+
+if __name__ == "__main__":
+    convert_all(sys.argv[1] if len(sys.argv) > 1 else "experiments")
@@ -0,0 +1,203 @@
+"""
+Background writer of the trial results file.
+
+TrialWriter keeps the experiment's txt file open for the whole session. The
+FSM hands it one immutable record (tuple) per trial with submit(), which only
+puts the record on a queue; a writer thread writes whatever is queued as one
+batch and flushes it to disk according to the policy:
+- flush_every: records written between flushes (1: every batch is flushed)
+- flush_interval_s: the longest a written record waits for its flush
+- fsync: os.fsync() after every flush, so a flushed trial survives a power cut
+flush() and close() return after everything submitted before them is on disk,
+whatever the policy.
+With a trial_store.TrialStore, every trial is also appended to the store by the
+same thread, under the same policy.
+A results file with another header (written by an older version, with other
+columns) is moved aside to <name>.<n>.txt and a new file is started, so the
+rows of one file always match its header.
+"""
+import atexit
+import csv
+import logging
+import os
+import queue
+import threading
+import time
+
+import trial_store
+
+logger = logging.getLogger("rig.trial_writer")
+
+_CLOSE = object()
+
+
+def set_aside_mismatched(path, header):
+    """
+    If path has a header other than header, renames it to <name>.<n><ext> (the first free n)
+    so that a new file is started. Returns the new name of the old file, or None
+    """
+    try:
+        with open(path, newline='') as file:
+            old_header = next(csv.reader(file), None)
+    except FileNotFoundError:
+        return None
+    if old_header is None or tuple(old_header) == tuple(header):
+        return None
+    root, ext = os.path.splitext(path)
+    n = 1
+    while os.path.exists(f"{root}.{n}{ext}"):
+        n += 1
+    os.rename(path, f"{root}.{n}{ext}")
+    logger.warning("%s has other columns than this version writes, moved it to %s and started a new file",
+                   path, f"{root}.{n}{ext}")
+    return f"{root}.{n}{ext}"
+
+
+class _FlushRequest:
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class TrialWriter:
+
+    def __init__(self, path, header, flush_every=1, flush_interval_s=5.0, fsync=True, store=None):
+        """
+        path: the results file; the header is written only if the file is empty
+              (a file with another header is moved aside first, see set_aside_mismatched)
+        header: the column names
+        store: None, or a trial_store.TrialStore that gets every trial too
+        """
+        self.path = path
+        self.header = tuple(header)
+        self.flush_every = max(1, flush_every)
+        self.flush_interval_s = flush_interval_s
+        self.fsync = fsync
+        self.store = store
+        self.closed = False
+        self._queue = queue.Queue()
+        set_aside_mismatched(path, self.header)
+        self._file = open(path, mode='a', newline='')
+        self._writer = csv.writer(self._file)
+        if self._file.tell() == 0:
+            self._writer.writerow(self.header)
+            self._sync()
+        self._thread = threading.Thread(target=self._run, name="Trial writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)  # the thread is a daemon: drain the queue before the interpreter exits
+
+    def submit(self, record, store_row=None):
+        """
+        Queues one trial and returns at once
+        record: a tuple with one value per header column
+        store_row: the trial_store.TrialRow of the trial (for the store)
+        """
+        if self.closed:
+            # a trial that ended after close() (e.g. during a restart) is still saved to the CSV, the slow way
+            logger.warning("Writer closed, appending the trial directly")
+            with open(self.path, mode='a', newline='') as file:
+                csv.writer(file).writerow(record)
+            if self.store is not None and store_row is not None:
+                self._append_closed_store(store_row)
+            return
+        self._queue.put((record, store_row))
+
+    def _append_closed_store(self, store_row):
+        """Adds a trial submitted after close() to the store, reopened for it"""
+        if self._thread.is_alive():
+            # close() timed out: the writer thread may still append, a second writer would corrupt the store
+            logger.error("Writer thread still running, the trial is not added to the store %s", self.store.folder)
+            return
+        try:
+            store = trial_store.TrialStore(self.store.folder)
+            try:
+                store.append(store_row)
+            finally:
+                store.close()
+        except (OSError, ValueError) as e:
+            logger.error("Error adding a trial to the store after close: %s", e)
+
+    def flush(self, timeout=None):
+        """Waits until every trial submitted so far is flushed (and fsynced, if enabled). False on timeout"""
+        if self.closed:
+            return True
+        request = _FlushRequest()
+        self._queue.put(request)
+        return request.done.wait(timeout)
+
+    def close(self, timeout=10.0):
+        """Writes the queued trials, syncs and closes the file. Safe to call more than once"""
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.put(_CLOSE)
+        self._thread.join(timeout)
+        atexit.unregister(self.close)
+        # a trial submitted while closing may have missed the writer thread
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, _FlushRequest):
+                item.done.set()
+            elif item is not _CLOSE:
+                self.submit(*item)
+
+    def _run(self):
+        unflushed = 0
+        last_flush = time.monotonic()
+        while True:
+            timeout = self.flush_interval_s - (time.monotonic() - last_flush) if unflushed else None
+            try:
+                item = self._queue.get(timeout=max(0, timeout) if timeout is not None else None)
+            except queue.Empty:
+                item = None
+            # everything already queued is written as one batch
+            items = [] if item is None else [item]
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            requests = []
+            closing = False
+            for item in items:
+                if item is _CLOSE:
+                    closing = True
+                elif isinstance(item, _FlushRequest):
+                    requests.append(item)
+                else:
+                    record, store_row = item
+                    try:
+                        self._writer.writerow(record)
+                        unflushed += 1
+                    except (OSError, csv.Error) as e:
+                        logger.error("Error writing a trial: %s - %s", e, record)
+                    if self.store is not None and store_row is not None:
+                        try:
+                            self.store.append(store_row)
+                        except (OSError, ValueError) as e:
+                            logger.error("Error adding a trial to the store: %s", e)
+            if unflushed and (requests or closing or unflushed >= self.flush_every
+                              or time.monotonic() - last_flush >= self.flush_interval_s):
+                self._sync()
+                unflushed = 0
+                last_flush = time.monotonic()
+            for request in requests:
+                request.done.set()
+            if closing:
+                self._sync()
+                self._file.close()
+                if self.store is not None:
+                    self.store.close()
+                return
+
+    def _sync(self):
+        try:
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            if self.store is not None:
+                self.store.flush(self.fsync)
+        except OSError as e:
+            logger.error("Error flushing %s: %s", self.path, e)
@@ -12,43 +12,48 @@ import tracemalloc
 import objgraph
 import logging
 import pandas as pd
+import stimulus_bank
+import audio_engine
+
+folder = '/home/educage/git_educage2/educage2/pythonProject1/stimuli'
+bank = stimulus_bank.open_bank(folder)
+if bank is None:
+    print(f"No stimulus bank in {folder} (python stimulus_bank.py {folder}), reading the .npz files")
+
+
+def load(name):
+    if bank is not None and name in bank:
+        return bank.get(name)
+    return audio_engine.load_sound(os.path.join(folder, name))
+
+
 try:
-    with np.load('/home/educage/git_educage2/educage2/pythonProject1/stimuli/white_noise.npz', mmap_mode='r') as z:
-         noise = z['noise']
-         Fs = int(z['Fs'])
+    noise, Fs = load('white_noise.npz')
     sd.play(noise, samplerate=Fs, blocking=True)  #sd.wait()
 finally:
     sd.stop()
     time.sleep(1)
 try:
-    with np.load('/home/educage/git_educage2/educage2/pythonProject1/stimuli/scary_noise_with_ultrasonic.npz', mmap_mode='r') as z:
-         noise = z['data']
-         Fs = int(z['Fs'])
+    noise, Fs = load('scary_noise_with_ultrasonic.npz')
     sd.play(noise, samplerate=Fs, blocking=True)
 finally:
     sd.stop()
     time.sleep(1)
 try:
-    with np.load('/home/educage/git_educage2/educage2/pythonProject1/stimuli/scary_noise.npz', mmap_mode='r') as z:
-         noise = z['data']
-         Fs = int(z['Fs'])
+    noise, Fs = load('scary_noise.npz')
     sd.play(noise, samplerate=Fs, blocking=True)
 finally:
     sd.stop()
     time.sleep(1)
 try:
-    with np.load('/home/educage/git_educage2/educage2/pythonProject1/stimuli/scary_noise_with_ultrasonic.npz', mmap_mode='r') as z:
-         noise = z['data']
-         Fs = int(z['Fs'])
+    noise, Fs = load('scary_noise_with_ultrasonic.npz')
     sd.play(noise, samplerate=Fs)
     sd.wait()
 finally:
     sd.stop()
     time.sleep(1)
 try:
-    with np.load('/home/educage/git_educage2/educage2/pythonProject1/stimuli/scary_noise.npz', mmap_mode='r') as z:
-         noise = z['data']
-         Fs = int(z['Fs'])
+    noise, Fs = load('scary_noise.npz')
     sd.play(noise, samplerate=Fs)
     sd.wait()
 finally:
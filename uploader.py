@@ -0,0 +1,172 @@
+"""
+Background upload of experiment folders to the lab share.
+
+The FSM never uploads: it only calls mark_dirty(folder) when the session
+changed (a trial was written). The uploader thread uploads every dirty
+folder at most once per interval_s; a failed upload is retried after
+backoff_s, doubled on every failure up to max_backoff_s. The dirty folders
+are kept in PENDING_FILE, so a restarted process uploads what the previous
+one did not.
+
+listeners are called (from the uploader thread) with an UploadStatus when
+an upload starts or ends and every status_interval_s, for the live window.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+PENDING_FILE = "upload_pending.json"
+UPLOAD_MAX_BYTES_PER_S = 2 * 2**20  # bandwidth cap of the uploads to the lab share
+
+# state: "up to date", "pending", "uploading" or "retrying"
+# lag_s: seconds since the oldest change that is not on the share yet
+UploadStatus = namedtuple("UploadStatus", ["state", "pending", "lag_s", "last_upload", "last_error", "last_report"])
+
+logger = logging.getLogger("rig.uploader")
+
+
+def format_status(status):
+    """Short text of an UploadStatus for the live window"""
+    if status.state == "up to date":
+        return "up to date"
+    text = f"{status.state}, lag {status.lag_s / 60:.0f} min"
+    if status.state == "retrying" and status.last_error:
+        text += f" ({status.last_error[:40]})"
+    return text
+
+
+class Uploader:
+
+    def __init__(self, upload, interval_s=30 * 60, backoff_s=60, max_backoff_s=60 * 60, max_bytes_per_s=None,
+                 pending_file=PENDING_FILE, status_interval_s=10):
+        """
+        upload: upload(folder, max_bytes_per_s) uploads a folder (e.g. with data_sync.sync_folder)
+                and returns its report; any exception counts as a failed upload
+        max_bytes_per_s: bandwidth cap passed to upload (None: no cap)
+        """
+        self.upload = upload
+        self.interval_s = interval_s
+        self.backoff_s = backoff_s
+        self.max_backoff_s = max_backoff_s
+        self.max_bytes_per_s = max_bytes_per_s
+        self.pending_file = pending_file
+        self.status_interval_s = status_interval_s
+        self.listeners = []
+        self._lock = threading.Lock()
+        self._pending = self._load_pending()  # folder -> time.time() of its oldest change not uploaded
+        self._marks = {}         # folder -> number of mark_dirty() calls (to see changes during an upload)
+        self._next_attempt = {}  # folder -> time.monotonic() of its next upload
+        self._failures = {}      # folder -> consecutive failed uploads
+        self._uploading = None
+        self.last_upload = None  # time.time() of the last successful upload
+        self.last_error = None
+        self.last_report = None
+        self._stopped = False
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="Uploader", daemon=True)
+        self._thread.start()
+
+    def mark_dirty(self, folder):
+        """Notes that folder changed; returns at once"""
+        with self._lock:
+            self._marks[folder] = self._marks.get(folder, 0) + 1
+            if folder in self._pending:
+                return
+            self._pending[folder] = time.time()
+            self._save_pending()
+        self._wake.set()
+
+    def status(self):
+        with self._lock:
+            oldest = min(self._pending.values(), default=None)
+            if self._uploading is not None:
+                state = "uploading"
+            elif any(self._failures.values()):
+                state = "retrying"
+            elif self._pending:
+                state = "pending"
+            else:
+                state = "up to date"
+            return UploadStatus(state, len(self._pending), 0 if oldest is None else time.time() - oldest,
+                                self.last_upload, self.last_error, self.last_report)
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+
+    def _load_pending(self):
+        try:
+            with open(self.pending_file) as f:
+                return {folder: t for folder, t in json.load(f).items() if os.path.isdir(folder)}
+        except (OSError, ValueError, AttributeError):
+            return {}
+
+    def _save_pending(self):
+        """Called with _lock held"""
+        try:
+            with open(self.pending_file + ".tmp", "w") as f:
+                json.dump(self._pending, f, indent=1)
+            os.replace(self.pending_file + ".tmp", self.pending_file)
+        except OSError as e:
+            logger.error("Could not save %s: %s", self.pending_file, e)
+
+    def _run(self):
+        last_status = 0
+        while not self._stopped:
+            now = time.monotonic()
+            with self._lock:
+                due = [folder for folder in self._pending if self._next_attempt.get(folder, 0) <= now]
+            for folder in due:
+                self._upload(folder)
+            if due or time.monotonic() - last_status >= self.status_interval_s:
+                self._publish()
+                last_status = time.monotonic()
+            with self._lock:
+                waits = [t - time.monotonic() for folder, t in self._next_attempt.items() if folder in self._pending]
+            self._wake.wait(max(0.1, min(waits + [self.status_interval_s])))
+            self._wake.clear()
+
+    def _upload(self, folder):
+        with self._lock:
+            self._uploading = folder
+            marks = self._marks.get(folder, 0)
+        self._publish()
+        started = time.time()
+        try:
+            report = self.upload(folder, self.max_bytes_per_s)
+        except Exception as e:
+            with self._lock:
+                failures = self._failures.get(folder, 0) + 1
+                self._failures[folder] = failures
+                delay = min(self.max_backoff_s, self.backoff_s * 2 ** (failures - 1))
+                self._next_attempt[folder] = time.monotonic() + delay
+                self.last_error = f"{type(e).__name__}: {e}"
+                self._uploading = None
+            # the first failure of a streak is a warning; the retries of an unreachable share are not
+            logger.log(logging.WARNING if failures == 1 else logging.DEBUG,
+                       "Upload of %s failed (%s), retrying in %.0f s", folder, self.last_error, delay)
+            return
+        with self._lock:
+            if self._failures.pop(folder, None):
+                logger.info("Upload of %s succeeded again", folder)
+            self._next_attempt[folder] = time.monotonic() + self.interval_s
+            self.last_upload = time.time()
+            self.last_error = None
+            self.last_report = report
+            if self._marks.get(folder, 0) == marks:
+                del self._pending[folder]
+            else:
+                self._pending[folder] = started  # changed during the upload
+            self._save_pending()
+            self._uploading = None
+
+    def _publish(self):
+        status = self.status()
+        for listener in self.listeners:
+            try:
+                listener(status)
+            except Exception as e:
+                logger.error("Status listener failed: %s", e)
@@ -0,0 +1,118 @@
+"""
+Declarative valve timelines.
+
+A trial's valve activity is described as pulses (channel, onset, duration),
+compiled once per trial into a sorted list of switches, and executed against
+absolute deadlines on the monotonic clock. The sequencer sleeps until ~1 ms
+before each deadline and spins for the rest, so errors do not accumulate from
+one switch to the next. While a timeline runs, the interpreter's thread switch
+interval is shortened (precise_switching), so a thread holding the GIL hands it
+to the waking sequencer within SWITCH_INTERVAL_S instead of the default 5 ms.
+"""
+import logging
+import sys
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+ValvePulse = namedtuple("ValvePulse", ["channel", "onset", "duration"])  # seconds from the timeline start
+ValveSwitch = namedtuple("ValveSwitch", ["offset_ns", "channel", "level"])
+SwitchRecord = namedtuple("SwitchRecord", ["planned_ns", "actual_ns", "channel", "level"])  # time.monotonic_ns()
+
+logger = logging.getLogger("rig.valves")
+_warned_delays = set()  # (load, inter-odor delay) already warned about
+
+SWITCH_INTERVAL_S = 0.0002
+
+
+@contextmanager
+def precise_switching(interval=SWITCH_INTERVAL_S):
+    """Shortens sys.getswitchinterval() to interval for the duration of the block"""
+    previous = sys.getswitchinterval()
+    sys.setswitchinterval(min(previous, interval))
+    try:
+        yield
+    finally:
+        sys.setswitchinterval(previous)
+
+
+def odor_timeline(first_gpio, second_gpio, exit_gpio, load_duration, stim_duration, inter_odor_delay):
+    """
+    The DMTS odor presentation:
+    load the first odor, open the exit valve for the stimulus, then load the second
+    odor for the inter-odor delay and open the exit valve again.
+    """
+    inter_delay = max(load_duration, inter_odor_delay)
+    if load_duration > inter_odor_delay and (load_duration, inter_odor_delay) not in _warned_delays:
+        _warned_delays.add((load_duration, inter_odor_delay))
+        logger.warning("The inter-odor delay (%s s) is shorter than the odor load duration (%s s). "
+                       "The wait time between odors is increased due to the load time.", inter_odor_delay, load_duration)
+    first_on = load_duration
+    second_on = first_on + stim_duration + inter_delay
+    # the exit valve is listed first so it closes before the odor valve behind it
+    return [
+        ValvePulse(exit_gpio, first_on, stim_duration),
+        ValvePulse(first_gpio, 0.0, first_on + stim_duration),
+        ValvePulse(exit_gpio, second_on, stim_duration),
+        ValvePulse(second_gpio, first_on + stim_duration, inter_delay + stim_duration),
+    ]
+
+
+def compile_timeline(pulses):
+    """
+    Turns pulses into switches sorted by time.
+    At the same time, closing comes before opening; otherwise the pulses' order is kept.
+    """
+    switches = []
+    for pulse in pulses:
+        onset_ns = int(round(pulse.onset * 1e9))
+        switches.append(ValveSwitch(onset_ns, pulse.channel, 1))
+        switches.append(ValveSwitch(onset_ns + int(round(pulse.duration * 1e9)), pulse.channel, 0))
+    switches.sort(key=lambda switch: (switch.offset_ns, switch.level))
+    return switches
+
+
+class ValveSequencer:
+
+    def __init__(self, backend, spin_ns=1_000_000):
+        """
+        backend: hardware.HardwareBackend
+        spin_ns: the last part of every wait that is busy-waited instead of slept
+        """
+        self.backend = backend
+        self.spin_ns = spin_ns
+
+    def wait_until(self, deadline_ns):
+        remaining = deadline_ns - time.monotonic_ns()
+        if remaining > self.spin_ns:
+            time.sleep((remaining - self.spin_ns) / 1e9)
+        while time.monotonic_ns() < deadline_ns:
+            pass
+
+    def run(self, switches, on_switch=None):
+        """
+        Executes compiled switches, starting now.
+        on_switch(channel, level) is called after a switch is done (e.g. for the live window);
+        it does not shift the following deadlines.
+        Returns a SwitchRecord per switch with the planned and actual times.
+        """
+        records = []
+        t0 = time.monotonic_ns()
+        with precise_switching():
+            try:
+                for switch in switches:
+                    planned = t0 + switch.offset_ns
+                    self.wait_until(planned)
+                    if switch.level:
+                        self.backend.valve_on(switch.channel)
+                    else:
+                        self.backend.valve_off(switch.channel)
+                    records.append(SwitchRecord(planned, time.monotonic_ns(), switch.channel, switch.level))
+                    if on_switch is not None:
+                        on_switch(switch.channel, switch.level)
+            finally:
+                # never leave a valve open (e.g. on an exception from the backend)
+                if len(records) < len(switches):
+                    for channel in {switch.channel for switch in switches}:
+                        self.backend.valve_off(channel)
+        return records